@@ -0,0 +1,226 @@
+"""
+Admission control for generation requests
+
+Generations hold a slot from admission until they finish, and at most
+ADMISSION_CONCURRENCY hold one at a time per process. The rest wait in a
+bounded queue with two lanes: interactive (chat, single generations) and
+batch. While both lanes have waiters, interactive gets
+ADMISSION_INTERACTIVE_WEIGHT slots for every one batch gets, so batch
+jobs slow down under load but never stop. Within a lane, clients take
+turns, so one client's burst queues behind its own requests rather than
+everyone else's.
+
+A request that would have to wait longer than it is allowed to is turned
+away at once with a retry hint instead of tying up a server thread until
+it times out; generations already admitted keep their upstream capacity,
+so completed work per second holds steady however far demand overshoots.
+Requests that don't generate (health, metrics, listings) never come
+through here.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', 'true').lower() not in ('0', 'false', 'no')
+# Generations in progress per process; defaults to the upstream connection cap
+ADMISSION_CONCURRENCY = int(os.getenv('ADMISSION_CONCURRENCY', os.getenv('LLM_MAX_CONCURRENCY', 16)))
+# Generations waiting per process, across clients and lanes
+ADMISSION_QUEUE_LIMIT = int(os.getenv('ADMISSION_QUEUE_LIMIT', 32))
+# Generations one client may have waiting
+ADMISSION_CLIENT_QUEUE_LIMIT = int(os.getenv('ADMISSION_CLIENT_QUEUE_LIMIT', 8))
+# Longest a request waits for a slot before it gets a 429
+ADMISSION_MAX_WAIT_MS = int(os.getenv('ADMISSION_MAX_WAIT_MS', 10000))
+# Interactive slots granted per batch slot while both lanes are waiting
+ADMISSION_INTERACTIVE_WEIGHT = int(os.getenv('ADMISSION_INTERACTIVE_WEIGHT', 4))
+# Header naming the end user when requests arrive through a proxy such as the backend
+ADMISSION_CLIENT_HEADER = os.getenv('ADMISSION_CLIENT_HEADER', 'X-Client-Id')
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+LANES = (INTERACTIVE, BATCH)
+
+# Weight of the newest sample in the moving average of slot hold times
+_HOLD_SMOOTHING = 0.2
+
+
+class Overloaded(Exception):
+    """Generation turned away; retry_after is whole seconds until a retry is likely to be admitted"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Generation not admitted: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A held generation slot; release it once, or use it as a context manager"""
+
+    def __init__(self, controller=None, waited=0.0):
+        self.controller = controller
+        self.waited = waited
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self.controller is not None and not self._released:
+            self._released = True
+            self.controller._release(time.monotonic() - self.started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _Waiter:
+    __slots__ = ('client', 'lane', 'granted', 'event')
+
+    def __init__(self, client, lane):
+        self.client = client
+        self.lane = lane
+        self.granted = False
+        self.event = threading.Event()
+
+
+class AdmissionController:
+    """Slots, lanes and per-client round-robin queues for one process"""
+
+    def __init__(self, concurrency=ADMISSION_CONCURRENCY, queue_limit=ADMISSION_QUEUE_LIMIT,
+                 client_queue_limit=ADMISSION_CLIENT_QUEUE_LIMIT, max_wait_ms=ADMISSION_MAX_WAIT_MS,
+                 interactive_weight=ADMISSION_INTERACTIVE_WEIGHT, enabled=ADMISSION_CONTROL):
+        self.concurrency = max(1, concurrency)
+        self.queue_limit = max(0, queue_limit)
+        self.client_queue_limit = max(1, client_queue_limit)
+        self.max_wait = max_wait_ms / 1000.0
+        self.interactive_weight = max(1, interactive_weight)
+        self.enabled = enabled
+        self.active = 0
+        # lane -> client -> waiters; clients are served in insertion order and rotate to the back
+        self._queues = {lane: OrderedDict() for lane in LANES}
+        self._queued = dict.fromkeys(LANES, 0)
+        self._interactive_run = 0
+        # Moving average of how long a slot is held; None until a generation finishes
+        self._hold = None
+        self.admitted = Counter()
+        self.rejected = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        return sum(self._queued.values())
+
+    def admit(self, client, lane=INTERACTIVE, deadline=None):
+        """Wait for a slot and return its Ticket, or raise Overloaded
+
+        deadline (a resilience.Deadline) shortens the wait to what is left
+        of the request's budget.
+        """
+        if not self.enabled:
+            return Ticket()
+        lane = lane if lane in self._queues else INTERACTIVE
+        limit = self.max_wait if deadline is None else min(self.max_wait, deadline.remaining())
+        with self._lock:
+            if self.active < self.concurrency and not self.queued:
+                self.active += 1
+                self.admitted[lane] += 1
+                return Ticket(self)
+            self._screen(client, lane, limit)
+            waiter = _Waiter(client, lane)
+            self._queues[lane].setdefault(client, deque()).append(waiter)
+            self._queued[lane] += 1
+
+        started = time.monotonic()
+        waiter.event.wait(limit)
+        with self._lock:
+            if not waiter.granted:
+                self._remove(waiter)
+                self.rejected[lane, 'timeout'] += 1
+                raise Overloaded('timeout', self._retry_after())
+        return Ticket(self, time.monotonic() - started)
+
+    def check(self, client, lane=INTERACTIVE):
+        """Raise Overloaded if a request from client would be turned away right now"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.active >= self.concurrency or self.queued:
+                self._screen(client, lane, self.max_wait)
+
+    def _screen(self, client, lane, limit):
+        """Turn away a request that the queue has no room or no time for; called with the lock held"""
+        reason = None
+        if self.queued >= self.queue_limit:
+            reason = 'queue_full'
+        elif len(self._queues[lane].get(client, ())) >= self.client_queue_limit:
+            reason = 'client_queue_full'
+        elif self._hold is not None:
+            # Interactive only waits behind interactive; batch waits behind everything
+            ahead = self._queued[INTERACTIVE] if lane == INTERACTIVE else self.queued
+            if (ahead + 1) * self._hold / self.concurrency > limit:
+                reason = 'wait_too_long'
+        if reason is not None:
+            self.rejected[lane, reason] += 1
+            raise Overloaded(reason, self._retry_after())
+
+    def _retry_after(self):
+        """Seconds until the current queue has drained, at least 1"""
+        if self._hold is None:
+            return 1
+        return max(1, math.ceil((self.queued + 1) * self._hold / self.concurrency))
+
+    def _remove(self, waiter):
+        clients = self._queues[waiter.lane]
+        waiters = clients[waiter.client]
+        waiters.remove(waiter)
+        if not waiters:
+            del clients[waiter.client]
+        self._queued[waiter.lane] -= 1
+
+    def _release(self, held):
+        with self._lock:
+            self.active -= 1
+            self._hold = held if self._hold is None else self._hold + _HOLD_SMOOTHING * (held - self._hold)
+            while self.active < self.concurrency and self.queued:
+                self._grant(self._next_lane())
+
+    def _next_lane(self):
+        if not self._queued[BATCH]:
+            return INTERACTIVE
+        if not self._queued[INTERACTIVE] or self._interactive_run >= self.interactive_weight:
+            self._interactive_run = 0
+            return BATCH
+        self._interactive_run += 1
+        return INTERACTIVE
+
+    def _grant(self, lane):
+        """Hand a slot to the first waiter of the lane's next client; called with the lock held"""
+        clients = self._queues[lane]
+        client, waiters = next(iter(clients.items()))
+        waiter = waiters.popleft()
+        if waiters:
+            clients.move_to_end(client)
+        else:
+            del clients[client]
+        self._queued[lane] -= 1
+        self.active += 1
+        self.admitted[lane] += 1
+        waiter.granted = True
+        waiter.event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'concurrency': self.concurrency,
+                'active': self.active,
+                'queued': dict(self._queued),
+                'queueLimit': self.queue_limit,
+                'waitingClients': sum(len(clients) for clients in self._queues.values()),
+                'holdSeconds': round(self._hold, 3) if self._hold is not None else None,
+                'admitted': dict(self.admitted),
+                'rejected': {f"{lane}:{reason}": count for (lane, reason), count in self.rejected.items()}
+            }
@@ -1,11 +1,31 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 import os
 import json
-import re
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
 from datetime import datetime
 from dotenv import load_dotenv
-import openai
+from retrieval import InvertedIndex, term_counts
+from llm_client import LLMClient
+from local_llm import LocalLLM
+from resilience import GENERATION_DEADLINE_MS, BreakerOpen, Deadline, DeadlineExceeded, UpstreamGuard
+from cache import ParseCache, ResponseCache, content_digest, response_cache_key
+from document_store import DocumentStore, summarize_elements
+from conversation_context import ConversationContext
+from semantic_index import SEMANTIC_REFIT_GROWTH, SEMANTIC_RETRIEVAL, fit_semantic_index
+from fallback_pools import FallbackPools, canned
+from context_packer import CONTEXT_CANDIDATES, CONTEXT_TOKEN_BUDGET, ContextChunk, format_chunks, pack_chunks
+from training_store import STORE_ENABLED, LogGap, TrainingStore
+from training_watcher import TrainingWatcher, training_directory, training_metadata
+from ingest import BulkIngester, parse_elements, read_ndjson, read_tar, training_record
+from dedup import ACTIONS, DedupIndex
+from admission import ADMISSION_CLIENT_HEADER, BATCH, INTERACTIVE, LANES, AdmissionController, Overloaded
+from metrics import (HTTP_REQUESTS, HTTP_SECONDS, PROFILER_ENABLED, SERVER_TIMING, STAGE_SECONDS, UPSTREAM_ERRORS,
+                     finish_request_timing, profiler, registry, stage, start_request_timing)
 
 # Load environment variables
 load_dotenv()
@@ -19,116 +39,566 @@ DEBUG = os.getenv('FLASK_ENV') == 'development'
 
 # OpenAI Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+SCENE_MAX_TOKENS = 1000
+OUTLINE_MAX_TOKENS = 800
+# Lower temperature for more consistent use of training data
+GENERATION_TEMPERATURE = 0.3
 
-# Initialize OpenAI client
-if not OPENAI_API_KEY or OPENAI_API_KEY == "your_openai_api_key_here":
-    print("⚠️  WARNING: OPENAI_API_KEY not set or using default value")
-    print("   Please create a .env file with your actual OpenAI API key")
-    print("   Example: OPENAI_API_KEY=sk-your_actual_key_here")
-    openai_available = False
+# Batch generation
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 100))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 8))
+
+# Background corpus warmup: threads reading training files, and files read ahead of record building
+WARMUP_READERS = int(os.getenv('WARMUP_READERS', 8))
+WARMUP_READ_AHEAD = 4 * WARMUP_READERS
+# Set by gunicorn.conf.py under preload: each worker starts its own warmup after the fork
+# (threads don't survive one) instead of the master loading the corpus before it forks
+WARMUP_AFTER_FORK = os.getenv('WARMUP_AFTER_FORK', 'false').lower() in ('1', 'true', 'yes')
+
+# /scripts listing
+SCRIPTS_PAGE_SIZE = int(os.getenv('SCRIPTS_PAGE_SIZE', 50))
+SCRIPTS_MAX_PAGE_SIZE = int(os.getenv('SCRIPTS_MAX_PAGE_SIZE', 500))
+SCRIPT_FIELDS = ('id', 'filename', 'category', 'metadata', 'parsed', 'timestamp', 'digest', 'length', 'content')
+DEFAULT_SCRIPT_FIELDS = ('id', 'filename', 'metadata', 'parsed', 'timestamp')
+
+# Generation backend: 'openai' for the chat-completions API, 'local' for a model on disk
+GENERATION_BACKEND = os.getenv('GENERATION_BACKEND', 'openai').lower()
+
+if GENERATION_BACKEND == 'local':
+    # Same interface as LLMClient; torch is only imported once a request arrives
+    llm_client = LocalLLM()
+    openai_available = llm_client.available
+    if openai_available:
+        print(f"✅ Local model configured: {llm_client.model_dir}")
+    else:
+        print(f"⚠️  WARNING: GENERATION_BACKEND=local but no model found in {llm_client.model_dir}")
+        print("   Set LOCAL_MODEL_DIR to a Hugging Face causal-LM directory")
 else:
-    try:
-        openai.api_key = OPENAI_API_KEY
-        # Test the API key with a simple request
+    # Initialize OpenAI client
+    if not OPENAI_API_KEY or OPENAI_API_KEY == "your_openai_api_key_here":
+        print("⚠️  WARNING: OPENAI_API_KEY not set or using default value")
+        print("   Please create a .env file with your actual OpenAI API key")
+        print("   Example: OPENAI_API_KEY=sk-your_actual_key_here")
+        openai_available = False
+    else:
         openai_available = True
         print(f"✅ OpenAI API key loaded successfully")
-    except Exception as e:
-        print(f"❌ OpenAI initialization error: {e}")
-        openai_available = False
+    
+    # Pooled upstream client; connections are opened lazily on first use
+    llm_client = LLMClient(OPENAI_API_KEY)
+
+# Cached answers are only shared between requests served by the same model
+GENERATION_MODEL = f"local:{llm_client.model_dir}" if GENERATION_BACKEND == 'local' else OPENAI_MODEL
+
+# Deadlines, circuit breaker and hedging around every upstream call
+upstream_guard = UpstreamGuard()
+
+# Bounded, fair queue in front of generation; health, metrics and listings bypass it
+admission = AdmissionController()
 
 class ScriptGenerator:
-    def __init__(self):
-        self.training_data = []
-        self.load_training_data()
+    def __init__(self, warm_up=True):
+        self.training_data = DocumentStore()
+        # Near-duplicate clusters, applied at ingest and collapsed at retrieval (DEDUP_POLICY)
+        self.dedup = DedupIndex()
+        self.dedup.rebuild(self.training_data)
+        self.index = InvertedIndex()
+        # Scene/beat-sized chunks, scored separately to pick prompt context
+        self.chunk_index = InvertedIndex()
+        # Optional latent-semantic view of the chunks, blended with BM25 (SEMANTIC_RETRIEVAL)
+        self.semantic = None
+        self._semantic_fitting = threading.Lock()
+        # Chunk count of the last fit that came back empty (corpus too small to reduce)
+        self._semantic_unfit_at = None
+        self.parse_cache = ParseCache(parse_elements)
+        self.response_cache = ResponseCache()
+        self.conversation_context = ConversationContext()
+        self.fallback_pools = FallbackPools()
+        self.bulk_ingester = BulkIngester()
+        self.store = TrainingStore() if STORE_ENABLED else None
+        self._write_lock = threading.Lock()
+        # Serializes commits when there is no store lock to do it
+        self._commit_lock = threading.Lock()
+        # Reloads training files edited on disk once started (see gunicorn.conf.py and __main__)
+        self.watcher = TrainingWatcher(
+            self, training_directory(),
+            os.path.join(self.store.directory, 'watch.lock') if self.store is not None else None)
+        # The corpus loads in the background so the port binds straight away; until it is
+        # done, requests are served from whatever has been indexed so far (see /ready)
+        self.warmed_up = threading.Event()
+        self.warmup_error = None
+        self.warmup_files = None
+        self.warmup_files_read = 0
+        self._warmup_started = time.monotonic()
+        self._warmup_seconds = None
+        self._warmup_thread = None
+        if warm_up:
+            self.start_warmup()
+    
+    def start_warmup(self):
+        """Load the corpus on a background thread, once per generator"""
+        if self._warmup_thread is not None:
+            return
+        self._warmup_started = time.monotonic()
+        self._warmup_thread = threading.Thread(target=self._warm_up, name='training-warmup', daemon=True)
+        self._warmup_thread.start()
+    
+    def _warm_up(self):
+        try:
+            self.load_training_data()
+        except Exception as e:
+            self.warmup_error = str(e)
+            print(f"Training data warmup error: {e}")
+        finally:
+            self._warmup_seconds = time.monotonic() - self._warmup_started
+            self.warmed_up.set()
+        if WARMUP_AFTER_FORK and self.warmup_error is None:
+            # The worker that seeded an empty store holds its documents in memory; the rest mapped the snapshot
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Training data compaction error: {e}")
+    
+    @property
+    def ready(self):
+        """True once the whole corpus is loaded and indexed"""
+        return self.warmed_up.is_set() and self.warmup_error is None
+    
+    def wait_until_warm(self, timeout=None):
+        """Block until warmup has finished (or failed); False if timeout ran out first"""
+        return self.warmed_up.wait(timeout)
+    
+    def warmup_stats(self):
+        finished = self.warmed_up.is_set()
+        elapsed = self._warmup_seconds if finished else time.monotonic() - self._warmup_started
+        return {
+            'status': ('failed' if self.warmup_error else 'ready') if finished else 'warming',
+            'documents': self.training_data.live_count,
+            'filesFound': self.warmup_files,
+            'filesRead': self.warmup_files_read,
+            'elapsedSeconds': round(elapsed, 3),
+            'error': self.warmup_error
+        }
     
     def load_training_data(self):
-        """Load training data from scripts directory"""
-        # Try multiple possible paths for scripts, prioritizing training folder
-        possible_paths = [
-            os.path.join(os.path.dirname(__file__), '..', 'training'),
-            os.path.join(os.path.dirname(__file__), '..', 'scripts'),
-            os.path.join(os.path.dirname(__file__), 'scripts')
-        ]
+        """Load training data from the persistent store, or the scripts directory on first start
         
-        for scripts_dir in possible_paths:
-            if os.path.exists(scripts_dir):
-                print(f"Loading training data from: {scripts_dir}")
-                # Recursively search for .txt files in all subdirectories
-                for root, dirs, files in os.walk(scripts_dir):
-                    for filename in files:
-                        if filename.endswith('.txt'):
-                            filepath = os.path.join(root, filename)
-                            try:
-                                with open(filepath, 'r', encoding='utf-8') as f:
-                                    content = f.read()
-                                    # Get relative path for better identification
-                                    rel_path = os.path.relpath(filepath, scripts_dir)
-                                    self.training_data.append({
-                                        'filename': rel_path,
-                                        'content': content
-                                    })
-                                    print(f"Loaded training data: {rel_path}")
-                            except Exception as e:
-                                print(f"Error loading {filename}: {e}")
-                break
-        
-        print(f"Total training data loaded: {len(self.training_data)}")
-    
-    def parse_script_content(self, content):
-        """Parse script content to extract training elements"""
-        parsed = {
-            'scenes': [],
-            'characters': [],
-            'dialogue': [],
-            'descriptions': []
+        Files are committed batch by batch as their records are built, so
+        retrieval serves the documents loaded so far while the rest load.
+        """
+        if self.store is None:
+            self._seed_training_files(self.commit_training_records)
+            self._fit_semantic(wait=True)
+            print(f"Total training data loaded: {len(self.training_data)}")
+            return
+        
+        # Hold the store lock so only one worker seeds an empty store
+        with self.store.locked():
+            state = self.store.load()
+            if not state.empty:
+                self._restore(state)
+                self._fit_semantic(wait=True)
+                print(f"Training data restored from store: {len(self.training_data)} "
+                      f"({len(state.records)} replayed from the log)")
+                # A long replay (say, after a snapshot layout change) is folded into a snapshot too
+                if len(state.records) < self.store.snapshot_every:
+                    return
+            else:
+                self._seed_training_files(self._store_records)
+                self._fit_semantic(wait=True)
+                print(f"Total training data loaded: {len(self.training_data)}")
+            seq = self.store.rotate()
+            view = self._snapshot_view()
+        # Snapshot right away so the next start neither walks the files nor replays the log
+        self.store.write_snapshot(seq, *view)
+    
+    def _seed_training_files(self, commit):
+        """Build records for the training files in a process pool and pass each batch to commit"""
+        loader = BulkIngester()
+        try:
+            for summary in loader.run(self._read_training_files(), commit):
+                pass
+        finally:
+            loader.close()
+        if summary['failed']:
+            print(f"{summary['failed']} training files not loaded: {'; '.join(summary['errors'])}")
+    
+    def _read_training_files(self):
+        """Training items for every .txt file under the scripts directory, read a few at a time in parallel"""
+        scripts_dir = training_directory()
+        if scripts_dir is None:
+            return
+        print(f"Loading training data from: {scripts_dir}")
+        # Recursively search for .txt files in all subdirectories
+        paths = [os.path.join(root, filename)
+                 for root, dirs, files in os.walk(scripts_dir) for filename in files if filename.endswith('.txt')]
+        self.warmup_files = len(paths)
+        
+        def read(filepath):
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    # Stat before reading, so a write racing the read shows up as a change to the watcher
+                    stat = os.fstat(f.fileno())
+                    content = f.read()
+            except Exception as e:
+                print(f"Error loading {filepath}: {e}")
+                return None
+            # Get relative path for better identification
+            return {
+                'filename': os.path.relpath(filepath, scripts_dir),
+                'content': content,
+                'metadata': training_metadata(stat.st_mtime_ns, stat.st_size)
+            }
+        
+        with ThreadPoolExecutor(max_workers=WARMUP_READERS) as readers:
+            # Only WARMUP_READ_AHEAD files are held at once, however large the corpus
+            for start in range(0, len(paths), WARMUP_READ_AHEAD):
+                for item in readers.map(read, paths[start:start + WARMUP_READ_AHEAD]):
+                    self.warmup_files_read += 1
+                    if item is not None:
+                        yield item
+    
+    def add_training_item(self, item):
+        """Store a training item and add it to the retrieval index; returns (doc_id, duplicate)"""
+        doc_ids, duplicates = self.add_training_items([item])
+        return doc_ids[0], duplicates[0]
+    
+    def add_training_items(self, items):
+        """Store training items and index them as one new segment
+        
+        Items are dicts with `content` and optionally `filename`, `id`,
+        `metadata` and `timestamp`. Work is proportional to the new items.
+        Documents are stored before the index snapshot that references them
+        is published, so concurrent readers only ever see ids they can resolve.
+        """
+        return self.commit_training_records([self._training_record(item) for item in items])
+    
+    def commit_training_records(self, records, retired=()):
+        """Log (when the store is on) and apply records built by training_record
+        
+        Returns (doc_ids, duplicates) in record order: the doc id, or None
+        when the dedup policy rejected the record, and the near-duplicate it
+        matched, if any. Documents in retired (ones the records replace) are
+        deleted in the same commit, so readers see the old version or the
+        new one but never both or neither.
+        """
+        with stage('commit'):
+            if self.store is None:
+                with self._commit_lock:
+                    return self._admit(records, self._apply_records, retired)
+            
+            with self.store.locked():
+                doc_ids = self._store_records(records, retired)
+                snapshot = self._start_snapshot() if self.store.snapshot_due() else None
+        if snapshot is not None:
+            threading.Thread(target=self._write_snapshot, args=snapshot, daemon=True).start()
+        return doc_ids
+    
+    def _training_record(self, item):
+        """Record for an item, reusing the element parse if the request already made it"""
+        with stage('record'):
+            digest = item.get('digest') or content_digest(item['content'])
+            return training_record(dict(item, digest=digest), self.parse_cache.get_or_parse(item['content'], digest))
+    
+    def _store_records(self, records, retired=()):
+        """Append records to the store log and apply them; caller holds the store lock"""
+        # Apply what other workers logged first so document ids agree everywhere
+        self._catch_up()
+        return self._admit(records, self._log_and_apply, retired)
+    
+    def _log_and_apply(self, records):
+        self.store.append(records)
+        return self._apply_records(records)
+    
+    def _admit(self, records, apply, retired=()):
+        """Apply the dedup policy to records and pass the admitted ones to apply
+        
+        The caller serializes commits, so the doc ids the batch will get are
+        known up front and records can also match earlier ones of the batch.
+        A delete record for retired goes first, and records are not matched
+        against the documents they replace.
+        """
+        dedup = self.dedup
+        deletes = [{'delete': sorted(retired)}] if retired else []
+        if not dedup.enabled:
+            return apply(deletes + records), [None] * len(records)
+        base = len(self.training_data)
+        admitted = []
+        rejected = {}
+        batch = dedup.batch()
+        for position, record in enumerate(records):
+            signature = record.get('signature')
+            match = dedup.find(signature, retired) or batch.find(signature)
+            if match is not None and dedup.policy == 'reject':
+                rejected[position] = self._duplicate_info(match, admitted, base)
+                continue
+            if match is not None and dedup.policy == 'version' and record['item'].get('id') is None:
+                # A new version answers to the script id of the one it revises
+                record['item']['id'] = self._duplicate_info(match, admitted, base)['scriptId']
+            batch.add(base + len(admitted), signature)
+            admitted.append(record)
+        
+        admitted_ids = iter(apply(deletes + admitted) if admitted or deletes else [])
+        doc_ids = []
+        duplicates = []
+        for position in range(len(records)):
+            if position in rejected:
+                doc_ids.append(None)
+                duplicates.append(rejected[position])
+                continue
+            doc_id = next(admitted_ids)
+            match = dedup.match(doc_id)
+            doc_ids.append(doc_id)
+            duplicates.append(self._duplicate_info(match) if match else None)
+        return doc_ids, duplicates
+    
+    def _duplicate_info(self, match, pending=(), base=None):
+        """What /train reports about a near-duplicate match"""
+        doc_id, score = match[0], match[1]
+        if base is not None and doc_id >= base:
+            item = pending[doc_id - base]['item']
+            script_id, filename = item.get('id'), item.get('filename')
+        else:
+            document = self.training_data[doc_id]
+            script_id, filename = document.id, document.filename
+        info = {
+            'docId': doc_id,
+            'scriptId': script_id,
+            'filename': filename,
+            'similarity': round(score, 3),
+            'action': ACTIONS[self.dedup.policy]
         }
+        if len(match) > 2 and self.dedup.policy == 'version':
+            info['version'] = match[2]
+        return info
+    
+    def _apply_records(self, records):
+        """Apply training records (new, or logged by any process) to the documents and the index
         
-        # Extract scenes (lines starting with INT./EXT.)
-        scene_pattern = r'^(INT\.|EXT\.|INT\/EXT\.).*$'
-        scenes = re.findall(scene_pattern, content, re.MULTILINE)
-        parsed['scenes'] = scenes[:10]  # Limit to first 10 scenes
-        
-        # Extract character names (lines in ALL CAPS, usually dialogue)
-        character_pattern = r'^[A-Z\s]+$'
-        characters = re.findall(character_pattern, content, re.MULTILINE)
-        parsed['characters'] = [c.strip() for c in characters if len(c.strip()) > 2][:20]
-        
-        # Extract dialogue (lines after character names)
-        lines = content.split('\n')
-        dialogue = []
-        for i, line in enumerate(lines):
-            if re.match(character_pattern, line.strip()) and i + 1 < len(lines):
-                next_line = lines[i + 1].strip()
-                if next_line and not re.match(character_pattern, next_line):
-                    dialogue.append(f"{line.strip()}: {next_line}")
-        parsed['dialogue'] = dialogue[:15]
-        
-        # Extract scene descriptions (lines between scenes and dialogue)
-        descriptions = []
-        for line in lines:
-            line = line.strip()
-            if (line and 
-                not re.match(scene_pattern, line) and 
-                not re.match(character_pattern, line) and
-                not line.startswith('(') and
-                not line.startswith('FADE') and
-                len(line) > 20):
-                descriptions.append(line)
-        parsed['descriptions'] = descriptions[:10]
-        
-        return parsed
-    
-    def generate_script_scene_with_openai(self, prompt, context=None):
-        """Generate a script scene using OpenAI API for intelligence + training data for content"""
-        if not openai_available:
-            return self.generate_script_scene_fallback(prompt, context)
+        Returns the doc ids of added documents. Documents and deletions
+        reach the index in one snapshot swap.
+        """
+        with self._write_lock:
+            doc_ids = []
+            documents = []
+            chunks = []
+            retired = []
+            for record in records:
+                if 'delete' in record:
+                    # Cluster what was added before the delete, as the live commit did
+                    self.dedup.add(len(self.training_data))
+                    deleted = self.training_data.delete(record['delete'])
+                    self.dedup.remove(deleted)
+                    retired.extend(deleted)
+                    continue
+                item = record['item']
+                doc_id = self.training_data.append(
+                    item['content'], item.get('filename'), item.get('id'), item.get('metadata'),
+                    item.get('timestamp'), item.get('digest'), record['spans'],
+                    [(start, end) for start, end, _ in record['chunks']], record.get('signature'))
+                doc_ids.append(doc_id)
+                # Chunks partition the text, so their counts add up to the document's
+                doc_terms = Counter()
+                for chunk_id, (start, end, terms) in zip(self.training_data.chunk_range(doc_id), record['chunks']):
+                    doc_terms.update(terms)
+                    chunks.append((chunk_id, terms, item.get('filename'), end - start))
+                documents.append((doc_id, doc_terms, item.get('filename'), len(item['content'])))
+            self.dedup.add(len(self.training_data))
+            self.index.add_counted_documents(documents, retired)
+            self.chunk_index.add_counted_documents(chunks, self._chunk_ids(retired))
+            if self.semantic is not None and chunks:
+                self.semantic.add(chunks[0][0], [terms for _, terms, _, _ in chunks])
+        if self._semantic_stale() and not self._semantic_fitting.locked():
+            threading.Thread(target=self._fit_semantic, daemon=True).start()
+        return doc_ids
+    
+    def _chunk_ids(self, doc_ids):
+        return [chunk_id for doc_id in doc_ids for chunk_id in self.training_data.chunk_range(doc_id)]
+    
+    def _chunk_count(self):
+        return self.training_data.chunk_offsets[len(self.training_data)]
+    
+    def _semantic_stale(self):
+        """Whether semantic retrieval is on but missing or outgrown by the corpus"""
+        if not SEMANTIC_RETRIEVAL:
+            return False
+        semantic = self.semantic
+        if semantic is None:
+            tried = self._semantic_unfit_at
+            return tried is None or self._chunk_count() >= max(tried + 1, tried * SEMANTIC_REFIT_GROWTH)
+        return len(semantic) >= semantic.fitted_rows * SEMANTIC_REFIT_GROWTH
+    
+    def _fit_semantic(self, wait=False):
+        """Fit the semantic index on every chunk and switch retrieval over to it
         
+        Runs at startup and in the background once the corpus has outgrown
+        the current fit; chunks added while fitting are projected before the
+        switch, so ids always line up with the chunk index.
+        """
+        if not SEMANTIC_RETRIEVAL or not self._semantic_fitting.acquire(blocking=wait):
+            return
         try:
-            # Extract relevant content from training data based on prompt
-            relevant_content = self._extract_relevant_training_content(prompt)
-            
-            # Create intelligent prompt for GPT to orchestrate the content
-            system_prompt = f"""You are a professional screenwriter. Your job is to intelligently structure and combine content from training data to create compelling scenes.
+            if not self._semantic_stale():
+                return
+            with self._write_lock:
+                snapshot = self.chunk_index.snapshot()
+                count = self._chunk_count()
+            started = time.monotonic()
+            semantic = fit_semantic_index(snapshot, count)
+            if semantic is None:
+                # Not worth another pass over every posting until the corpus has grown as much as for a refit
+                self._semantic_unfit_at = count
+                return
+            while True:
+                with self._write_lock:
+                    total = self._chunk_count()
+                    if len(semantic) >= total:
+                        self.semantic = semantic
+                        break
+                documents = self.training_data
+                semantic.add(len(semantic), [term_counts(documents.chunk_text(chunk_id))
+                                             for chunk_id in range(len(semantic), total)])
+            print(f"Semantic index fitted over {count} chunks in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            print(f"Semantic index fit error: {e}")
+        finally:
+            self._semantic_fitting.release()
+    
+    def _restore(self, state):
+        """Replace documents and index with the mapped snapshot plus its log tail"""
+        index = InvertedIndex()
+        chunk_index = InvertedIndex()
+        documents = state.documents if state.documents is not None else DocumentStore()
+        if state.segments:
+            # Snapshot segments still hold deleted documents
+            deleted = sorted(documents.deleted)
+            index.add_segment(state.segments['documents'], deleted)
+            chunk_index.add_segment(state.segments['chunks'],
+                                    [chunk_id for doc_id in deleted for chunk_id in documents.chunk_range(doc_id)])
+        with self._write_lock:
+            self.training_data = documents
+            if state.dedup is not None:
+                self.dedup = state.dedup
+            else:
+                self.dedup.rebuild(self.training_data)
+            self.index = index
+            self.chunk_index = chunk_index
+            self.semantic = state.semantic if SEMANTIC_RETRIEVAL else None
+            self._semantic_unfit_at = None
+            # Pools saved with the snapshot; the log tail is pooled on the next fallback
+            self.fallback_pools = state.fallback or FallbackPools()
+        if state.records:
+            self._apply_records(state.records)
+    
+    def _catch_up(self):
+        """Apply records other workers appended; caller holds the store's thread lock"""
+        try:
+            records = self.store.read_new()
+        except LogGap as e:
+            print(f"Reloading training data: {e}")
+            self._restore(self.store.load())
+            return
+        if records:
+            self._apply_records(records)
+    
+    def refresh_training_data(self):
+        """Pick up documents other workers added (rate limited; cheap when nothing changed)
+        
+        Skipped during warmup, which holds the store lock until the corpus is loaded.
+        """
+        if self.store is not None and self.warmed_up.is_set():
+            self.store.refresh(self._catch_up)
+    
+    def sync_training_data(self):
+        """Wait for warmup, apply everything logged so far and return the documents"""
+        self.wait_until_warm()
+        if self.store is not None:
+            with self.store.locked():
+                self._catch_up()
+        return self.training_data
+    
+    def reload_training_files(self, items, retired):
+        """Commit training files that changed on disk in place of the retired doc ids (see training_watcher.py)"""
+        doc_ids, _ = self.commit_training_records([self._training_record(item) for item in items], retired)
+        return doc_ids
+    
+    def _snapshot_view(self):
+        """Documents, their count, snapshots of every index, the fallback pools and dedup clusters as of one instant"""
+        with self._write_lock:
+            # training_data only grows (deletes are tombstones), so its first doc_count entries stay fixed
+            doc_count = len(self.training_data)
+            chunk_count = self.training_data.chunk_offsets[doc_count]
+            indexes = {
+                'documents': (self.index.snapshot(), doc_count),
+                'chunks': (self.chunk_index.snapshot(), chunk_count)
+            }
+            semantic = None
+            if self.semantic is not None and len(self.semantic) >= chunk_count:
+                semantic = (self.semantic.snapshot(), chunk_count)
+            dedup = self.dedup.snapshot() if self.dedup.enabled else None
+            return self.training_data, doc_count, indexes, semantic, self.fallback_pools, dedup
+    
+    def _start_snapshot(self):
+        """Cut the log and capture what the next snapshot covers; caller holds the store lock"""
+        self.store.snapshotting = True
+        seq = self.store.rotate()
+        return (seq,) + self._snapshot_view()
+    
+    def _write_snapshot(self, seq, documents, doc_count, indexes, semantic, fallback, dedup):
+        try:
+            self.store.write_snapshot(seq, documents, doc_count, indexes, semantic, fallback, dedup)
+            print(f"Training store snapshot written at seq {seq} ({doc_count} documents)")
+        except Exception as e:
+            print(f"Training store snapshot error: {e}")
+        finally:
+            self.store.snapshotting = False
+    
+    def compact(self):
+        """Fold in-memory documents into a snapshot and serve everything from its mapped files
+        
+        Run by gunicorn workers once warm (see gunicorn.conf.py), so the one
+        that seeded the store shares the page-cache copy of the corpus and
+        index with the others instead of holding its own strings and postings.
+        """
+        if self.store is None:
+            return False
+        with self.store.locked():
+            self._catch_up()
+            if not self.training_data.unmapped:
+                return False
+            seq = self.store.rotate()
+            view = self._snapshot_view()
+        self.store.write_snapshot(seq, *view)
+        with self.store.locked():
+            self._restore(self.store.load())
+        print(f"Training data compacted into a shared snapshot: {len(self.training_data)} documents")
+        return True
+    
+    def get_training_item(self, script_id):
+        """Look up a training item by script id"""
+        doc_id = self.training_data.lookup(script_id)
+        if doc_id is None:
+            return None
+        return self.training_data[doc_id]
+    
+    def parse_script_content(self, content, digest=None):
+        """Parse script content to extract training elements"""
+        # Goes through the parse cache so storing the document can reuse this parse
+        with stage('parse'):
+            return summarize_elements(self.parse_cache.get_or_parse(content, digest))
+    
+    def generate_script_scene_with_openai(self, prompt, context=None, use_cache=True, deadline=None):
+        """Generate a script scene using OpenAI API for intelligence + training data for content"""
+        return self.generate(prompt, 'script', context, use_cache, deadline=deadline)
+    
+    def _scene_messages(self, prompt, chunks=None, context=None):
+        """Chat messages asking for a scene built from relevant training content"""
+        # Extract relevant content from training data based on prompt
+        relevant_content = self._extract_relevant_training_content(prompt, chunks)
+        
+        # Create intelligent prompt for GPT to orchestrate the content
+        system_prompt = f"""You are a professional screenwriter. Your job is to intelligently structure and combine content from training data to create compelling scenes.
 
 Available Training Content:
 {relevant_content}
@@ -146,35 +616,26 @@ Instructions:
 - Maintain screenplay format and structure
 - Keep the authentic voice from the training data"""
 
-            user_prompt = f"Create a compelling script scene about: {prompt}\n\nUse the training data above as your primary content source. Structure it intelligently into a complete scene."
-
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                max_tokens=1000,
-                temperature=0.3  # Lower temperature for more consistent use of training data
-            )
-            
-            return response.choices[0].message.content
-            
-        except Exception as e:
-            print(f"OpenAI API error: {e}")
-            return self.generate_script_scene_fallback(prompt, context)
+        user_prompt = f"Create a compelling script scene about: {prompt}\n\nUse the training data above as your primary content source. Structure it intelligently into a complete scene."
+        if context:
+            user_prompt = f"{context}\n\n{user_prompt}"
+        
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
     
-    def generate_movie_outline_with_openai(self, prompt, context=None):
+    def generate_movie_outline_with_openai(self, prompt, context=None, use_cache=True, deadline=None):
         """Generate a movie outline using OpenAI API for intelligence + training data for content"""
-        if not openai_available:
-            return self.generate_movie_outline_fallback(prompt, context)
+        return self.generate(prompt, 'outline', context, use_cache, deadline=deadline)
+    
+    def _outline_messages(self, prompt, chunks=None, context=None):
+        """Chat messages asking for an outline built from relevant training content"""
+        # Extract relevant content from training data based on prompt
+        relevant_content = self._extract_relevant_training_content(prompt, chunks)
         
-        try:
-            # Extract relevant content from training data based on prompt
-            relevant_content = self._extract_relevant_training_content(prompt)
-            
-            # Create intelligent prompt for GPT to orchestrate the content
-            system_prompt = f"""You are a professional screenwriter. Your job is to intelligently structure and combine content from training data to create compelling movie outlines.
+        # Create intelligent prompt for GPT to orchestrate the content
+        system_prompt = f"""You are a professional screenwriter. Your job is to intelligently structure and combine content from training data to create compelling movie outlines.
 
 Available Training Content:
 {relevant_content}
@@ -192,282 +653,639 @@ Instructions:
 - Structure into a compelling 3-act outline
 - Keep the authentic voice from the training data"""
 
-            user_prompt = f"Create a compelling 3-act movie outline about: {prompt}\n\nUse the training data above as your primary content source. Structure it intelligently into a complete outline."
-
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                max_tokens=800,
-                temperature=0.3  # Lower temperature for more consistent use of training data
-            )
-            
-            return response.choices[0].message.content
+        user_prompt = f"Create a compelling 3-act movie outline about: {prompt}\n\nUse the training data above as your primary content source. Structure it intelligently into a complete outline."
+        if context:
+            user_prompt = f"{context}\n\n{user_prompt}"
+        
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+    
+    def _generation_settings(self, output_type):
+        """Message builder, token limit and fallback generator for an output type"""
+        if output_type == 'outline':
+            return self._outline_messages, OUTLINE_MAX_TOKENS, self.generate_movie_outline_fallback
+        return self._scene_messages, SCENE_MAX_TOKENS, self.generate_script_scene_fallback
+    
+    def generate(self, prompt, output_type='script', context=None, use_cache=True, documents=None, deadline=None,
+                 chunks=None):
+        """Generate with the upstream model, falling back to training data templates
+        
+        The upstream call only gets what is left of the request's latency
+        budget; when the budget or the circuit breaker rules it out, the
+        training-data fallback answers straight away. context is the
+        conversation so far as rendered by ConversationContext.
+        """
+        output_type = 'outline' if output_type == 'outline' else 'script'
+        messages_for, max_tokens, fallback = self._generation_settings(output_type)
+        upstream_guard.record_request()
+        if not openai_available:
+            upstream_guard.record_fallback('unavailable')
+            return self._fallback(fallback, prompt, context, documents)
+        if deadline is None:
+            deadline = Deadline(GENERATION_DEADLINE_MS)
+        # Answers grounded in a partly loaded corpus aren't kept
+        use_cache = use_cache and self.warmed_up.is_set()
+        
+        try:
+            # Identical requests share one cached or in-flight upstream call
+            cache_key = self._response_cache_key(prompt, output_type, max_tokens, context)
+            return self.response_cache.get_or_compute(
+                cache_key,
+                lambda: self._complete_upstream(self._prompt_messages(messages_for, prompt, chunks, context),
+                                                max_tokens, deadline),
+                bypass=not use_cache,
+                timeout=max(0.0, deadline.remaining() - upstream_guard.reserve))
             
+        except BreakerOpen:
+            upstream_guard.record_fallback('breaker_open')
+        except DeadlineExceeded:
+            upstream_guard.record_fallback('deadline')
         except Exception as e:
             print(f"OpenAI API error: {e}")
-            return self.generate_movie_outline_fallback(prompt, context)
+            upstream_guard.record_fallback('error')
+        return self._fallback(fallback, prompt, context, documents)
+    
+    def _prompt_messages(self, messages_for, prompt, chunks=None, context=None):
+        """Chat messages for a prompt; the 'prompt' stage includes the retrieval and packing it runs"""
+        with stage('prompt'):
+            return messages_for(prompt, chunks, context)
     
-    def generate_script_scene_fallback(self, prompt, context=None):
-        """Fallback script generation using training data as primary content source"""
-        # Extract relevant content from training data
-        relevant_content = self._extract_relevant_training_content(prompt)
+    def _fallback(self, fallback, prompt, context=None, documents=None):
+        with stage('fallback'):
+            return fallback(prompt, context, documents)
+    
+    def _response_cache_key(self, prompt, output_type, max_tokens, context):
+        """Response cache key; follow-ups only share answers within the same conversation state"""
+        sampling = {'max_tokens': max_tokens, 'temperature': GENERATION_TEMPERATURE}
+        if context:
+            sampling['context'] = content_digest(context)
+        return response_cache_key(prompt, output_type, GENERATION_MODEL, **sampling)
+    
+    def _complete_upstream(self, messages, max_tokens, deadline):
+        """One upstream completion within the request's latency budget"""
+        with stage('upstream'):
+            try:
+                return upstream_guard.call(
+                    lambda timeout, cancel: llm_client.complete(messages, OPENAI_MODEL, max_tokens,
+                                                                GENERATION_TEMPERATURE, timeout, cancel),
+                    deadline)
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(error=type(e).__name__)
+                raise
+    
+    def generate_batch(self, items, concurrency=BATCH_CONCURRENCY, use_cache=True, deadline_ms=GENERATION_DEADLINE_MS,
+                       client=None):
+        """Generate many prompts concurrently, yielding (index, result) as each finishes
+        
+        Retrieval for the whole batch runs in one pass over the index up front.
+        Each item is admitted separately in the batch lane, on behalf of client.
+        A failing item yields an 'error' result without affecting the others.
+        """
+        valid = []
+        for i, item in enumerate(items):
+            if isinstance(item, dict) and isinstance(item.get('prompt'), str) and item['prompt'].strip():
+                valid.append((i, item))
+            else:
+                yield i, {'error': 'Prompt is required'}
+        if not valid:
+            return
         
-        # Parse the training content to extract usable elements
-        parsed_content = self._parse_training_content_for_fallback(relevant_content)
+        prompts = [item['prompt'] for _, item in valid]
+        documents = self._retrieve_training_documents_many(prompts)
+        chunks = self._retrieve_training_chunks_many(prompts) if openai_available else [None] * len(valid)
+        
+        def run(item, item_documents, item_chunks):
+            output_type = item.get('outputType', 'script')
+            # Each item's budget starts when it is picked up, not when the batch arrived
+            deadline = Deadline(deadline_ms)
+            try:
+                with stage('queue'):
+                    ticket = admission.admit(client, BATCH, deadline)
+            except Overloaded as e:
+                return {'error': 'Service overloaded', 'retryAfter': e.retry_after}
+            with ticket:
+                content = self.generate(item['prompt'], output_type, None, use_cache, item_documents,
+                                        deadline, item_chunks)
+            return {
+                'content': content,
+                'outputType': output_type,
+                'timestamp': datetime.now().isoformat(),
+                'prompt': item['prompt']
+            }
+        
+        workers = max(1, min(concurrency, len(valid)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(run, item, item_documents, item_chunks): i
+                for (i, item), item_documents, item_chunks in zip(valid, documents, chunks)
+            }
+            try:
+                for future in as_completed(futures):
+                    try:
+                        yield futures[future], future.result()
+                    except Exception as e:
+                        print(f"Batch item error: {e}")
+                        yield futures[future], {'error': 'Generation failed'}
+            finally:
+                # Client went away: don't start items nobody will read
+                for future in futures:
+                    future.cancel()
+    
+    def stream_generation(self, prompt, output_type='script', context=None, use_cache=True, deadline=None):
+        """Yield generated text in pieces as the model produces it
+        
+        Cached responses and the training-data fallback are emitted through
+        the same interface so callers don't need to care which path served them.
+        """
+        output_type = 'outline' if output_type == 'outline' else 'script'
+        messages_for, max_tokens, fallback = self._generation_settings(output_type)
+        upstream_guard.record_request()
+        fallback_reason = 'unavailable'
+        
+        if openai_available:
+            if deadline is None:
+                deadline = Deadline(GENERATION_DEADLINE_MS)
+            use_cache = use_cache and self.warmed_up.is_set()
+            cache_key = self._response_cache_key(prompt, output_type, max_tokens, context)
+            if use_cache and self.response_cache.enabled:
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    yield cached
+                    return
+            
+            pieces = []
+            started = time.monotonic()
+            admitted = recorded = False
+            try:
+                messages = self._prompt_messages(messages_for, prompt, context=context)
+                available = upstream_guard.budget(deadline)
+                admitted = True
+                for piece in llm_client.stream_complete(messages, OPENAI_MODEL, max_tokens,
+                                                        GENERATION_TEMPERATURE, available):
+                    pieces.append(piece)
+                    yield piece
+                upstream_guard.record_outcome(started)
+                recorded = True
+                STAGE_SECONDS.observe(time.monotonic() - started, stage='upstream_stream')
+            except BreakerOpen:
+                UPSTREAM_ERRORS.inc(error='BreakerOpen')
+                fallback_reason = 'breaker_open'
+            except DeadlineExceeded:
+                UPSTREAM_ERRORS.inc(error='DeadlineExceeded')
+                fallback_reason = 'deadline'
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(error=type(e).__name__)
+                print(f"OpenAI API error: {e}")
+                upstream_guard.record_outcome(started, e)
+                recorded = True
+                fallback_reason = 'error'
+                if pieces:
+                    # The client already has part of the answer; don't splice a template onto it
+                    return
+            finally:
+                # A client that disconnects closes the generator (GeneratorExit) mid-stream;
+                # the breaker still has to get its half-open probe slot back
+                if admitted and not recorded:
+                    upstream_guard.release()
+            
+            if pieces:
+                if use_cache and self.response_cache.enabled:
+                    self.response_cache.put(cache_key, ''.join(pieces))
+                return
+        
+        # Emit the fallback a line at a time, like a model would
+        upstream_guard.record_fallback(fallback_reason)
+        for line in self._fallback(fallback, prompt, context).splitlines(keepends=True):
+            yield line
+    
+    def generate_script_scene_fallback(self, prompt, context=None, documents=None):
+        """Fallback script generation using training data as primary content source
+        
+        Lines come from the best-matching script's element pools, widening to
+        its category and then the whole corpus; picks are seeded by the
+        prompt, so the same prompt always yields the same scene.
+        """
+        pools, doc_id = self._fallback_source(prompt, documents)
+        
+        heading = pools.pick(prompt, 'scene_heading', 'scenes', doc_id)
+        description = pools.pick(prompt, 'scene_description', 'actions', doc_id)
+        exchange = pools.pick(prompt, 'dialogue', 'dialogue', doc_id)
+        action = pools.pick(prompt, 'action_line', 'actions', doc_id, offset=1)
+        if exchange is None:
+            exchange = ('CHARACTER NAME', canned(prompt, 'dialogue'),
+                        'ANOTHER CHARACTER', canned(prompt, 'response'))
         
         # Create scene using training data
         scene_template = f"""FADE IN:
 
-{parsed_content.get('scene_heading', 'INT. LOCATION - DAY')}
+{heading[0] if heading else 'INT. LOCATION - DAY'}
 
-{parsed_content.get('scene_description', self._generate_scene_description(prompt))}
+{description[0] if description else canned(prompt, 'scene_description')}
 
-{parsed_content.get('character_name', 'CHARACTER NAME')}
-{parsed_content.get('dialogue', self._generate_dialogue(prompt))}
+{exchange[0]}
+{exchange[1]}
 
-{parsed_content.get('response_character', 'ANOTHER CHARACTER')}
-{parsed_content.get('response_dialogue', self._generate_response(prompt))}
+{exchange[2]}
+{exchange[3]}
 
-{parsed_content.get('action_line', self._generate_action_line(prompt))}
+{action[0] if action and action != description else canned(prompt, 'action_line')}
 
 FADE OUT."""
         
         return scene_template
     
-    def generate_movie_outline_fallback(self, prompt, context=None):
+    def generate_movie_outline_fallback(self, prompt, context=None, documents=None):
         """Fallback outline generation using training data as primary content source"""
-        # Extract relevant content from training data
-        relevant_content = self._extract_relevant_training_content(prompt)
+        pools, doc_id = self._fallback_source(prompt, documents)
         
-        # Parse the training content to extract usable elements
-        parsed_content = self._parse_training_content_for_fallback(relevant_content)
+        opening = pools.pick(prompt, 'opening_scene', 'actions', doc_id)
+        # Consecutive beats from one seeded starting point, so the acts don't repeat each other
+        beats = [pools.pick(prompt, 'beat', 'beats', doc_id, offset=i) for i in range(7)]
+        beats = [beat[0] if beat else canned(prompt, 'plot_point', i) for i, beat in enumerate(beats)]
         
         # Create outline using training data
         outline_template = f"""MOVIE OUTLINE: {prompt[:50]}...
 
 ACT I - SETUP
-- Opening scene: {parsed_content.get('opening_scene', self._generate_scene_description(prompt))}
-- Introduce main character: {parsed_content.get('character_intro', self._generate_character_description(prompt))}
-- Inciting incident: {parsed_content.get('inciting_incident', self._generate_plot_point(prompt))}
+- Opening scene: {opening[0] if opening else canned(prompt, 'scene_description')}
+- Introduce main character: {canned(prompt, 'character')}
+- Inciting incident: {beats[0]}
 
 ACT II - CONFRONTATION
-- Rising action: {parsed_content.get('rising_action', self._generate_plot_point(prompt))}
-- Midpoint: {parsed_content.get('midpoint', self._generate_plot_point(prompt))}
-- Complications: {parsed_content.get('complications', self._generate_plot_point(prompt))}
+- Rising action: {beats[1]}
+- Midpoint: {beats[2]}
+- Complications: {beats[3]}
 
 ACT III - RESOLUTION
-- Climax: {parsed_content.get('climax', self._generate_plot_point(prompt))}
-- Falling action: {parsed_content.get('falling_action', self._generate_plot_point(prompt))}
-- Resolution: {parsed_content.get('resolution', self._generate_plot_point(prompt))}
+- Climax: {beats[4]}
+- Falling action: {beats[5]}
+- Resolution: {beats[6]}
 
-THEMES: {parsed_content.get('themes', self._generate_themes(prompt))}
-GENRE: {parsed_content.get('genre', self._generate_genre(prompt))}"""
+THEMES: {canned(prompt, 'themes')}
+GENRE: {canned(prompt, 'genre')}"""
         
         return outline_template
     
-    def _generate_scene_description(self, prompt):
-        """Generate a scene description"""
-        descriptions = [
-            "A dimly lit room with shadows dancing on the walls",
-            "A bustling city street filled with the sounds of life",
-            "A quiet forest clearing where sunlight filters through leaves",
-            "A modern office building with floor-to-ceiling windows",
-            "A cozy coffee shop with the aroma of fresh brew"
-        ]
-        return descriptions[hash(prompt) % len(descriptions)]
-    
-    def _generate_dialogue(self, prompt):
-        """Generate dialogue"""
-        dialogue_options = [
-            "I never thought it would come to this.",
-            "Sometimes the hardest choices are the right ones.",
-            "We all have our secrets, don't we?",
-            "The past has a way of catching up with us.",
-            "What if everything we know is wrong?"
-        ]
-        return dialogue_options[hash(prompt) % len(dialogue_options)]
-    
-    def _generate_response(self, prompt):
-        """Generate a response line"""
-        responses = [
-            "You don't understand what's at stake.",
-            "I wish it were that simple.",
-            "Maybe we're asking the wrong questions.",
-            "The truth is more complicated than that.",
-            "Some things are better left unsaid."
-        ]
-        return responses[hash(prompt) % len(responses)]
-    
-    def _generate_action_line(self, prompt):
-        """Generate an action line"""
-        actions = [
-            "Character looks out the window, lost in thought.",
-            "A moment of silence hangs heavy in the air.",
-            "Character paces back and forth, clearly agitated.",
-            "The tension in the room is palpable.",
-            "Character takes a deep breath, steeling themselves."
-        ]
-        return actions[hash(prompt) % len(actions)]
-    
-    def _generate_character_description(self, prompt):
-        """Generate character description"""
-        descriptions = [
-            "A determined individual with a mysterious past",
-            "Someone who has seen too much and learned too little",
-            "A person caught between duty and desire",
-            "An outsider looking for their place in the world",
-            "A character with secrets that could change everything"
-        ]
-        return descriptions[hash(prompt) % len(descriptions)]
-    
-    def _generate_plot_point(self, prompt):
-        """Generate a plot point"""
-        plot_points = [
-            "A discovery that changes everything",
-            "A betrayal that shatters trust",
-            "A choice that defines character",
-            "A revelation that explains the past",
-            "A decision that shapes the future"
-        ]
-        return plot_points[hash(prompt) % len(plot_points)]
-    
-    def _generate_themes(self, prompt):
-        """Generate themes"""
-        themes = [
-            "Redemption and forgiveness",
-            "Truth versus lies",
-            "The price of ambition",
-            "Love and sacrifice",
-            "Identity and self-discovery"
-        ]
-        return themes[hash(prompt) % len(themes)]
+    def _fallback_source(self, prompt, documents):
+        """Up-to-date element pools and the doc id of the best match (None without one)"""
+        # Find relevant training documents
+        if documents is None:
+            documents = self._retrieve_training_documents(prompt, k=1)
+        self.fallback_pools.refresh(self.training_data)
+        return self.fallback_pools, documents[0][1].doc_id if documents else None
+
+    def _retrieve_training_documents(self, prompt, k=3):
+        """Rank training data with BM25 and return the top (score, item) pairs, one per duplicate cluster"""
+        with stage('retrieval'):
+            results = self.dedup.collapse(self.index.search(prompt, k=self.dedup.search_k(k)), k=k)
+            return [(score, self.training_data[doc_id]) for score, doc_id in results]
     
-    def _generate_genre(self, prompt):
-        """Generate genre"""
-        genres = [
-            "Drama", "Thriller", "Romance", "Mystery", "Action"
-        ]
-        return genres[hash(prompt) % len(genres)]
-
-    def _extract_relevant_training_content(self, prompt):
-        """Extract the most relevant training content based on the prompt"""
-        # Analyze prompt for keywords
-        prompt_lower = prompt.lower()
-        keywords = prompt_lower.split()
-        
-        # Score training data based on relevance
-        scored_content = []
-        for script in self.training_data:
-            score = 0
-            content_lower = script['content'].lower()
-            
-            # Score based on keyword matches
-            for keyword in keywords:
-                if keyword in content_lower:
-                    score += 1
-            
-            # Score based on content length (more content = more options)
-            score += len(script['content']) / 1000
-            
-            # Score based on filename relevance
-            if any(keyword in script['filename'].lower() for keyword in keywords):
-                score += 5
-            
-            scored_content.append((score, script))
-        
-        # Sort by relevance score and take top 3
-        scored_content.sort(key=lambda x: x[0], reverse=True)
-        top_content = scored_content[:3]
-        
-        # Format the content for GPT
-        formatted_content = ""
-        for score, script in top_content:
-            formatted_content += f"\n--- Training Script: {script['filename']} (Relevance: {score:.1f}) ---\n"
-            # Include more content since this is now the primary source
-            formatted_content += script['content'][:1000] + "...\n"
-        
-        return formatted_content
-
-    def _parse_training_content_for_fallback(self, training_content):
-        """Parse training content to extract usable elements for fallback generation"""
-        parsed = {}
-        
-        # Extract scene headings (INT./EXT.)
-        scene_pattern = r'^(INT\.|EXT\.|INT\/EXT\.).*$'
-        scenes = re.findall(scene_pattern, training_content, re.MULTILINE)
-        if scenes:
-            parsed['scene_heading'] = scenes[0]
-        
-        # Extract character names and dialogue
-        character_pattern = r'^[A-Z\s]+$'
-        lines = training_content.split('\n')
-        dialogue_pairs = []
-        
-        for i, line in enumerate(lines):
-            if re.match(character_pattern, line.strip()) and i + 1 < len(lines):
-                next_line = lines[i + 1].strip()
-                if next_line and not re.match(character_pattern, next_line):
-                    dialogue_pairs.append((line.strip(), next_line))
-        
-        if dialogue_pairs:
-            parsed['character_name'] = dialogue_pairs[0][0]
-            parsed['dialogue'] = dialogue_pairs[0][1]
-            if len(dialogue_pairs) > 1:
-                parsed['response_character'] = dialogue_pairs[1][0]
-                parsed['response_dialogue'] = dialogue_pairs[1][1]
-        
-        # Extract scene descriptions
-        descriptions = []
-        for line in lines:
-            line = line.strip()
-            if (line and 
-                not re.match(scene_pattern, line) and 
-                not re.match(character_pattern, line) and
-                not line.startswith('(') and
-                not line.startswith('FADE') and
-                len(line) > 20):
-                descriptions.append(line)
-        
-        if descriptions:
-            parsed['scene_description'] = descriptions[0]
-            parsed['opening_scene'] = descriptions[0]
-        
-        # Extract plot points and themes
-        plot_points = [
-            "A discovery that changes everything",
-            "A betrayal that shatters trust", 
-            "A choice that defines character",
-            "A revelation that explains the past",
-            "A decision that shapes the future"
-        ]
-        
-        # Use training data if available, otherwise fallback
-        if descriptions:
-            parsed['inciting_incident'] = descriptions[1] if len(descriptions) > 1 else plot_points[0]
-            parsed['rising_action'] = descriptions[2] if len(descriptions) > 2 else plot_points[1]
-            parsed['midpoint'] = descriptions[3] if len(descriptions) > 3 else plot_points[2]
-            parsed['complications'] = descriptions[4] if len(descriptions) > 4 else plot_points[3]
-            parsed['climax'] = descriptions[5] if len(descriptions) > 5 else plot_points[4]
-            parsed['falling_action'] = descriptions[6] if len(descriptions) > 6 else plot_points[0]
-            parsed['resolution'] = descriptions[7] if len(descriptions) > 7 else plot_points[1]
+    def _retrieve_training_documents_many(self, prompts, k=3):
+        """Retrieval for a batch of prompts in one pass over the index"""
+        with stage('retrieval'):
+            return [
+                [(score, self.training_data[doc_id]) for score, doc_id in self.dedup.collapse(results, k=k)]
+                for results in self.index.search_many(prompts, k=self.dedup.search_k(k))
+            ]
+    
+    def _retrieve_training_chunks(self, prompt, k=CONTEXT_CANDIDATES):
+        """Rank training chunks with BM25 (blended with semantic similarity if enabled) as ContextChunks"""
+        return self._retrieve_training_chunks_many([prompt], k)[0]
+    
+    def _retrieve_training_chunks_many(self, prompts, k=CONTEXT_CANDIDATES):
+        """Chunk retrieval for a batch of prompts in one pass over the chunk index"""
+        with stage('retrieval'):
+            fetch = self.dedup.search_k(k)
+            snapshot = self.chunk_index.snapshot()
+            results = snapshot.search_many(prompts, k=fetch)
+            semantic = self.semantic
+            if semantic is not None:
+                results = semantic.blend_many(prompts, results, fetch, exclude=snapshot.deleted)
+            documents = self.training_data
+            return [
+                self._context_chunks(
+                    self.dedup.collapse(ranked, lambda result: documents.chunk_document(result[1]), k))
+                for ranked in results
+            ]
+    
+    def _context_chunks(self, results):
+        chunks = []
+        documents = self.training_data
+        for score, chunk_id in results:
+            doc_id = documents.chunk_document(chunk_id)
+            chunks.append(ContextChunk(score, doc_id, documents.chunk_span(chunk_id)[0],
+                                       documents[doc_id].name, documents.chunk_text(chunk_id, doc_id)))
+        return chunks
+    
+    def _extract_relevant_training_content(self, prompt, chunks=None):
+        """Extract the most relevant training content based on the prompt
         
-        return parsed
+        Chunks are scored individually and packed into CONTEXT_TOKEN_BUDGET,
+        so the prompt carries the passages that matched rather than the
+        opening of each matching script.
+        """
+        candidates = chunks if chunks is not None else self._retrieve_training_chunks(prompt)
+        with stage('packing'):
+            return format_chunks(pack_chunks(candidates, CONTEXT_TOKEN_BUDGET))
 
 # Initialize the script generator
-script_generator = ScriptGenerator()
+script_generator = ScriptGenerator(warm_up=not WARMUP_AFTER_FORK)
+
+@registry.collector
+def service_metrics():
+    """Figures the service's components already count, read when /metrics is scraped"""
+    guard = upstream_guard.stats()
+    yield ('script_generation_requests_total', 'counter', 'Generation requests', {}, guard['requests'])
+    for reason, count in guard['fallbacks'].items():
+        yield ('script_fallbacks_total', 'counter', 'Generations answered by the training-data fallback',
+               {'reason': reason}, count)
+    yield ('script_breaker_open', 'gauge', '1 while the upstream circuit breaker is open', {},
+           int(guard['breaker']['state'] == 'open'))
+    yield ('script_hedges_total', 'counter', 'Hedged upstream requests sent', {}, guard['hedgesSent'])
+    
+    caches = (('response', script_generator.response_cache.stats()), ('parse', script_generator.parse_cache.stats()))
+    for cache, stats in caches:
+        for field in ('hits', 'misses', 'evictions'):
+            yield (f"script_cache_{field}_total", 'counter', f"Cache {field}", {'cache': cache}, stats[field])
+        yield ('script_cache_bytes', 'gauge', 'Estimated cache memory', {'cache': cache}, stats['bytes'])
+    
+    upstream = llm_client.stats()
+    yield ('script_upstream_in_flight', 'gauge', 'Upstream model calls in progress', {}, upstream['inFlight'])
+    for kind, tokens in upstream['usage'].items():
+        yield ('script_upstream_tokens_total', 'counter', 'Tokens used by upstream completions',
+               {'type': kind}, tokens)
+    for kind, tokens in upstream['lastUsage'].items():
+        yield ('script_upstream_last_tokens', 'gauge', 'Token usage of the latest upstream completion',
+               {'type': kind}, tokens)
+    
+    yield ('script_training_documents', 'gauge', 'Training documents served', {},
+           script_generator.training_data.live_count)
+    yield ('script_training_chunks', 'gauge', 'Retrieval chunks indexed', {}, len(script_generator.chunk_index))
+    yield ('script_training_duplicates', 'gauge', 'Stored near-duplicate documents', {},
+           script_generator.dedup.duplicates)
+    yield ('script_ready', 'gauge', '1 once the training corpus is fully loaded', {}, int(script_generator.ready))
+    yield ('script_bulk_documents_total', 'counter', 'Documents committed by bulk ingestion', {},
+           script_generator.bulk_ingester.documents)
+    watch = script_generator.watcher.stats()
+    yield ('script_training_watch_files', 'gauge', 'Training files watched for changes', {}, watch['files'])
+    for change, count in watch['changes'].items():
+        yield ('script_training_reloaded_files_total', 'counter', 'Training files reloaded after changing on disk',
+               {'change': change}, count)
+    
+    queue = admission.stats()
+    yield ('script_admission_active', 'gauge', 'Generations holding an admission slot', {}, queue['active'])
+    for lane, waiting in queue['queued'].items():
+        yield ('script_admission_queued', 'gauge', 'Generations waiting for admission', {'lane': lane}, waiting)
+    for lane, count in queue['admitted'].items():
+        yield ('script_admission_admitted_total', 'counter', 'Generations admitted', {'lane': lane}, count)
+    for key, count in queue['rejected'].items():
+        lane, reason = key.split(':')
+        yield ('script_admission_rejected_total', 'counter', 'Generations turned away with a 429',
+               {'lane': lane, 'reason': reason}, count)
+
+@app.before_request
+def start_request_metrics():
+    """Start the request clock, and collect stage times when a Server-Timing header is wanted"""
+    registry.start_flushing()
+    g.request_started = time.perf_counter()
+    start_request_timing(SERVER_TIMING or request.headers.get('X-Server-Timing') == '1')
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    HTTP_SECONDS.observe(elapsed, endpoint=endpoint)
+    timing = finish_request_timing(elapsed)
+    # A streamed body is still being produced, so its stages can't be reported up front
+    if timing is not None and not response.is_streamed:
+        response.headers['Server-Timing'] = timing
+    return response
+
+@app.before_request
+def refresh_training_data():
+    """Make documents trained through other workers visible to this one"""
+    script_generator.refresh_training_data()
+
+def request_deadline_ms(data):
+    """Latency budget in milliseconds from the request body, or the configured default"""
+    value = data.get('deadlineMs', GENERATION_DEADLINE_MS)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError('deadlineMs must be a positive number')
+    return value
+
+def conversation_context(data):
+    """Rendered conversation context for a request, bounded however long the conversation is"""
+    history = data.get('conversationHistory')
+    if not isinstance(history, list) or not history:
+        return None
+    return script_generator.conversation_context.render(
+        history, data.get('prompt'), data.get('conversationId'), data.get('messageCount'))
+
+def cache_allowed(data):
+    """False when the client asked to skip the response cache"""
+    if data.get('cache') is False:
+        return False
+    return 'no-cache' not in request.headers.get('Cache-Control', '')
+
+def admission_client():
+    """Who a generation is queued for: its API key, else the client header, else the peer address"""
+    key = request.headers.get('X-API-Key') or request.headers.get('Authorization')
+    if key:
+        return f"key:{content_digest(key)[:16]}"
+    client = request.headers.get(ADMISSION_CLIENT_HEADER)
+    if client:
+        return f"client:{client[:128]}"
+    return f"addr:{request.remote_addr}"
+
+def admission_lane(data, default=INTERACTIVE):
+    """Priority lane from the body's priority field or the X-Priority header"""
+    lane = data.get('priority') or request.headers.get('X-Priority') or default
+    return lane if lane in LANES else default
+
+def overloaded_response(error):
+    """429 for a generation the admission queue turned away"""
+    response = jsonify({
+        'error': 'Service overloaded, retry later',
+        'reason': error.reason,
+        'retryAfter': error.retry_after
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
+    """Liveness check; /ready says whether the training corpus has finished loading"""
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'training_data_count': len(script_generator.training_data),
+        'training_data_count': script_generator.training_data.live_count,
+        'training_chunk_count': len(script_generator.chunk_index),
+        'semantic_index': script_generator.semantic.stats() if script_generator.semantic else None,
         'openai_available': openai_available,
-        'openai_status': 'configured' if openai_available else 'not_configured'
+        'openai_status': 'configured' if openai_available else 'not_configured',
+        'generation_backend': GENERATION_BACKEND,
+        'parse_cache': script_generator.parse_cache.stats(),
+        'response_cache': script_generator.response_cache.stats(),
+        'fallback_pools': script_generator.fallback_pools.stats(),
+        'dedup': script_generator.dedup.stats(),
+        'bulk_ingest': script_generator.bulk_ingester.stats(),
+        'training_watch': script_generator.watcher.stats(),
+        'warmup': script_generator.warmup_stats(),
+        'conversation_context': script_generator.conversation_context.stats(),
+        'upstream': llm_client.stats(),
+        'resilience': upstream_guard.stats(),
+        'admission': admission.stats(),
+        'training_store': script_generator.store.stats() if script_generator.store else None
+    })
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 503 with warmup progress until the training corpus is fully loaded"""
+    warmup = script_generator.warmup_stats()
+    response = jsonify(warmup)
+    if not script_generator.ready:
+        response.status_code = 503
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/debug/profiler', methods=['GET', 'POST'])
+def sampling_profiler():
+    """Start or stop the sampling profiler (POST) or read its collapsed stacks (GET)
+    
+    Only available with PROFILER_ENABLED; each worker profiles itself.
+    """
+    if not PROFILER_ENABLED:
+        return jsonify({'error': 'Not found'}), 404
+    
+    if request.method == 'GET':
+        if request.args.get('format') == 'collapsed':
+            return Response(profiler.collapsed(), mimetype='text/plain')
+        return jsonify(dict(profiler.status(), top=profiler.collapsed(20).splitlines()))
+    
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    if action == 'start':
+        try:
+            started = profiler.start(data.get('intervalMs'), data.get('seconds'))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'intervalMs and seconds must be numbers'}), 400
+        if not started:
+            return jsonify({'error': 'Profiler is already running'}), 409
+        return jsonify(profiler.status())
+    if action == 'stop':
+        return jsonify(profiler.stop())
+    return jsonify({'error': "action must be 'start' or 'stop'"}), 400
+
+def sse_event(event, payload):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def stream_response(prompt, output_type, context, use_cache, deadline_ms=GENERATION_DEADLINE_MS, lane=INTERACTIVE):
+    """SSE response relaying generated text, ending with the usual metadata
+    
+    The request is admitted before the stream opens, so a full queue is
+    still answered with a plain 429; the slot is held until the stream ends.
+    """
+    deadline = Deadline(deadline_ms)
+    try:
+        with stage('queue'):
+            ticket = admission.admit(admission_client(), lane, deadline)
+    except Overloaded as e:
+        return overloaded_response(e)
+    
+    def events():
+        # Open the stream straight away so the client sees bytes before retrieval runs
+        yield ": stream open\n\n"
+        pieces = []
+        try:
+            for piece in script_generator.stream_generation(prompt, output_type, context, use_cache, deadline):
+                pieces.append(piece)
+                yield sse_event('token', {'content': piece})
+        except Exception as e:
+            app.logger.error(f"Error streaming script: {str(e)}")
+            yield sse_event('error', {'error': 'Internal server error'})
+            return
+        yield sse_event('done', {
+            'content': ''.join(pieces),
+            'outputType': output_type,
+            'timestamp': datetime.now().isoformat(),
+            'prompt': prompt
+        })
+    
+    response = Response(stream_with_context(events()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Runs once the stream is finished or abandoned
+    response.call_on_close(ticket.release)
+    return response
+
+@app.route('/generate/stream', methods=['POST'])
+def generate_script_stream():
+    """Stream a script or outline as Server-Sent Events"""
+    data = request.get_json(silent=True)
+    
+    if not data or 'prompt' not in data:
+        return jsonify({'error': 'Prompt is required'}), 400
+    try:
+        deadline_ms = request_deadline_ms(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return stream_response(data['prompt'], data.get('outputType', 'script'),
+                           conversation_context(data), cache_allowed(data), deadline_ms, admission_lane(data))
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_script_batch():
+    """Generate many prompts concurrently, streaming NDJSON results as they finish"""
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else data
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'A non-empty list of items is required'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'At most {BATCH_MAX_ITEMS} items per batch'}), 400
+    
+    concurrency = BATCH_CONCURRENCY
+    use_cache = True
+    if isinstance(data, dict):
+        try:
+            concurrency = max(1, min(int(data.get('concurrency', BATCH_CONCURRENCY)), BATCH_CONCURRENCY))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'concurrency must be an integer'}), 400
+        use_cache = cache_allowed(data)
+        try:
+            deadline_ms = request_deadline_ms(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    else:
+        deadline_ms = GENERATION_DEADLINE_MS
+    
+    # Items queue one by one in the batch lane; a batch that would only meet a full queue is turned away whole
+    client = admission_client()
+    try:
+        admission.check(client, BATCH)
+    except Overloaded as e:
+        return overloaded_response(e)
+    
+    def lines():
+        errors = 0
+        for index, result in script_generator.generate_batch(items, concurrency, use_cache, deadline_ms, client):
+            if 'error' in result:
+                errors += 1
+            yield json.dumps(dict(result, index=index)) + "\n"
+        yield json.dumps({'done': True, 'count': len(items), 'errors': errors}) + "\n"
+    
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson', headers={
+        'X-Accel-Buffering': 'no'
     })
 
 @app.route('/generate', methods=['POST'])
@@ -479,23 +1297,41 @@ def generate_script():
         if not data or 'prompt' not in data:
             return jsonify({'error': 'Prompt is required'}), 400
         
+        try:
+            deadline_ms = request_deadline_ms(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if data.get('stream'):
+            return stream_response(data['prompt'], data.get('outputType', 'script'),
+                                   conversation_context(data), cache_allowed(data), deadline_ms, admission_lane(data))
+        
         prompt = data['prompt']
         output_type = data.get('outputType', 'script')
-        conversation_history = data.get('conversationHistory', [])
+        use_cache = cache_allowed(data)
+        # Time spent queued for admission comes out of the request's budget
+        deadline = Deadline(deadline_ms)
+        with stage('queue'):
+            ticket = admission.admit(admission_client(), admission_lane(data), deadline)
         
-        # Generate content based on output type
-        if output_type == 'outline':
-            content = script_generator.generate_movie_outline_with_openai(prompt, conversation_history)
-        else:
-            content = script_generator.generate_script_scene_with_openai(prompt, conversation_history)
+        with ticket:
+            context = conversation_context(data)
+            # Generate content based on output type
+            if output_type == 'outline':
+                content = script_generator.generate_movie_outline_with_openai(prompt, context, use_cache, deadline)
+            else:
+                content = script_generator.generate_script_scene_with_openai(prompt, context, use_cache, deadline)
         
-        return jsonify({
-            'content': content,
-            'outputType': output_type,
-            'timestamp': datetime.now().isoformat(),
-            'prompt': prompt
-        })
+        with stage('serialize'):
+            return jsonify({
+                'content': content,
+                'outputType': output_type,
+                'timestamp': datetime.now().isoformat(),
+                'prompt': prompt
+            })
         
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         app.logger.error(f"Error generating script: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -513,19 +1349,26 @@ def train_model():
         content = data['content']
         metadata = data.get('metadata', {})
         
-        # Parse the script content
-        parsed_data = script_generator.parse_script_content(content)
+        # Parse the script content (kept in the parse cache for the fallback path)
+        digest = content_digest(content)
+        parsed_data = script_generator.parse_script_content(content, digest)
         
-        # Add to training data
+        # Add to training data (parsed elements are kept as spans into the stored text)
         training_item = {
             'id': script_id,
             'content': content,
+            'digest': digest,
             'metadata': metadata,
-            'parsed': parsed_data,
             'timestamp': datetime.now().isoformat()
         }
         
-        script_generator.training_data.append(training_item)
+        doc_id, duplicate = script_generator.add_training_item(training_item)
+        if doc_id is None:
+            return jsonify({
+                'error': 'Script is a near-duplicate of one already trained',
+                'scriptId': script_id,
+                'duplicate': duplicate
+            }), 409
         
         # In a real implementation, you would:
         # 1. Fine-tune the model with the new data
@@ -536,31 +1379,127 @@ def train_model():
             'message': 'Training data processed successfully',
             'scriptId': script_id,
             'parsedData': parsed_data,
-            'trainingDataCount': len(script_generator.training_data)
+            'duplicate': duplicate,
+            'trainingDataCount': script_generator.training_data.live_count
         })
         
     except Exception as e:
         app.logger.error(f"Error training model: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+BULK_READERS = {
+    'application/x-ndjson': read_ndjson,
+    'application/jsonl': read_ndjson,
+    'application/x-tar': read_tar,
+    'application/gzip': read_tar,
+    'application/x-gzip': read_tar
+}
+
+@app.route('/train/bulk', methods=['POST'])
+def train_bulk():
+    """Ingest an NDJSON stream of scripts or a tar of .txt files, streaming NDJSON progress
+    
+    The upload is parsed as it arrives and committed in batches, so it can
+    be far larger than memory; the last line summarises the whole upload.
+    """
+    reader = BULK_READERS.get(request.mimetype)
+    if reader is None:
+        return jsonify({'error': f"Content-Type must be one of: {', '.join(BULK_READERS)}"}), 415
+    
+    def lines():
+        try:
+            for event in script_generator.bulk_ingester.run(reader(request.stream),
+                                                            script_generator.commit_training_records):
+                if event.get('done'):
+                    event['trainingDataCount'] = script_generator.training_data.live_count
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            app.logger.error(f"Error in bulk training: {str(e)}")
+            yield json.dumps({'error': 'Internal server error',
+                              'trainingDataCount': script_generator.training_data.live_count}) + "\n"
+    
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson', headers={
+        'X-Accel-Buffering': 'no'
+    })
+
+def encode_cursor(doc_id):
+    """Opaque pagination cursor for the next document to list"""
+    return base64.urlsafe_b64encode(str(doc_id).encode('ascii')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Doc id from a cursor made by encode_cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        doc_id = int(base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii'))
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if doc_id < 0:
+        raise ValueError('Invalid cursor')
+    return doc_id
+
+def script_listing_params(args):
+    """Validated (start, limit, fields, category) from /scripts query parameters"""
+    start = decode_cursor(args['cursor']) if args.get('cursor') else 0
+    
+    try:
+        limit = int(args.get('limit', SCRIPTS_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if not 1 <= limit <= SCRIPTS_MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {SCRIPTS_MAX_PAGE_SIZE}")
+    
+    fields = DEFAULT_SCRIPT_FIELDS
+    if args.get('fields'):
+        fields = tuple(dict.fromkeys(f.strip() for f in args['fields'].split(',') if f.strip()))
+        unknown = [f for f in fields if f not in SCRIPT_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    
+    return start, limit, fields, args.get('category') or None
+
+def script_summary(item, fields):
+    """Listing entry for a stored document with only the requested fields"""
+    summary = {}
+    for field in fields:
+        value = getattr(item, field)
+        if field == 'id' and value is None:
+            value = 'unknown'
+        elif field == 'filename' and not value:
+            value = 'unknown'
+        summary[field] = value
+    return summary
+
 @app.route('/scripts', methods=['GET'])
 def get_training_scripts():
-    """Get list of available training scripts"""
+    """Get a page of available training scripts
+    
+    Query parameters: limit, cursor (from nextCursor), fields (comma
+    separated) and category (training directory). Responses carry an
+    ETag, so polling clients get a 304 while nothing has changed.
+    """
     try:
-        scripts = []
-        for item in script_generator.training_data:
-            scripts.append({
-                'id': item.get('id', 'unknown'),
-                'filename': item.get('filename', 'unknown'),
-                'metadata': item.get('metadata', {}),
-                'parsed': item.get('parsed', {}),
-                'timestamp': item.get('timestamp')
-            })
+        try:
+            start, limit, fields, category = script_listing_params(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        return jsonify({
-            'scripts': scripts,
-            'count': len(scripts)
-        })
+        documents = script_generator.training_data
+        # The store version is the same in every worker holding the same documents, so it plus the query pins the body
+        query = json.dumps([start, limit, fields, category])
+        etag = f"{documents.version}-{content_digest(query)}"
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            doc_ids, next_start, total = documents.page(start, limit, category)
+            response = jsonify({
+                'scripts': [script_summary(documents[doc_id], fields) for doc_id in doc_ids],
+                'count': len(doc_ids),
+                'total': total,
+                'nextCursor': encode_cursor(next_start) if next_start is not None else None
+            })
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
         
     except Exception as e:
         app.logger.error(f"Error getting scripts: {str(e)}")
@@ -570,11 +1509,19 @@ def get_training_scripts():
 def get_training_script(script_id):
     """Get specific training script by ID"""
     try:
-        for item in script_generator.training_data:
-            if item.get('id') == script_id:
-                return jsonify({
-                    'script': item
+        item = script_generator.get_training_item(script_id)
+        if item is not None:
+            # Stored documents never change, so their content digest is a strong validator
+            etag = item.digest
+            if etag and request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = jsonify({
+                    'script': item.to_dict()
                 })
+            if etag:
+                response.set_etag(etag)
+            return response
         
         return jsonify({'error': 'Script not found'}), 404
         
@@ -583,4 +1530,6 @@ def get_training_script(script_id):
         return jsonify({'error': 'Internal server error'}), 500
 
 if __name__ == '__main__':
+    script_generator.start_warmup()
+    script_generator.watcher.start()
     app.run(host='0.0.0.0', port=PORT, debug=DEBUG)
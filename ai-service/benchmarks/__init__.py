@@ -0,0 +1 @@
+"""Benchmarks for the AI service; see the README for how to run them"""
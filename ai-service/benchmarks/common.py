@@ -0,0 +1,111 @@
+"""
+Timing and result files shared by the benchmarks
+
+Every run writes one JSON file holding the commit it ran against, the
+machine and the parameters next to the measurements, so two files can be
+compared with benchmarks.compare. Timings are in milliseconds.
+"""
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(SERVICE_DIR, 'benchmarks', 'results')
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git', *args], cwd=SERVICE_DIR, capture_output=True, text=True,
+                              timeout=30).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def environment():
+    """The commit and machine a run happened on"""
+    return {
+        'commit': _git('rev-parse', '--short', 'HEAD') or 'unknown',
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarize(samples, operations=None):
+    """Latency summary in ms for samples in seconds
+
+    operations is how many operations the samples cover in total, for
+    throughput; by default each sample is one operation.
+    """
+    ordered = sorted(samples)
+    total = sum(ordered)
+    count = operations if operations is not None else len(ordered)
+    return {
+        'samples': len(ordered),
+        'minMs': round(ordered[0] * 1000, 4) if ordered else 0.0,
+        'meanMs': round(total / len(ordered) * 1000, 4) if ordered else 0.0,
+        'p50Ms': round(percentile(ordered, 0.50) * 1000, 4),
+        'p90Ms': round(percentile(ordered, 0.90) * 1000, 4),
+        'p99Ms': round(percentile(ordered, 0.99) * 1000, 4),
+        'maxMs': round(ordered[-1] * 1000, 4) if ordered else 0.0,
+        'opsPerSecond': round(count / total, 2) if total else 0.0
+    }
+
+
+def measure(function, repeat=20, warmup=2, min_seconds=0.0):
+    """Call function repeatedly and summarize the call times
+
+    Runs at least repeat calls after warmup, and keeps going until
+    min_seconds have been spent so fast functions get enough samples.
+    """
+    for _ in range(warmup):
+        function()
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < repeat or time.perf_counter() - started < min_seconds:
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def write_results(name, parameters, results, path=None):
+    """Write a result file and return its path; the default name carries the commit"""
+    env = environment()
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        suffix = '-dirty' if env['dirty'] else ''
+        path = os.path.join(RESULTS_DIR, f"{name}-{env['commit']}{suffix}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'benchmark': name,
+            'createdAt': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'environment': env,
+            'parameters': parameters,
+            'results': results
+        }, f, indent=2)
+        f.write('\n')
+    return path
+
+
+def report(results):
+    """Print one line per measurement"""
+    width = max((len(name) for name in results), default=0)
+    for name, stats in results.items():
+        if 'p50Ms' not in stats:
+            continue
+        print(f"{name:<{width}}  p50 {stats['p50Ms']:>10.3f} ms  p99 {stats['p99Ms']:>10.3f} ms  "
+              f"{stats['opsPerSecond']:>10.1f} ops/s", file=sys.stderr)
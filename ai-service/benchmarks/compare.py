@@ -0,0 +1,72 @@
+"""
+Compare two benchmark result files
+
+    python -m benchmarks.compare benchmarks/results/micro-1a2b3c4.json benchmarks/results/micro-5d6e7f8.json
+
+Prints each measurement the files share with its relative change, marking
+changes beyond --threshold in the wrong direction as regressions. With
+--fail-on-regression the exit status is 1 when there are any, so the
+comparison can gate a CI job.
+"""
+
+import argparse
+import json
+import sys
+
+# Lower is better for latencies, higher for rates
+METRICS = (('p50Ms', -1), ('p99Ms', -1), ('meanMs', -1), ('opsPerSecond', 1), ('throughput', 1),
+           ('documentsPerSecond', 1), ('errors', -1))
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare(baseline, candidate, threshold=0.1):
+    """Rows of (measurement, metric, old, new, change, regressed) for what both runs measured"""
+    rows = []
+    for name, old_stats in baseline['results'].items():
+        new_stats = candidate['results'].get(name)
+        if not isinstance(old_stats, dict) or not isinstance(new_stats, dict):
+            continue
+        for metric, direction in METRICS:
+            old, new = old_stats.get(metric), new_stats.get(metric)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+                continue
+            change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+            rows.append((name, metric, old, new, change, change * direction < -threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args(argv)
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    if baseline.get('benchmark') != candidate.get('benchmark'):
+        print(f"Warning: comparing {baseline.get('benchmark')} with {candidate.get('benchmark')} results",
+              file=sys.stderr)
+    if baseline.get('parameters') != candidate.get('parameters'):
+        print("Warning: the runs used different parameters", file=sys.stderr)
+    if baseline['environment'].get('platform') != candidate['environment'].get('platform'):
+        print("Warning: the runs happened on different platforms", file=sys.stderr)
+
+    rows = compare(baseline, candidate, args.threshold)
+    print(f"{baseline['environment']['commit']} -> {candidate['environment']['commit']}")
+    width = max((len(name) + len(metric) + 1 for name, metric, *_ in rows), default=0)
+    for name, metric, old, new, change, regressed in rows:
+        print(f"{name + '.' + metric:<{width}}  {old:>12.3f}  {new:>12.3f}  {change:>+8.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    regressions = sum(1 for row in rows if row[-1])
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    if args.fail_on_regression and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Synthetic screenplay corpora for benchmarks
+
+Documents follow the layout of the files under training/: a title, FADE
+IN:, INT./EXT. scene headings, action paragraphs, uppercase character
+cues with optional parentheticals and dialogue, and transitions. Word
+choice is Zipf-distributed over a fixed vocabulary so BM25 postings and
+chunk sizes look like real text, and each document is generated from
+(seed, index) alone, so any slice of a corpus is reproducible without
+generating what comes before it.
+
+    python -m benchmarks.corpus --documents 10000 --out /tmp/corpus
+    python -m benchmarks.corpus --documents 1000000 --format ndjson --out corpus.ndjson
+"""
+
+import argparse
+import bisect
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import tarfile
+
+CATEGORIES = ('character_development', 'dialogue', 'emotional_beats', 'pacing', 'plot_twists',
+              'sample_scripts', 'tension_building', 'visual_storytelling')
+
+PLACES = ('KITCHEN', 'POLICE STATION', 'ROOFTOP', 'DINER', 'HOSPITAL CORRIDOR', 'CAR', 'WAREHOUSE', 'FOREST',
+          'APARTMENT', 'OFFICE', 'BAR', 'TRAIN PLATFORM', 'BEACH', 'MOTEL ROOM', 'COURTROOM', 'LIBRARY',
+          'PARKING GARAGE', 'CHURCH', 'FARMHOUSE', 'SUBWAY CAR', 'BACKSTAGE', 'LABORATORY', 'HARBOR', 'ALLEY')
+TIMES = ('DAY', 'NIGHT', 'DAWN', 'DUSK', 'LATER', 'CONTINUOUS', 'MOMENTS LATER')
+NAMES = ('SARAH', 'JACK', 'MARIA', 'DETECTIVE COLE', 'EVELYN', 'MARCUS', 'NINA', 'FRANK', 'DR. OKAFOR', 'LENA',
+         'TOMMY', 'GRACE', 'VICTOR', 'ELI', 'ROSA', 'SAM', 'CAPTAIN REYES', 'IRIS', 'NOAH', 'MRS. HALE')
+PARENTHETICALS = ('(quietly)', '(beat)', '(angry)', '(smiling)', '(under her breath)', '(to himself)',
+                  '(laughing)', '(pause)', '(whispering)', '(firmly)')
+TRANSITIONS = ('CUT TO:', 'SMASH CUT TO:', 'DISSOLVE TO:', 'MATCH CUT TO:')
+
+# Common words carry most of the mass; generated words make up the long tail
+COMMON_WORDS = """
+the a to and of in it you that is was he for on are with as his they be at one have this from
+or had by not but what all were when we there can an your which their said if do will each about
+how up out them then she many some so these would other into has more her two like him see time
+could no make than first been its who now people my made over did down only way find use may
+water long little very after words called just where most know get through back much before go
+good new write our used me man too any day same right look think also around another came come
+work three word must because does part even place well such here take why things help put years
+different away again off went old number great tell men say small every found still between name
+should home big give air line set own under read last never us left end along while might next
+sound below saw something thought both few those always looked show large often together asked
+house world going want school important until form food keep children feet land side without boy
+once animals life enough took sometimes four head above kind began almost live page got earth
+need far hand high year mother light parts country father let night following picture being study
+second eyes soon times story boys since white days ever paper hard near sentence better best across
+during today others however sure means knew its try told young miles sun ways thing whole hear example
+heard several change answer room sea against top turned learn point city play toward five using
+himself usually door gun blood money truth secret silence rain window phone letter knife photograph
+""".split()
+
+_SYLLABLES = ('ka', 'ro', 'mi', 'tes', 'lan', 'dor', 'vi', 'sha', 'quen', 'bel', 'mor', 'tri', 'zan',
+              'pel', 'gro', 'hal', 'nim', 'ost', 'rae', 'cul')
+VOCABULARY = COMMON_WORDS + [''.join(parts) for parts in itertools.product(_SYLLABLES, repeat=3)][:6000]
+# Cumulative Zipf weights (s = 1.1) for bisect sampling
+_CUMULATIVE = list(itertools.accumulate(1.0 / (rank ** 1.1) for rank in range(1, len(VOCABULARY) + 1)))
+
+
+def _words(rng, count):
+    total = _CUMULATIVE[-1]
+    return [VOCABULARY[bisect.bisect_left(_CUMULATIVE, rng.random() * total)] for _ in range(count)]
+
+
+def _sentence(rng, low=6, high=18):
+    words = _words(rng, rng.randint(low, high))
+    words[0] = words[0].capitalize()
+    return ' '.join(words) + (rng.choice('!?') if rng.random() < 0.1 else '.')
+
+
+def _scene(rng, cast):
+    lines = [f"{rng.choice(('INT.', 'EXT.'))} {rng.choice(PLACES)} - {rng.choice(TIMES)}", '']
+    lines.append(' '.join(_sentence(rng, 8, 24) for _ in range(rng.randint(1, 3))))
+    lines.append('')
+    speaker = None
+    for _ in range(rng.randint(2, 10)):
+        speaker = rng.choice([name for name in cast if name != speaker])
+        lines.append(speaker)
+        if rng.random() < 0.3:
+            lines.append(rng.choice(PARENTHETICALS))
+        lines.append(' '.join(_sentence(rng, 3, 16) for _ in range(rng.randint(1, 2))))
+        lines.append('')
+        if rng.random() < 0.25:
+            lines.append(_sentence(rng, 8, 20))
+            lines.append('')
+    if rng.random() < 0.4:
+        lines.append(rng.choice(TRANSITIONS))
+        lines.append('')
+    return lines
+
+
+def generate_document(index, seed=0, scale=1.0):
+    """(filename, content) of document index of the corpus for seed
+
+    scale multiplies the number of scenes, so scale=4 gives feature-length
+    scripts instead of the training files' scene-sized ones.
+    """
+    rng = random.Random(f"{seed}:{index}")
+    category = CATEGORIES[index % len(CATEGORIES)]
+    cast = rng.sample(NAMES, rng.randint(2, 5))
+    title = ' '.join(_words(rng, rng.randint(1, 4))).upper()
+    lines = [title, f"Written by {rng.choice(NAMES).title()}", '', 'FADE IN:', '']
+    for _ in range(max(1, round(rng.randint(2, 8) * scale))):
+        lines.extend(_scene(rng, cast))
+    lines.append('FADE OUT.')
+    return f"{category}/synthetic_{index:07d}.txt", '\n'.join(lines) + '\n'
+
+
+def generate_edit(index, seed=0, scale=1.0):
+    """A lightly edited copy of document index: one changed line and an added tag"""
+    filename, content = generate_document(index, seed, scale)
+    lines = content.split('\n')
+    rng = random.Random(f"{seed}:{index}:edit")
+    position = rng.randrange(len(lines))
+    lines[position] = lines[position].replace('the', 'that', 1)
+    return filename.replace('.txt', '_draft2.txt'), '\n'.join(lines) + 'THE END\n'
+
+
+def iter_corpus(count, seed=0, scale=1.0, duplicate_rate=0.0, start=0):
+    """(filename, content) for documents start..count-1; duplicate_rate of them are edits of earlier ones"""
+    for index in range(start, count):
+        rng = random.Random(f"{seed}:{index}:duplicate")
+        if index and rng.random() < duplicate_rate:
+            original = rng.randrange(index)
+            filename, content = generate_edit(original, seed, scale)
+            yield filename.replace(f"{original:07d}", f"{index:07d}"), content
+        else:
+            yield generate_document(index, seed, scale)
+
+
+def write_corpus(path, count, fmt='dir', seed=0, scale=1.0, duplicate_rate=0.0):
+    """Write a corpus as a directory tree like training/, an NDJSON file for /train/bulk, or a tar"""
+    documents = iter_corpus(count, seed, scale, duplicate_rate)
+    total = 0
+    if fmt == 'dir':
+        for filename, content in documents:
+            target = os.path.join(path, filename)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'w', encoding='utf-8') as f:
+                f.write(content)
+            total += len(content)
+    elif fmt == 'ndjson':
+        with open(path, 'w', encoding='utf-8') as f:
+            for filename, content in documents:
+                f.write(json.dumps({'filename': filename, 'content': content}) + '\n')
+                total += len(content)
+    elif fmt == 'tar':
+        with tarfile.open(path, 'w:gz') as archive:
+            for filename, content in documents:
+                data = content.encode('utf-8')
+                info = tarfile.TarInfo(filename)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+                total += len(content)
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--documents', type=int, default=1000)
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--format', choices=('dir', 'ndjson', 'tar'), default='dir')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', type=float, default=1.0, help='scenes per document multiplier')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0,
+                        help='share of documents that are light edits of earlier ones')
+    args = parser.parse_args(argv)
+    total = write_corpus(args.out, args.documents, args.format, args.seed, args.scale, args.duplicate_rate)
+    print(f"Wrote {args.documents} documents ({total / 1e6:.1f} MB of text) to {args.out}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""
+End-to-end load test of /generate, /train and /scripts against a stub upstream
+
+Starts the stub chat-completions server and the service (Flask's server,
+or gunicorn with --server gunicorn) in a scratch directory, seeds the
+synthetic corpus through /train/bulk, then runs concurrent clients over a
+weighted mix of requests for a fixed time:
+
+    python -m benchmarks.e2e --documents 2000 --clients 16 --seconds 30
+    python -m benchmarks.e2e --latency-ms 800 --error-rate 0.05 --mix generate=1
+
+Point --url at a service that is already running to skip starting one;
+its upstream is then whatever it was configured with.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+from benchmarks.common import SERVICE_DIR, summarize, write_results
+from benchmarks.corpus import CATEGORIES, iter_corpus
+from benchmarks.micro import prompts
+from benchmarks.stub_llm import StubLLM
+
+DEFAULT_MIX = 'generate=6,train=1,scripts=3'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_service(args, upstream, workdir):
+    """Launch the service on a free port; returns (process, base url)"""
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), OPENAI_API_KEY='stub', OPENAI_BASE_URL=upstream,
+               TRAINING_STORE='true' if args.store else 'false',
+               TRAINING_STORE_DIR=os.path.join(workdir, 'store'),
+               METRICS_DIR=os.path.join(workdir, 'metrics'), FLASK_ENV='production')
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app']
+        env.setdefault('GUNICORN_WORKERS', str(args.workers))
+    else:
+        command = [sys.executable, 'app.py']
+    log = open(os.path.join(workdir, 'service.log'), 'wb')
+    process = subprocess.Popen(command, cwd=SERVICE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Service exited with {process.returncode}; see {log.name}")
+        try:
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"Service did not become ready within {args.startup_timeout}s; see {log.name}")
+
+
+def seed(url, args):
+    """Upload the synthetic corpus through /train/bulk; returns the final summary line"""
+    def body():
+        for filename, content in iter_corpus(args.documents, args.seed, args.scale, args.duplicate_rate):
+            yield (json.dumps({'filename': filename, 'content': content}) + '\n').encode('utf-8')
+
+    summary = {}
+    start = time.perf_counter()
+    with httpx.stream('POST', f"{url}/train/bulk", content=body(), timeout=None,
+                      headers={'Content-Type': 'application/x-ndjson'}) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                summary = json.loads(line)
+    summary['wallSeconds'] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ('generate', 'train', 'scripts'):
+            raise argparse.ArgumentTypeError(f"unknown request type: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class LoadRun:
+    """Concurrent clients over a weighted request mix, recording latency per request type"""
+
+    def __init__(self, url, args):
+        self.url = url
+        self.args = args
+        self.mix = list(args.mix.items())
+        self.prompts = prompts(args.prompts, args.seed)
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.errors = Counter()
+        self._next_document = args.documents
+        self._lock = threading.Lock()
+
+    def _train_body(self):
+        with self._lock:
+            index = self._next_document
+            self._next_document += 1
+        filename, content = next(iter_corpus(index + 1, self.args.seed, self.args.scale, start=index))
+        return {'scriptId': f"bench-{index}", 'content': content, 'metadata': {'filename': filename}}
+
+    def _request(self, client, rng, kind):
+        if kind == 'generate':
+            body = {'prompt': rng.choice(self.prompts), 'outputType': 'outline' if rng.random() < 0.2 else 'script',
+                    'cache': not self.args.no_cache}
+            return client.post('/generate', json=body)
+        if kind == 'train':
+            return client.post('/train', json=self._train_body())
+        params = {'limit': 50}
+        if rng.random() < 0.5:
+            params['category'] = rng.choice(CATEGORIES)
+        return client.get('/scripts', params=params)
+
+    def _client(self, number, stop_at):
+        rng = random.Random(f"{self.args.seed}:client:{number}")
+        kinds = [kind for kind, _ in self.mix]
+        weights = [weight for _, weight in self.mix]
+        with httpx.Client(base_url=self.url, timeout=self.args.timeout) as client:
+            while time.monotonic() < stop_at:
+                kind = rng.choices(kinds, weights)[0]
+                start = time.perf_counter()
+                try:
+                    status = self._request(client, rng, kind).status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.latencies[kind].append(elapsed)
+                    self.statuses[kind][str(status)] += 1
+                    if not isinstance(status, int) or status >= 500:
+                        self.errors[kind] += 1
+
+    def run(self):
+        stop_at = time.monotonic() + self.args.seconds
+        threads = [threading.Thread(target=self._client, args=(i, stop_at)) for i in range(self.args.clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        results = {}
+        for kind, samples in self.latencies.items():
+            stats = summarize(samples)
+            stats['throughput'] = round(len(samples) / elapsed, 2)
+            stats['errors'] = self.errors[kind]
+            stats['statuses'] = dict(self.statuses[kind])
+            results[kind] = stats
+        total = sum(len(samples) for samples in self.latencies.values())
+        results['total'] = dict(summarize([s for samples in self.latencies.values() for s in samples]),
+                                throughput=round(total / elapsed, 2), errors=sum(self.errors.values()))
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', help='benchmark a running service instead of starting one')
+    parser.add_argument('--server', choices=('flask', 'gunicorn'), default='flask')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--store', action='store_true', help='run the service with the persistent training store')
+    parser.add_argument('--documents', type=int, default=1000, help='synthetic documents seeded before the run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--duplicate-rate', type=float, default=0.0)
+    parser.add_argument('--prompts', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=20.0)
+    parser.add_argument('--timeout', type=float, default=60.0, help='client timeout per request')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"request weights (default {DEFAULT_MIX})")
+    parser.add_argument('--no-cache', action='store_true', help='send cache: false with every /generate')
+    parser.add_argument('--latency-ms', type=float, default=200.0, help='stub upstream latency')
+    parser.add_argument('--jitter-ms', type=float, default=50.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of upstream calls failing with 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of upstream calls failing with 429')
+    parser.add_argument('--startup-timeout', type=float, default=120.0)
+    parser.add_argument('--out', help='result file (default benchmarks/results/e2e-<commit>.json)')
+    args = parser.parse_args(argv)
+
+    stub = None
+    process = None
+    with tempfile.TemporaryDirectory(prefix='bench-e2e-') as workdir:
+        try:
+            url = args.url
+            if url is None:
+                stub = StubLLM(('127.0.0.1', 0), args.latency_ms, args.jitter_ms, args.error_rate,
+                               args.throttle_rate, seed=args.seed).start()
+                process, url = start_service(args, stub.base_url, workdir)
+            print(f"Seeding {args.documents} documents into {url}", file=sys.stderr)
+            results = {'seed': seed(url, args) if args.documents else {}}
+            print(f"Running {args.clients} clients for {args.seconds}s", file=sys.stderr)
+            results.update(LoadRun(url, args).run())
+            if stub is not None:
+                results['upstream'] = dict(stub.counts)
+        finally:
+            if process is not None:
+                process.terminate()
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            if stub is not None:
+                stub.shutdown()
+
+    parameters = {key: value for key, value in vars(args).items() if key != 'out'}
+    path = write_results('e2e', parameters, results, args.out)
+    for kind, stats in results.items():
+        if 'p50Ms' in stats:
+            print(f"{kind:<9} {stats['throughput']:>8.1f} req/s  p50 {stats['p50Ms']:>9.1f} ms  "
+                  f"p99 {stats['p99Ms']:>9.1f} ms  errors {stats['errors']}", file=sys.stderr)
+    print(f"Results written to {path}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
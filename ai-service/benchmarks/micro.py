@@ -0,0 +1,186 @@
+"""
+Micro-benchmarks of training data loading, retrieval, parsing and fallback generation
+
+Runs the service's own ScriptGenerator against a synthetic corpus in this
+process, with no server and no upstream model:
+
+    python -m benchmarks.micro --documents 10000
+    python -m benchmarks.micro --documents 100000 --store --only load_training_data
+
+load_training_data is timed with the store off (a cold walk, parse and
+index of every document) or, with --store, both seeding an empty store
+and restoring from the snapshot that seeding left behind.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.common import measure, report, summarize, write_results
+from benchmarks.corpus import NAMES, PLACES, TIMES, iter_corpus
+
+THEMES = ('betrayal', 'a missing letter', 'money owed', 'an old photograph', 'the truth about the fire',
+          'a secret marriage', 'the last train', 'a stolen knife', 'forgiveness', 'a phone call at midnight')
+
+
+def prompts(count, seed=0):
+    """Generation prompts in the style users send"""
+    rng = random.Random(f"{seed}:prompts")
+    return [
+        f"A tense scene in a {rng.choice(PLACES).lower()} at {rng.choice(TIMES).lower()} where "
+        f"{rng.choice(NAMES).title()} confronts {rng.choice(NAMES).title()} about {rng.choice(THEMES)}"
+        for _ in range(count)
+    ]
+
+
+def _configure(args):
+    """Environment the service modules read at import; must run before importing app"""
+    os.environ['TRAINING_STORE'] = 'true' if args.store else 'false'
+    if args.store:
+        os.environ['TRAINING_STORE_DIR'] = os.path.join(args.workdir, 'store')
+    os.environ.setdefault('RESPONSE_CACHE_TTL', '0')
+    os.environ.setdefault('OPENAI_API_KEY', '')
+    if args.semantic:
+        os.environ['SEMANTIC_RETRIEVAL'] = 'true'
+
+
+def run(args):
+    _configure(args)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+        # Let the module-level generator finish loading training/ so it doesn't skew the timings
+        app.script_generator.wait_until_warm()
+        from cache import ParseCache
+        from ingest import parse_elements
+
+    corpus = [{'filename': filename, 'content': content}
+              for filename, content in iter_corpus(args.documents, args.seed, args.scale, args.duplicate_rate)]
+
+    class SyntheticGenerator(app.ScriptGenerator):
+        def _read_training_files(self):
+            return [dict(item) for item in corpus]
+
+    def load():
+        with contextlib.redirect_stdout(io.StringIO()):
+            generator = SyntheticGenerator()
+            generator.wait_until_warm()
+            return generator
+
+    selected = set(args.only or ())
+
+    def wanted(name):
+        return not selected or name in selected or name.split('.')[0] in selected
+
+    results = {}
+    print(f"Corpus: {len(corpus)} documents, {sum(len(item['content']) for item in corpus) / 1e6:.1f} MB",
+          file=sys.stderr)
+
+    # Every load leaves a generator behind; the last one serves the other benchmarks
+    loads = max(1, args.load_repeat) if wanted('load_training_data') else 1
+    if args.store:
+        store_dir = os.environ['TRAINING_STORE_DIR']
+        seeds = []
+        for _ in range(loads):
+            shutil.rmtree(store_dir, ignore_errors=True)
+            generator, seconds = _timed(load)
+            seeds.append(seconds)
+        if wanted('load_training_data'):
+            results['load_training_data.seed'] = _load_stats(seeds, len(corpus))
+            restores = []
+            for _ in range(loads):
+                generator, seconds = _timed(load)
+                restores.append(seconds)
+            results['load_training_data.restore'] = _load_stats(restores, len(corpus))
+    else:
+        samples = []
+        for _ in range(loads):
+            generator, seconds = _timed(load)
+            samples.append(seconds)
+        if wanted('load_training_data'):
+            results['load_training_data'] = _load_stats(samples, len(corpus))
+
+    queries = prompts(args.prompts, args.seed)
+    cycle = _cycler(queries)
+
+    if wanted('retrieve_training_documents'):
+        results['retrieve_training_documents'] = measure(
+            lambda: generator._retrieve_training_documents(next(cycle)), args.repeat, min_seconds=args.min_seconds)
+    if wanted('retrieve_training_chunks'):
+        results['retrieve_training_chunks'] = measure(
+            lambda: generator._retrieve_training_chunks(next(cycle)), args.repeat, min_seconds=args.min_seconds)
+    if wanted('extract_relevant_training_content'):
+        results['extract_relevant_training_content'] = measure(
+            lambda: generator._extract_relevant_training_content(next(cycle)), args.repeat,
+            min_seconds=args.min_seconds)
+
+    if wanted('parse_script_content'):
+        documents = _cycler(corpus[:max(1, min(len(corpus), args.prompts))])
+
+        def parse_cold():
+            generator.parse_cache = ParseCache(parse_elements)
+            generator.parse_script_content(next(documents)['content'])
+
+        results['parse_script_content.cold'] = measure(parse_cold, args.repeat, min_seconds=args.min_seconds)
+        results['parse_script_content.cached'] = measure(
+            lambda: generator.parse_script_content(next(documents)['content']), args.repeat,
+            min_seconds=args.min_seconds)
+
+    if wanted('fallback'):
+        results['fallback.scene'] = measure(
+            lambda: generator.generate_script_scene_fallback(next(cycle)), args.repeat, min_seconds=args.min_seconds)
+        results['fallback.outline'] = measure(
+            lambda: generator.generate_movie_outline_fallback(next(cycle)), args.repeat, min_seconds=args.min_seconds)
+
+    return results
+
+
+def _timed(function):
+    start = time.perf_counter()
+    value = function()
+    return value, time.perf_counter() - start
+
+
+def _load_stats(samples, documents):
+    stats = summarize(samples)
+    stats['documentsPerSecond'] = round(documents / (sum(samples) / len(samples)), 1)
+    return stats
+
+
+def _cycler(items):
+    while True:
+        yield from items
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--documents', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', type=float, default=1.0, help='scenes per document multiplier')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0)
+    parser.add_argument('--prompts', type=int, default=50, help='distinct prompts cycled through')
+    parser.add_argument('--repeat', type=int, default=50, help='minimum calls per measurement')
+    parser.add_argument('--min-seconds', type=float, default=1.0, help='minimum time per measurement')
+    parser.add_argument('--load-repeat', type=int, default=3, help='full loads timed')
+    parser.add_argument('--store', action='store_true', help='load through the persistent training store')
+    parser.add_argument('--semantic', action='store_true', help='enable SEMANTIC_RETRIEVAL')
+    parser.add_argument('--only', nargs='*', help='benchmarks to run, e.g. load_training_data fallback')
+    parser.add_argument('--out', help='result file (default benchmarks/results/micro-<commit>.json)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='bench-micro-') as workdir:
+        args.workdir = workdir
+        results = run(args)
+    parameters = {key: value for key, value in vars(args).items() if key not in ('out', 'workdir')}
+    path = write_results('micro', parameters, results, args.out)
+    report(results)
+    print(f"Results written to {path}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
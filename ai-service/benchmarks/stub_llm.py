@@ -0,0 +1,158 @@
+"""
+Stand-in for the chat-completions API with latency and error injection
+
+Answers POST /chat/completions with a short scene, as JSON or as an SSE
+stream when the request asks for one, after a configurable delay. A share
+of requests can fail with a 5xx or 429 so retries, hedging and the
+circuit breaker get exercised. Point the service at it with
+
+    OPENAI_BASE_URL=http://127.0.0.1:9911/v1 OPENAI_API_KEY=stub python app.py
+    python -m benchmarks.stub_llm --port 9911 --latency-ms 300 --jitter-ms 100 --error-rate 0.02
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = """FADE IN:
+
+INT. STUB SERVER - NIGHT
+
+A single fan hums over a rack of blinking lights.
+
+OPERATOR
+Every answer takes exactly as long as you asked for.
+
+FADE OUT."""
+
+
+class StubLLM(ThreadingHTTPServer):
+    """Threaded server counting what it answered"""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms=200.0, jitter_ms=0.0, error_rate=0.0, throttle_rate=0.0,
+                 chunk_delay_ms=5.0, seed=0):
+        super().__init__(address, _Handler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.chunk_delay_ms = chunk_delay_ms
+        self.random = random.Random(seed)
+        self.counts = {'requests': 0, 'errors': 0, 'throttled': 0, 'streams': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def draw(self):
+        """Delay in seconds and the injected failure status (or None) for one request"""
+        with self._lock:
+            self.counts['requests'] += 1
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            roll = self.random.random()
+            if roll < self.error_rate:
+                self.counts['errors'] += 1
+                return delay, 503
+            if roll < self.error_rate + self.throttle_rate:
+                self.counts['throttled'] += 1
+                return delay, 429
+            return delay, None
+
+    def start(self):
+        """Serve from a daemon thread and return self"""
+        threading.Thread(target=self.serve_forever, name='stub-llm', daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError:
+            return self._send(400, {'error': {'message': 'invalid JSON'}})
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send(404, {'error': {'message': f"no route {self.path}"}})
+
+        delay, failure = self.server.draw()
+        time.sleep(delay)
+        if failure is not None:
+            return self._send(failure, {'error': {'message': 'injected failure'}})
+
+        prompt_tokens = sum(len(str(message.get('content', '')).split()) for message in body.get('messages', []))
+        if body.get('stream'):
+            return self._stream(body.get('model'))
+        self._send(200, {
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': REPLY}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(REPLY.split()),
+                      'total_tokens': prompt_tokens + len(REPLY.split())}
+        })
+
+    def _stream(self, model):
+        with self.server._lock:
+            self.server.counts['streams'] += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for line in REPLY.splitlines(keepends=True):
+                chunk = {'object': 'chat.completion.chunk', 'model': model,
+                         'choices': [{'index': 0, 'delta': {'content': line}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(self.server.chunk_delay_ms / 1000)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9911)
+    parser.add_argument('--latency-ms', type=float, default=200.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--chunk-delay-ms', type=float, default=5.0, help='delay between streamed lines')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    server = StubLLM((args.host, args.port), args.latency_ms, args.jitter_ms, args.error_rate,
+                     args.throttle_rate, args.chunk_delay_ms, args.seed)
+    print(f"Stub chat-completions API on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.counts))
+
+
+if __name__ == '__main__':
+    main()
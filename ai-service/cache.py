@@ -0,0 +1,358 @@
+"""
+In-process caches keyed by content digest
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from resilience import DeadlineExceeded
+
+# Memory cap for parsed training documents
+PARSE_CACHE_MAX_BYTES = int(os.getenv('PARSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+
+def content_digest(text):
+    """Stable digest of a document's text, used as a cache key"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by an estimated memory footprint"""
+
+    def __init__(self, max_bytes, sizeof=sys.getsizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the cached value and mark it most recently used"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store a value, evicting least recently used entries to stay under the cap"""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        """Drop an entry if present"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+
+    def stats(self):
+        """Counters for health reporting"""
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'maxBytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+def elements_size(collected):
+    """Rough memory footprint of a collect_elements() result"""
+    size = sys.getsizeof(collected)
+    for elements in collected.values():
+        size += sys.getsizeof(elements)
+        for element in elements:
+            # The tuple itself plus its text; spans and cue names are small or shared
+            size += 120 + len(element.text)
+    return size
+
+
+class ParseCache(LRUCache):
+    """Parsed screenplay elements of training documents, keyed by content digest"""
+
+    def __init__(self, parser, max_bytes=PARSE_CACHE_MAX_BYTES):
+        super().__init__(max_bytes, sizeof=elements_size)
+        self.parser = parser
+
+    def get_or_parse(self, content, digest=None):
+        """Return the parsed elements for content, parsing only on a miss"""
+        key = digest or content_digest(content)
+        collected = self.get(key)
+        if collected is None:
+            collected = self.parser(content)
+            self.put(key, collected)
+        return collected
+
+
+# Completed generations; a TTL of 0 disables response caching
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+# Optional directory for a disk tier shared by every worker on the host
+RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR')
+# Files kept in the disk tier; expired ones go first, then those closest to expiring
+RESPONSE_CACHE_DISK_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_DISK_MAX_ENTRIES', 10000))
+# Seconds between sweeps of expired disk entries
+RESPONSE_CACHE_SWEEP_SECONDS = float(os.getenv('RESPONSE_CACHE_SWEEP_SECONDS', 300))
+# Share of the cap a sweep trims the disk tier down to, so the next few writes don't set off another
+_DISK_LOW_WATER = 0.9
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt):
+    """Fold case and whitespace so trivially different prompts share a cache entry"""
+    return _WHITESPACE.sub(' ', prompt).strip().casefold()
+
+
+def response_cache_key(prompt, output_type, model, **sampling):
+    """Cache key for a generation request"""
+    payload = json.dumps({
+        'prompt': normalize_prompt(prompt),
+        'outputType': output_type,
+        'model': model,
+        'sampling': sampling
+    }, sort_keys=True)
+    return content_digest(payload)
+
+
+class _InFlight:
+    """A generation that other identical requests are waiting on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """TTL + LRU cache of generated text with an optional disk tier
+
+    Identical requests that arrive while the first one is still talking to
+    the upstream API wait for its result instead of issuing their own call.
+    Disk entries carry their expiry time as the file's mtime, so sweeps
+    can drop expired and surplus files without opening them. Sweeps run on
+    a background thread and count what is in the directory, since every
+    worker on the host writes to it.
+    """
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES, disk_dir=RESPONSE_CACHE_DIR,
+                 disk_max_entries=RESPONSE_CACHE_DISK_MAX_ENTRIES, sweep_seconds=RESPONSE_CACHE_SWEEP_SECONDS):
+        self.ttl = ttl
+        self.memory = LRUCache(max_bytes, sizeof=lambda entry: sys.getsizeof(entry[0]) + 64)
+        self.disk_dir = disk_dir
+        self.disk_max_entries = max(1, disk_max_entries)
+        self.sweep_seconds = sweep_seconds
+        self.coalesced = 0
+        self.coalesce_timeouts = 0
+        self.disk_hits = 0
+        self.disk_evictions = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        # Files the last sweep found plus this process's writes since; other workers' writes show up at the next sweep
+        self._disk_entries = 0
+        self._last_sweep = 0.0
+        self._sweeper = None
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._start_sweep()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def get(self, key):
+        """Cached value for key, or None if missing or expired"""
+        entry = self.memory.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.time():
+                return value
+            self.memory.discard(key)
+
+        entry = self._read_disk(key)
+        if entry is not None:
+            self.disk_hits += 1
+            self.memory.put(key, entry)
+            return entry[0]
+        return None
+
+    def put(self, key, value):
+        """Store value in memory and, when configured, on disk"""
+        entry = (value, time.time() + self.ttl)
+        self.memory.put(key, entry)
+        self._write_disk(key, entry)
+
+    def get_or_compute(self, key, compute, bypass=False, timeout=None):
+        """Return a cached value or run compute() once for all concurrent callers
+
+        With bypass compute() runs on its own: the cache is neither read
+        nor written and no in-flight request is joined. A caller that joins
+        one waits at most timeout seconds for it, then raises DeadlineExceeded.
+        """
+        if bypass:
+            return compute()
+        if self.enabled:
+            value = self.get(key)
+            if value is not None:
+                return value
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _InFlight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                with self._lock:
+                    self.coalesce_timeouts += 1
+                raise DeadlineExceeded('coalesced request outlived the latency budget')
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+            if self.enabled:
+                self.put(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get('expires', 0) <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return (record['value'], record['expires'])
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'value': entry[0], 'expires': entry[1]}, f)
+            os.utime(tmp_path, (entry[1], entry[1]))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Response cache write error: {e}")
+            return
+        self._disk_entries += 1
+        if (self._disk_entries > self.disk_max_entries
+                or time.monotonic() - self._last_sweep >= self.sweep_seconds):
+            self._start_sweep()
+
+    def _start_sweep(self):
+        """Sweep the disk tier on a background thread, unless a sweep is already running"""
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        self._last_sweep = time.monotonic()
+        self._sweeper = threading.Thread(target=self._sweep_disk, daemon=True)
+        self._sweeper.start()
+
+    def _sweep_disk(self):
+        """Remove expired disk entries, then the ones closest to expiry down to the low-water mark
+
+        Runs with the sweep lock held and releases it when done.
+        """
+        try:
+            now = time.time()
+            live = []
+            removed = 0
+            with os.scandir(self.disk_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.json'):
+                        continue
+                    try:
+                        expires = entry.stat().st_mtime
+                        if expires <= now:
+                            os.remove(entry.path)
+                            removed += 1
+                        else:
+                            live.append((expires, entry.path))
+                    except OSError:
+                        pass
+            if len(live) > self.disk_max_entries:
+                keep = max(1, int(self.disk_max_entries * _DISK_LOW_WATER))
+                live.sort()
+                for _, path in live[:len(live) - keep]:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+                live = live[len(live) - keep:]
+            self._disk_entries = len(live)
+            self.disk_evictions += removed
+        except OSError as e:
+            print(f"Response cache sweep error: {e}")
+        finally:
+            self._sweep_lock.release()
+
+    def stats(self):
+        """Counters for health reporting"""
+        stats = self.memory.stats()
+        stats.update({
+            'ttl': self.ttl,
+            'diskTier': bool(self.disk_dir),
+            'diskHits': self.disk_hits,
+            'diskEvictions': self.disk_evictions,
+            'coalesced': self.coalesced,
+            'coalesceTimeouts': self.coalesce_timeouts,
+            'inFlight': len(self._inflight)
+        })
+        return stats
@@ -0,0 +1,86 @@
+"""
+Token-budgeted packing of retrieved training chunks into prompt context
+"""
+
+import os
+from collections import namedtuple
+
+from cache import content_digest, normalize_prompt
+from retrieval import tokenize
+
+# Prompt tokens to spend on training excerpts
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 600))
+# Chunks scored per request before packing
+CONTEXT_CANDIDATES = int(os.getenv('CONTEXT_CANDIDATES', 24))
+# Rough size of a token for English prose; avoids a tokenizer dependency
+CHARS_PER_TOKEN = 4
+# Overhead of the per-excerpt header line
+HEADER_TOKENS = 12
+# Chunks scoring below this fraction of the best match are left out
+MIN_RELATIVE_SCORE = 0.25
+# Chunks sharing at least this fraction of their terms with a picked chunk are skipped
+DUPLICATE_OVERLAP = 0.8
+
+# A retrieved excerpt; start is its byte offset, used to keep excerpts in script order
+ContextChunk = namedtuple('ContextChunk', ['score', 'doc_id', 'start', 'name', 'text'])
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _overlap(terms, other):
+    if not terms or not other:
+        return 0.0
+    return len(terms & other) / min(len(terms), len(other))
+
+
+def pack_chunks(candidates, budget_tokens=CONTEXT_TOKEN_BUDGET):
+    """Highest-scoring, de-duplicated chunks that fit the token budget
+
+    Chunks are taken in score order; weak matches, exact and near
+    duplicates of something already picked are dropped, and chunks too
+    large for what is left of the budget are skipped in favour of smaller
+    ones further down.
+    """
+    ranked = sorted(candidates, key=lambda c: c.score, reverse=True)
+    floor = ranked[0].score * MIN_RELATIVE_SCORE if ranked else 0.0
+    picked = []
+    picked_terms = []
+    seen = set()
+    used = 0
+    for chunk in ranked:
+        if chunk.score < floor:
+            break
+        if not chunk.text:
+            continue
+        cost = estimate_tokens(chunk.text) + HEADER_TOKENS
+        if used + cost > budget_tokens:
+            continue
+        key = content_digest(normalize_prompt(chunk.text))
+        if key in seen:
+            continue
+        terms = set(tokenize(chunk.text))
+        if any(_overlap(terms, other) >= DUPLICATE_OVERLAP for other in picked_terms):
+            continue
+        seen.add(key)
+        picked_terms.append(terms)
+        picked.append(chunk)
+        used += cost
+    return picked
+
+
+def format_chunks(chunks):
+    """Prompt text for packed chunks, grouped by script in reading order"""
+    groups = {}
+    for chunk in chunks:
+        groups.setdefault(chunk.doc_id, []).append(chunk)
+    # Best-scoring script first; within a script keep the original order
+    ordered = sorted(groups.values(), key=lambda group: max(c.score for c in group), reverse=True)
+
+    formatted = ""
+    for group in ordered:
+        for chunk in sorted(group, key=lambda c: c.start):
+            formatted += f"\n--- Training Script: {chunk.name} (Relevance: {chunk.score:.1f}) ---\n"
+            formatted += chunk.text + "\n"
+    return formatted
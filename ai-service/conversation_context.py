@@ -0,0 +1,128 @@
+"""
+Bounded conversation context: a rolling summary of older turns plus the latest raw turns
+
+Summaries are cached per conversation together with a watermark, the
+number of messages already folded in. Each request folds only the turns
+that have aged out of the raw window since the last one, so the work and
+the prompt size per request stay flat however long the conversation gets.
+"""
+
+import os
+import re
+import sys
+
+from cache import LRUCache
+from screenplay import collect_elements
+
+# Most recent messages passed through verbatim
+CONVERSATION_RAW_TURNS = int(os.getenv('CONVERSATION_RAW_TURNS', 4))
+# Caps on what the context adds to a prompt
+CONVERSATION_TURN_MAX_CHARS = int(os.getenv('CONVERSATION_TURN_MAX_CHARS', 600))
+CONVERSATION_SUMMARY_MAX_CHARS = int(os.getenv('CONVERSATION_SUMMARY_MAX_CHARS', 1500))
+CONVERSATION_CACHE_MAX_BYTES = int(os.getenv('CONVERSATION_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+
+# Length of the excerpt kept from each summarized message
+SUMMARY_EXCERPT_CHARS = 160
+OMITTED_MARKER = '(earlier turns omitted)'
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _excerpt(text, limit):
+    text = _WHITESPACE.sub(' ', text).strip()
+    return text if len(text) <= limit else text[:limit - 3].rstrip() + '...'
+
+
+def _message(entry):
+    """(role, content) from a backend message, or None if it is unusable"""
+    if not isinstance(entry, dict) or not isinstance(entry.get('content'), str):
+        return None
+    role = entry.get('type') or entry.get('role')
+    return ('user' if role == 'user' else 'assistant'), entry['content']
+
+
+def summarize_turn(role, content):
+    """One summary line for a message that has aged out of the raw window"""
+    if role == 'user':
+        return f"User asked for: {_excerpt(content, SUMMARY_EXCERPT_CHARS)}"
+
+    first_line = content.strip().split('\n', 1)[0]
+    if first_line.startswith('MOVIE OUTLINE'):
+        return f"Assistant outlined: {_excerpt(first_line, SUMMARY_EXCERPT_CHARS)}"
+    elements = collect_elements(content, scenes=1, characters=4, dialogue=0, descriptions=0)
+    if elements['scenes'] or elements['characters']:
+        parts = []
+        if elements['scenes']:
+            parts.append(f"set in {elements['scenes'][0].text}")
+        names = list(dict.fromkeys(e.text for e in elements['characters']))
+        if names:
+            parts.append(f"with {', '.join(names)}")
+        return f"Assistant wrote a scene {' '.join(parts)}"
+    return f"Assistant replied: {_excerpt(content, SUMMARY_EXCERPT_CHARS)}"
+
+
+def _lines_size(entry):
+    watermark, lines = entry
+    return sys.getsizeof(lines) + sum(len(line) + 49 for line in lines)
+
+
+class ConversationContext:
+    """Per-conversation rolling summaries, cached by conversation id and watermark"""
+
+    def __init__(self, raw_turns=CONVERSATION_RAW_TURNS, max_bytes=CONVERSATION_CACHE_MAX_BYTES):
+        self.raw_turns = raw_turns
+        self.summaries = LRUCache(max_bytes, sizeof=_lines_size)
+        self.folded = 0
+
+    def render(self, history, prompt=None, conversation_id=None, message_count=None):
+        """Prompt text describing the conversation so far, or None when there is none
+
+        history is the tail of the conversation as the backend sends it;
+        message_count is the conversation's full length, which places that
+        tail. A trailing user message equal to prompt is the current request
+        and is left out.
+        """
+        messages = [m for m in map(_message, history or ()) if m is not None]
+        total = message_count if isinstance(message_count, int) and message_count >= len(messages) else len(messages)
+        if messages and messages[-1] == ('user', prompt):
+            messages.pop()
+            total -= 1
+        if not messages:
+            return None
+
+        window_start = total - len(messages)
+        fold_end = max(window_start, total - self.raw_turns)
+
+        watermark, lines = 0, []
+        if conversation_id:
+            cached = self.summaries.get(str(conversation_id))
+            # A watermark past the end means the history was rewritten; start over
+            if cached is not None and cached[0] <= total:
+                watermark, lines = cached
+        lines = list(lines)
+        # Turns that left the window before they could be folded (e.g. seen by another worker)
+        if window_start > watermark and lines[-1:] != [OMITTED_MARKER]:
+            lines.append(OMITTED_MARKER)
+        for position in range(max(watermark, window_start), fold_end):
+            lines.append(summarize_turn(*messages[position - window_start]))
+            self.folded += 1
+        while len(lines) > 1 and sum(len(line) + 1 for line in lines) > CONVERSATION_SUMMARY_MAX_CHARS:
+            del lines[0]
+        if conversation_id:
+            self.summaries.put(str(conversation_id), (max(watermark, fold_end), lines))
+
+        sections = []
+        if lines:
+            sections.append("Conversation summary:\n" + "\n".join(f"- {line}" for line in lines))
+        recent = messages[max(0, fold_end - window_start):]
+        if recent:
+            turns = "\n".join(f"{'User' if role == 'user' else 'Assistant'}: "
+                              f"{_excerpt(content, CONVERSATION_TURN_MAX_CHARS)}"
+                              for role, content in recent)
+            sections.append("Recent turns:\n" + turns)
+        return "\n\n".join(sections)
+
+    def stats(self):
+        stats = self.summaries.stats()
+        stats['turnsFolded'] = self.folded
+        return stats
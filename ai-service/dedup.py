@@ -0,0 +1,417 @@
+"""
+Near-duplicate detection for training documents with MinHash and banded LSH
+
+Each document gets a MinHash signature over its word 5-shingles when its
+record is built, so the estimated Jaccard similarity of two documents is
+the share of signature positions they agree on. Signatures are split into
+DEDUP_BANDS bands; documents sharing any whole band land in the same
+bucket, so a lookup only compares against the few documents it collides
+with instead of the whole corpus.
+
+Matching documents form clusters, and DEDUP_POLICY decides what happens
+to a new member:
+
+    reject     it is not stored
+    version    it is stored as the newest version and retrieval only
+               sees the newest version of each cluster
+    collapse   it is stored and retrieval keeps the best-ranked member
+               of each cluster
+    off        no detection
+
+Buckets, clusters and matches are saved with each training store snapshot
+(dedup.* files). A restore maps the sorted bucket tables and binary-searches
+them, so it does not re-cluster the corpus.
+"""
+
+import json
+import os
+import threading
+import zlib
+from bisect import bisect_left
+
+from document_store import SIGNATURE_WIDTH, _Column, _int_view, _map_file
+from retrieval import tokenize
+
+DEDUP_POLICY = os.getenv('DEDUP_POLICY', 'collapse').lower()
+DEDUP_POLICIES = ('reject', 'version', 'collapse', 'off')
+# Estimated Jaccard similarity at which two documents count as duplicates
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', 0.8))
+# Bands of SIGNATURE_WIDTH // DEDUP_BANDS rows; 16 x 8 puts the LSH cut-off near 0.7
+DEDUP_BANDS = int(os.getenv('DEDUP_BANDS', 16))
+SHINGLE_WORDS = 5
+
+# Universal hashing modulo a Mersenne prime; the fixed seed keeps signatures
+# identical in every process and across restarts
+_PRIME = (1 << 31) - 1
+# Shingles hashed per step, bounding the (SIGNATURE_WIDTH, block) intermediate
+_BLOCK = 4096
+
+ACTIONS = {'reject': 'rejected', 'version': 'versioned', 'collapse': 'collapsed'}
+
+# numpy and the hash coefficients drawn with it, loaded on first use
+np = None
+_A = _B = _ROW_WEIGHTS = None
+
+
+def _import_numpy():
+    global np, _A, _B, _ROW_WEIGHTS
+    if np is None:
+        import numpy as module
+        generator = module.random.RandomState(20240611)
+        _A = generator.randint(1, _PRIME, SIGNATURE_WIDTH).astype(module.uint64)[:, None]
+        _B = generator.randint(0, _PRIME, SIGNATURE_WIDTH).astype(module.uint64)[:, None]
+        # Bucket keys are weighted sums of a band's rows modulo 2**64, stable across processes
+        _ROW_WEIGHTS = generator.randint(1, 1 << 63, SIGNATURE_WIDTH, dtype=module.uint64) | module.uint64(1)
+        np = module
+
+
+def minhash(content):
+    """MinHash signature of a document as SIGNATURE_WIDTH ints, or None when it has no words"""
+    words = tokenize(content)
+    if not words:
+        return None
+    _import_numpy()
+    count = max(1, len(words) - SHINGLE_WORDS + 1)
+    hashes = np.fromiter(
+        (zlib.crc32(' '.join(words[i:i + SHINGLE_WORDS]).encode('utf-8')) for i in range(count)),
+        dtype=np.uint64, count=count)
+    signature = np.full(SIGNATURE_WIDTH, _PRIME, dtype=np.uint64)
+    for start in range(0, count, _BLOCK):
+        block = hashes[start:start + _BLOCK][None, :]
+        np.minimum(signature, ((_A * block + _B) % _PRIME).min(axis=1), out=signature)
+    return signature.astype(np.int32)
+
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of two signatures"""
+    _import_numpy()
+    return float(np.count_nonzero(np.asarray(first) == np.asarray(second))) / SIGNATURE_WIDTH
+
+
+class _Buckets:
+    """One band's buckets: a sorted key table mapped from a snapshot plus the changes since"""
+
+    __slots__ = ('keys', 'ids', 'added', 'dropped')
+
+    def __init__(self, keys=(), ids=()):
+        self.keys = keys
+        self.ids = ids
+        self.added = {}
+        self.dropped = set()
+
+    def get(self, key):
+        doc_id = self.added.get(key)
+        if doc_id is not None or key in self.dropped:
+            return doc_id
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.ids[i]
+        return None
+
+    def setdefault(self, key, doc_id):
+        if self.get(key) is None:
+            self.added[key] = doc_id
+            self.dropped.discard(key)
+
+    def discard(self, key, doc_id):
+        """Empty the bucket if doc_id holds it; True if it did"""
+        if self.get(key) != doc_id:
+            return False
+        self.added.pop(key, None)
+        self.dropped.add(key)
+        return True
+
+    def copy(self):
+        buckets = _Buckets(self.keys, self.ids)
+        buckets.added = dict(self.added)
+        buckets.dropped = set(self.dropped)
+        return buckets
+
+    def table(self):
+        """(sorted keys, doc ids) of every bucket"""
+        _import_numpy()
+        keys = np.asarray(self.keys, dtype=np.uint64)
+        ids = np.asarray(self.ids, dtype=np.int32)
+        changed = np.fromiter(self.dropped | self.added.keys(), dtype=np.uint64)
+        kept = ~np.isin(keys, changed)
+        keys = np.concatenate([keys[kept], np.fromiter(self.added, dtype=np.uint64, count=len(self.added))])
+        ids = np.concatenate([ids[kept], np.fromiter(self.added.values(), dtype=np.int32, count=len(self.added))])
+        order = np.argsort(keys, kind='stable')
+        return keys[order], ids[order]
+
+
+class DedupIndex:
+    """LSH buckets and duplicate clusters over one DocumentStore's signatures
+
+    Buckets keep the first document that hashed to them, which is usually
+    its cluster's original, so memory is one dict entry per band per
+    distinct bucket. Documents are added in doc id order, and removed when
+    deleted, under the caller's write lock; readers only look up.
+    """
+
+    def __init__(self, policy=DEDUP_POLICY, threshold=DEDUP_THRESHOLD, bands=DEDUP_BANDS):
+        if policy not in DEDUP_POLICIES:
+            raise ValueError(f"DEDUP_POLICY must be one of: {', '.join(DEDUP_POLICIES)}")
+        if SIGNATURE_WIDTH % bands:
+            raise ValueError(f"DEDUP_BANDS must divide {SIGNATURE_WIDTH}")
+        self.policy = policy
+        self.threshold = threshold
+        self.rows = SIGNATURE_WIDTH // bands
+        self.documents = None
+        self._buckets = [_Buckets() for _ in range(bands)]
+        self._roots = _Column('i')  # doc id -> doc id of its cluster's first member
+        self._latest = {}         # root -> newest member, only for clusters of two or more
+        self._sizes = {}          # root -> member count, likewise
+        self._members = {}        # root -> live members in doc id order, likewise
+        self._matches = {}        # doc id -> (matched doc id, similarity, version) for duplicates
+        self._signatures = {}     # signatures computed here for documents stored without one
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.policy != 'off'
+
+    @property
+    def duplicates(self):
+        return len(self._matches)
+
+    def rebuild(self, documents):
+        """Index every document of a store, replacing what was indexed before"""
+        with self._lock:
+            self.documents = documents
+            self._buckets = [_Buckets() for _ in self._buckets]
+            self._roots = _Column('i')
+            self._latest = {}
+            self._sizes = {}
+            self._members = {}
+            self._matches = {}
+            self._signatures = {}
+        self.add(len(documents))
+
+    def signature(self, doc_id):
+        signature = self.documents.signature(doc_id)
+        if signature is not None:
+            return signature
+        if doc_id not in self._signatures:
+            self._signatures[doc_id] = minhash(self.documents.content(doc_id))
+        return self._signatures[doc_id]
+
+    def _keys(self, signature):
+        _import_numpy()
+        values = np.asarray(signature, dtype=np.int32).astype(np.uint64)
+        return (values * _ROW_WEIGHTS).reshape(-1, self.rows).sum(axis=1).tolist()
+
+    def _closest(self, bands, signature, signature_of, exclude=()):
+        best = None
+        seen = set(exclude)
+        for buckets, key in zip(bands, self._keys(signature)):
+            doc_id = buckets.get(key)
+            if doc_id is None or doc_id in seen:
+                continue
+            seen.add(doc_id)
+            score = similarity(signature, signature_of(doc_id))
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (doc_id, score)
+        return best
+
+    def find(self, signature, exclude=()):
+        """(doc id, similarity) of the closest indexed near-duplicate outside exclude, or None"""
+        if not self.enabled or signature is None:
+            return None
+        return self._closest(self._buckets, signature, self.signature, exclude)
+
+    def batch(self):
+        """PendingBatch for matching records of one commit against each other"""
+        return PendingBatch(self)
+
+    def add(self, count):
+        """Index documents up to count, clustering each with its near-duplicate"""
+        if not self.enabled:
+            return
+        with self._lock:
+            for doc_id in range(len(self._roots), count):
+                if self.documents.is_deleted(doc_id):
+                    self._roots.append(doc_id)
+                    continue
+                signature = self.signature(doc_id)
+                match = self.find(signature)
+                root = doc_id
+                if match is not None:
+                    root = self._roots[match[0]]
+                    self._sizes[root] = self._sizes.get(root, 1) + 1
+                    self._latest[root] = doc_id
+                    self._members.setdefault(root, [root]).append(doc_id)
+                    self._matches[doc_id] = match + (self._sizes[root],)
+                self._roots.append(root)
+                if signature is not None:
+                    for buckets, key in zip(self._buckets, self._keys(signature)):
+                        buckets.setdefault(key, doc_id)
+
+    def remove(self, doc_ids):
+        """Forget deleted documents
+
+        Buckets a document held pass to the live members of its cluster
+        that share them, and the cluster's newest live member becomes its
+        latest version again.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            for doc_id in doc_ids:
+                if doc_id >= len(self._roots):
+                    continue
+                self._matches.pop(doc_id, None)
+                root = self._roots[doc_id]
+                members = self._members.get(root)
+                if members is not None and doc_id in members:
+                    members.remove(doc_id)
+                    if members:
+                        self._latest[root] = members[-1]
+                    else:
+                        del self._members[root]
+                        self._latest.pop(root, None)
+                signature = self.signature(doc_id)
+                self._signatures.pop(doc_id, None)
+                if signature is None:
+                    continue
+                freed = set()
+                for band, (buckets, key) in enumerate(zip(self._buckets, self._keys(signature))):
+                    if buckets.discard(key, doc_id):
+                        freed.add((band, key))
+                for member in (members or ()) if freed else ():
+                    member_signature = self.signature(member)
+                    if member_signature is None:
+                        continue
+                    for band, (buckets, key) in enumerate(zip(self._buckets, self._keys(member_signature))):
+                        if (band, key) in freed:
+                            buckets.setdefault(key, member)
+
+    def match(self, doc_id):
+        """(matched doc id, similarity, version) if doc_id was added as a near-duplicate
+
+        version counts the cluster's members up to and including doc_id.
+        """
+        return self._matches.get(doc_id)
+
+    def search_k(self, k):
+        """How many results to fetch so k survive collapsing"""
+        return k * 3 if self.enabled and self._matches else k
+
+    def collapse(self, ranked, doc_of=lambda item: item[1], k=None):
+        """Drop results hidden by the policy, keeping rank order
+
+        ranked holds results best first; doc_of maps one to its doc id.
+        version keeps only results from each cluster's newest member;
+        collapse keeps results from the first-ranked member of each cluster.
+        Several results of the one kept document all stay.
+        """
+        if not self.enabled or not self._matches:
+            return ranked[:k] if k is not None else ranked
+        roots = self._roots
+        kept = []
+        chosen = {}
+        for item in ranked:
+            doc_id = doc_of(item)
+            root = roots[doc_id] if doc_id < len(roots) else doc_id
+            if self.policy == 'version':
+                if self._latest.get(root, root) != doc_id:
+                    continue
+            elif chosen.setdefault(root, doc_id) != doc_id:
+                continue
+            kept.append(item)
+            if k is not None and len(kept) == k:
+                break
+        return kept
+
+    def snapshot(self):
+        """Copy of the current buckets and clusters, safe to save while adds continue"""
+        with self._lock:
+            view = DedupIndex(self.policy, self.threshold, len(self._buckets))
+            view.documents = self.documents
+            view.deleted = self.documents.deleted if self.documents is not None else frozenset()
+            view._buckets = [buckets.copy() for buckets in self._buckets]
+            view._roots = _Column('i', self._roots.base)
+            view._roots.extend(self._roots.tail)
+            view._latest = dict(self._latest)
+            view._sizes = dict(self._sizes)
+            view._members = {root: list(members) for root, members in self._members.items()}
+            view._matches = dict(self._matches)
+        return view
+
+    def save(self, directory):
+        """Write a snapshot() as dedup.* files under directory"""
+        offsets = [0]
+        with open(os.path.join(directory, 'dedup.keys.bin'), 'wb') as keys_file, \
+                open(os.path.join(directory, 'dedup.ids.bin'), 'wb') as ids_file:
+            for buckets in self._buckets:
+                keys, ids = buckets.table()
+                keys_file.write(keys.tobytes())
+                ids_file.write(ids.tobytes())
+                offsets.append(offsets[-1] + len(keys))
+        with open(os.path.join(directory, 'dedup.roots.bin'), 'wb') as f:
+            self._roots.write(f, len(self._roots))
+        with open(os.path.join(directory, 'dedup.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'policy': self.policy,
+                'threshold': self.threshold,
+                'bands': len(self._buckets),
+                'offsets': offsets,
+                'deleted': sorted(doc_id for doc_id in self.deleted if doc_id < len(self._roots)),
+                'latest': list(self._latest.items()),
+                'sizes': list(self._sizes.items()),
+                'members': list(self._members.items()),
+                'matches': [[doc_id] + list(match) for doc_id, match in self._matches.items()]
+            }, f, separators=(',', ':'))
+
+    @classmethod
+    def open(cls, directory, documents, policy=DEDUP_POLICY, threshold=DEDUP_THRESHOLD, bands=DEDUP_BANDS):
+        """Saved index over documents, or None if it was saved with other settings"""
+        with open(os.path.join(directory, 'dedup.json'), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        if (info['policy'], info['threshold'], info['bands']) != (policy, threshold, bands):
+            return None
+        dedup = cls(policy, threshold, bands)
+        dedup.documents = documents
+        keys = _int_view(_map_file(os.path.join(directory, 'dedup.keys.bin')), 'Q')
+        ids = _int_view(_map_file(os.path.join(directory, 'dedup.ids.bin')), 'i')
+        offsets = info['offsets']
+        dedup._buckets = [_Buckets(keys[start:stop], ids[start:stop]) for start, stop in zip(offsets, offsets[1:])]
+        dedup._roots = _Column('i', _int_view(_map_file(os.path.join(directory, 'dedup.roots.bin')), 'i'))
+        dedup._latest = dict(info['latest'])
+        dedup._sizes = dict(info['sizes'])
+        dedup._members = dict(info['members'])
+        dedup._matches = {doc_id: tuple(match) for doc_id, *match in info['matches']}
+        # Documents deleted after the copy was taken but before the store was saved
+        dedup.remove(sorted(documents.deleted.difference(info['deleted'])))
+        return dedup
+
+    def stats(self):
+        return {
+            'policy': self.policy,
+            'threshold': self.threshold,
+            'documents': len(self._roots),
+            'duplicates': len(self._matches),
+            'clusters': len(self._sizes)
+        }
+
+
+class PendingBatch:
+    """Records of one commit, bucketed like DedupIndex so each is matched against the rest in O(bands)"""
+
+    def __init__(self, dedup):
+        self.dedup = dedup
+        self._buckets = [{} for _ in dedup._buckets]
+        self._signatures = {}
+
+    def find(self, signature):
+        """(doc id, similarity) of the closest near-duplicate added to the batch, or None"""
+        if signature is None:
+            return None
+        return self.dedup._closest(self._buckets, signature, self._signatures.get)
+
+    def add(self, doc_id, signature):
+        if signature is None:
+            return
+        self._signatures[doc_id] = signature
+        for buckets, key in zip(self._buckets, self.dedup._keys(signature)):
+            buckets.setdefault(key, doc_id)
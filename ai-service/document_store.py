@@ -0,0 +1,578 @@
+"""
+Columnar, append-only store for training documents
+
+All document text lives in one UTF-8 buffer addressed by an offset array;
+filenames share a second buffer, categories are interned, and parsed
+screenplay elements are kept as integer spans into the text instead of
+copied substrings. A store opened from a snapshot maps its columns
+read-only and appends new documents to in-memory tails, so documents are
+cheap to hold and a pass over the whole corpus touches packed arrays
+rather than one dict per document.
+"""
+
+import json
+import mmap
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+from screenplay import ACTION, CHARACTER, DIALOGUE, SCENE_HEADING, Element
+
+# Buckets of collect_elements() in the order their codes are stored
+ELEMENT_BUCKETS = ('scenes', 'characters', 'dialogue', 'descriptions')
+BUCKET_KINDS = (SCENE_HEADING, CHARACTER, DIALOGUE, ACTION)
+# Ints per stored element: bucket, start, end, cue start, cue end
+SPAN_WIDTH = 5
+
+DIGEST_SIZE = 16
+# MinHash values per document (see dedup.py); -1 fills the slot when a record had none
+SIGNATURE_WIDTH = 128
+NO_TIMESTAMP = -1
+
+
+_NO_SIGNATURE = array('i', [-1]) * SIGNATURE_WIDTH
+
+
+def _map_file(path):
+    """Read-only mmap of a file, or an empty buffer for empty files"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _int_view(buffer, typecode):
+    """Integer view over a mapped buffer without copying it"""
+    if not len(buffer):
+        return array(typecode)
+    return memoryview(buffer).cast(typecode)
+
+
+def summarize_elements(collected):
+    """The plain lists /train reports and /scripts returns as `parsed`"""
+    return {
+        'scenes': [e.text for e in collected['scenes']],
+        'characters': [e.text for e in collected['characters']],
+        'dialogue': [f"{e.character}: {e.text}" for e in collected['dialogue']],
+        'descriptions': [e.text for e in collected['descriptions']]
+    }
+
+
+def _byte_offsets(content, indices):
+    """{character index: UTF-8 byte offset} for indices in content, in one pass over the text"""
+    if content.isascii():
+        return {index: index for index in indices}
+    offsets = {}
+    position = offset = 0
+    for index in sorted(set(indices)):
+        offset += len(content[position:index].encode('utf-8'))
+        offsets[index] = offset
+        position = index
+    return offsets
+
+
+def element_spans(content, collected):
+    """Flat [bucket, start, end, cue_start, cue_end, ...] UTF-8 byte spans for collected elements"""
+    spans = []
+    for code, bucket in enumerate(ELEMENT_BUCKETS):
+        for element in collected[bucket]:
+            cue_start = cue_end = -1
+            if element.character is not None:
+                # The cue is the nearest line before the dialogue with exactly that text
+                cue = content.rfind(element.character, 0, element.start)
+                if cue != -1:
+                    cue_start, cue_end = cue, cue + len(element.character)
+            spans.extend((code, element.start, element.end, cue_start, cue_end))
+    # Character offsets to byte offsets for everything but the bucket codes and missing cues
+    byte_offset = _byte_offsets(content, (value for i, value in enumerate(spans) if i % 5 and value != -1))
+    byte_offset[-1] = -1
+    return [value if not i % 5 else byte_offset[value] for i, value in enumerate(spans)]
+
+
+def chunk_byte_spans(content, spans):
+    """[(start, end)] character spans from screenplay.chunk_spans() as UTF-8 byte spans"""
+    byte_offset = _byte_offsets(content, (index for span in spans for index in span))
+    return [(byte_offset[start], byte_offset[end]) for start, end in spans]
+
+
+def _timestamp_micros(timestamp):
+    if not timestamp:
+        return NO_TIMESTAMP
+    try:
+        moment = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return NO_TIMESTAMP
+    return int(moment.timestamp()) * 1_000_000 + moment.microsecond
+
+
+def category_of(filename):
+    """Training category: the top-level directory of a training file's path"""
+    if not filename:
+        return None
+    head, sep, _ = filename.replace(os.sep, '/').partition('/')
+    return head if sep else None
+
+
+class _Column:
+    """Append-only integer column: a read-only (possibly mapped) prefix plus a growable tail"""
+
+    __slots__ = ('base', 'tail')
+
+    def __init__(self, typecode, base=None):
+        self.base = base if base is not None else array(typecode)
+        self.tail = array(typecode)
+
+    def __len__(self):
+        return len(self.base) + len(self.tail)
+
+    def __getitem__(self, i):
+        base_length = len(self.base)
+        return self.base[i] if i < base_length else self.tail[i - base_length]
+
+    def append(self, value):
+        self.tail.append(value)
+
+    def extend(self, values):
+        self.tail.extend(values)
+
+    def range(self, start, stop):
+        """Values [start, stop), which never straddle base and tail"""
+        base_length = len(self.base)
+        if stop <= base_length:
+            return self.base[start:stop]
+        return self.tail[start - base_length:stop - base_length]
+
+    def write(self, f, count):
+        """Write the first count values in native layout"""
+        base_count = min(count, len(self.base))
+        f.write(memoryview(self.base)[:base_count].tobytes())
+        f.write(self.tail[:count - base_count].tobytes())
+
+
+class _Bytes:
+    """Append-only byte buffer: a read-only (possibly mapped) prefix plus a growable tail"""
+
+    __slots__ = ('base', 'tail')
+
+    def __init__(self, base=b''):
+        self.base = base
+        self.tail = bytearray()
+
+    def __len__(self):
+        return len(self.base) + len(self.tail)
+
+    def extend(self, data):
+        self.tail += data
+
+    def slice(self, start, stop):
+        base_length = len(self.base)
+        if stop <= base_length:
+            return self.base[start:stop]
+        return bytes(self.tail[start - base_length:stop - base_length])
+
+    def write(self, f, length):
+        base_length = min(length, len(self.base))
+        f.write(self.base[:base_length])
+        f.write(self.tail[:length - base_length])
+
+
+class Document:
+    """Lightweight view of one stored document; fields are decoded on access"""
+
+    __slots__ = ('store', 'doc_id')
+
+    def __init__(self, store, doc_id):
+        self.store = store
+        self.doc_id = doc_id
+
+    @property
+    def content(self):
+        return self.store.content(self.doc_id)
+
+    @property
+    def length(self):
+        """Size of the text in UTF-8 bytes, without decoding it"""
+        return self.store.text_length(self.doc_id)
+
+    @property
+    def filename(self):
+        return self.store.filename(self.doc_id)
+
+    @property
+    def category(self):
+        return self.store.category(self.doc_id)
+
+    @property
+    def id(self):
+        return self.store.ids.get(self.doc_id)
+
+    @property
+    def metadata(self):
+        return self.store.metadata.get(self.doc_id, {})
+
+    @property
+    def timestamp(self):
+        return self.store.timestamp(self.doc_id)
+
+    @property
+    def digest(self):
+        return self.store.digest(self.doc_id)
+
+    @property
+    def elements(self):
+        return self.store.elements(self.doc_id)
+
+    @property
+    def parsed(self):
+        return summarize_elements(self.elements)
+
+    @property
+    def name(self):
+        """Label for prompts and logs"""
+        return self.filename or self.id or 'unknown'
+
+    def to_dict(self):
+        """The item shape /scripts has always returned"""
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'category': self.category,
+            'content': self.content,
+            'digest': self.digest,
+            'metadata': self.metadata,
+            'parsed': self.parsed,
+            'timestamp': self.timestamp
+        }
+
+
+class DocumentStore:
+    """Columnar training documents addressed by dense doc ids
+
+    Appends are expected to be serialized by the caller. The text offset is
+    written last, so concurrent readers never see a half-added document.
+    """
+
+    FILES = ('text', 'text_offsets', 'names', 'name_offsets', 'categories', 'digests',
+             'timestamps', 'spans', 'span_offsets', 'chunks', 'chunk_offsets', 'signatures')
+
+    def __init__(self):
+        self.text = _Bytes()
+        self.text_offsets = _Column('q', array('q', [0]))
+        self.names = _Bytes()
+        self.name_offsets = _Column('q', array('q', [0]))
+        self.category_ids = _Column('i')          # index into category_names, -1 for none
+        self.category_names = []
+        self._category_lookup = {}
+        self.digests = _Bytes()
+        self.timestamps = _Column('q')            # microseconds since the epoch
+        self.spans = _Column('i')                 # SPAN_WIDTH ints per element
+        self.span_offsets = _Column('q', array('q', [0]))  # element index per document
+        self.chunks = _Column('i')                # start, end byte offsets per retrieval chunk
+        self.chunk_offsets = _Column('q', array('q', [0]))  # first chunk id per document
+        self.signatures = _Column('i')            # SIGNATURE_WIDTH ints per document
+        self.ids = {}       # doc_id -> script id, only for documents that have one
+        self.id_lookup = {}  # script id -> doc_id
+        self.metadata = {}  # doc_id -> metadata dict, only when non-empty
+        self.deleted = frozenset()  # tombstoned doc ids, replaced rather than mutated; their data stays in place
+        self._members = None  # category code -> sorted doc ids, built on first use
+        self._members_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.text_offsets) - 1
+
+    @property
+    def version(self):
+        """Tag for the store's contents, for validating listings with an ETag
+
+        Documents are only ever appended and tombstoned, in log order, so
+        the two counts name the same contents in every process, whether it
+        applied the log itself or opened a snapshot of it.
+        """
+        return f"{len(self)}.{len(self.deleted)}"
+
+    def __getitem__(self, doc_id):
+        if doc_id < 0:
+            doc_id += len(self)
+        if not 0 <= doc_id < len(self):
+            raise IndexError('document index out of range')
+        return Document(self, doc_id)
+
+    def __iter__(self):
+        for doc_id in range(len(self)):
+            yield Document(self, doc_id)
+
+    @property
+    def live_count(self):
+        """Documents that have not been deleted"""
+        return len(self) - len(self.deleted)
+
+    @property
+    def unmapped(self):
+        """Documents held in memory rather than in a mapped snapshot"""
+        return len(self.text_offsets.tail)
+
+    # Writing
+
+    def _intern_category(self, category):
+        if category is None:
+            return -1
+        code = self._category_lookup.get(category)
+        if code is None:
+            code = self._category_lookup[category] = len(self.category_names)
+            self.category_names.append(category)
+        return code
+
+    def append(self, content, filename=None, script_id=None, metadata=None, timestamp=None,
+               digest=None, spans=(), chunks=(), signature=None):
+        """Add a document and return its doc id
+
+        spans come from element_spans(), chunks from chunk_byte_spans() and
+        signature from dedup.minhash().
+        """
+        doc_id = len(self)
+        text = content.encode('utf-8')
+        name = (filename or '').encode('utf-8')
+
+        self.text.extend(text)
+        self.names.extend(name)
+        self.name_offsets.append(len(self.names))
+        self.category_ids.append(self._intern_category(category_of(filename)))
+        self.digests.extend(bytes.fromhex(digest) if digest else bytes(DIGEST_SIZE))
+        self.timestamps.append(_timestamp_micros(timestamp))
+        self.spans.extend(spans)
+        self.span_offsets.append(len(self.spans) // SPAN_WIDTH)
+        for start, end in chunks:
+            self.chunks.extend((start, end))
+        self.chunk_offsets.append(len(self.chunks) // 2)
+        self.signatures.extend(signature if signature is not None else _NO_SIGNATURE)
+        if metadata:
+            self.metadata[doc_id] = metadata
+        if script_id is not None:
+            self.ids[doc_id] = script_id
+            self.id_lookup[str(script_id)] = doc_id
+        # Publishes the document
+        self.text_offsets.append(len(self.text))
+        with self._members_lock:
+            if self._members is not None and self.category_ids[doc_id] >= 0:
+                self._members.setdefault(self.category_ids[doc_id], array('i')).append(doc_id)
+        return doc_id
+
+    def delete(self, doc_ids):
+        """Tombstone documents and return the doc ids that were live
+
+        A deleted document keeps its doc id and data, so chunk ids and
+        mapped columns never shift; it just stops being listed, looked up
+        by script id or counted in its category.
+        """
+        retired = sorted({doc_id for doc_id in doc_ids if 0 <= doc_id < len(self) and doc_id not in self.deleted})
+        if not retired:
+            return []
+        self.deleted = self.deleted.union(retired)
+        for doc_id in retired:
+            script_id = self.ids.get(doc_id)
+            if script_id is not None and self.id_lookup.get(str(script_id)) == doc_id:
+                del self.id_lookup[str(script_id)]
+            with self._members_lock:
+                code = self.category_ids[doc_id]
+                members = self._members.get(code) if self._members is not None else None
+                if members is not None:
+                    members.remove(doc_id)
+        return retired
+
+    # Reading
+
+    def is_deleted(self, doc_id):
+        return doc_id in self.deleted
+
+    def text_length(self, doc_id):
+        return self.text_offsets[doc_id + 1] - self.text_offsets[doc_id]
+
+    def text_bytes(self, doc_id):
+        return self.text.slice(self.text_offsets[doc_id], self.text_offsets[doc_id + 1])
+
+    def content(self, doc_id):
+        return self.text_bytes(doc_id).decode('utf-8')
+
+    def filename(self, doc_id):
+        name = self.names.slice(self.name_offsets[doc_id], self.name_offsets[doc_id + 1])
+        return name.decode('utf-8') or None
+
+    def category(self, doc_id):
+        code = self.category_ids[doc_id]
+        return self.category_names[code] if code >= 0 else None
+
+    def digest(self, doc_id):
+        digest = self.digests.slice(doc_id * DIGEST_SIZE, (doc_id + 1) * DIGEST_SIZE)
+        return digest.hex() if any(digest) else None
+
+    def timestamp(self, doc_id):
+        micros = self.timestamps[doc_id]
+        if micros == NO_TIMESTAMP:
+            return None
+        seconds, micros = divmod(micros, 1_000_000)
+        return datetime.fromtimestamp(seconds).replace(microsecond=micros).isoformat()
+
+    def signature(self, doc_id):
+        """A document's MinHash signature, or None when it was stored without one"""
+        signature = self.signatures.range(doc_id * SIGNATURE_WIDTH, (doc_id + 1) * SIGNATURE_WIDTH)
+        return signature if signature[0] != -1 else None
+
+    def lookup(self, script_id):
+        """Doc id for a script id, or None"""
+        return self.id_lookup.get(str(script_id))
+
+    def raw_spans(self, doc_id):
+        """A document's element spans as flat ints, SPAN_WIDTH per element (see SPAN_WIDTH)"""
+        first, last = self.span_offsets[doc_id], self.span_offsets[doc_id + 1]
+        return self.spans.range(first * SPAN_WIDTH, last * SPAN_WIDTH)
+
+    def span_text(self, doc_id, start, end):
+        """Text between two byte offsets of a document"""
+        base = self.text_offsets[doc_id]
+        return self.text.slice(base + start, base + end).decode('utf-8')
+
+    def elements(self, doc_id):
+        """collect_elements()-shaped dict rebuilt from the stored spans"""
+        collected = {bucket: [] for bucket in ELEMENT_BUCKETS}
+        spans = self.raw_spans(doc_id)
+        if not spans:
+            return collected
+        text = self.text_bytes(doc_id)
+        for i in range(0, len(spans), SPAN_WIDTH):
+            code, start, end, cue_start, cue_end = spans[i:i + SPAN_WIDTH]
+            cue = text[cue_start:cue_end].decode('utf-8') if cue_start >= 0 else None
+            collected[ELEMENT_BUCKETS[code]].append(
+                Element(BUCKET_KINDS[code], text[start:end].decode('utf-8'), start, end, cue))
+        return collected
+
+    def chunk_range(self, doc_id):
+        """range() of the chunk ids belonging to a document"""
+        return range(self.chunk_offsets[doc_id], self.chunk_offsets[doc_id + 1])
+
+    def chunk_document(self, chunk_id):
+        """Doc id that a chunk belongs to"""
+        return bisect_right(self.chunk_offsets, chunk_id) - 1
+
+    def chunk_span(self, chunk_id):
+        """(start, end) byte offsets of a chunk within its document"""
+        return self.chunks[chunk_id * 2], self.chunks[chunk_id * 2 + 1]
+
+    def chunk_text(self, chunk_id, doc_id=None):
+        """Stripped text of a chunk"""
+        if doc_id is None:
+            doc_id = self.chunk_document(chunk_id)
+        start, end = self.chunk_span(chunk_id)
+        base = self.text_offsets[doc_id]
+        return self.text.slice(base + start, base + end).decode('utf-8').strip()
+
+    def category_members(self, category):
+        """Sorted doc ids of one category"""
+        code = self._category_lookup.get(category)
+        if code is None:
+            return array('i')
+        with self._members_lock:
+            if self._members is None:
+                members = {}
+                for doc_id in range(len(self)):
+                    member_code = self.category_ids[doc_id]
+                    if member_code >= 0 and doc_id not in self.deleted:
+                        members.setdefault(member_code, array('i')).append(doc_id)
+                self._members = members
+            return self._members.get(code, array('i'))
+
+    def page(self, start=0, limit=50, category=None):
+        """One page of doc ids from start onward, optionally within a category
+
+        Returns (doc_ids, next_start, total); next_start is None on the last page.
+        """
+        if category is None and not self.deleted:
+            total = len(self)
+            stop = min(total, start + limit)
+            return list(range(start, stop)), (stop if stop < total else None), total
+        if category is None:
+            doc_ids = []
+            doc_id = start
+            while doc_id < len(self) and len(doc_ids) <= limit:
+                if doc_id not in self.deleted:
+                    doc_ids.append(doc_id)
+                doc_id += 1
+            following = doc_ids.pop() if len(doc_ids) > limit else None
+            return doc_ids, following, self.live_count
+
+        members = self.category_members(category)
+        first = bisect_left(members, start)
+        doc_ids = list(members[first:first + limit])
+        following = first + limit
+        return doc_ids, (members[following] if following < len(members) else None), len(members)
+
+    def categories(self):
+        """Document count per category"""
+        return {name: len(self.category_members(name)) for name in list(self.category_names)}
+
+    # Persistence
+
+    def save(self, directory, doc_count):
+        """Write the first doc_count documents as column files under directory"""
+        text_end = self.text_offsets[doc_count]
+        name_end = self.name_offsets[doc_count]
+        span_end = self.span_offsets[doc_count] * SPAN_WIDTH
+        chunk_end = self.chunk_offsets[doc_count] * 2
+        columns = {
+            'text': lambda f: self.text.write(f, text_end),
+            'text_offsets': lambda f: self.text_offsets.write(f, doc_count + 1),
+            'names': lambda f: self.names.write(f, name_end),
+            'name_offsets': lambda f: self.name_offsets.write(f, doc_count + 1),
+            'categories': lambda f: self.category_ids.write(f, doc_count),
+            'digests': lambda f: self.digests.write(f, doc_count * DIGEST_SIZE),
+            'timestamps': lambda f: self.timestamps.write(f, doc_count),
+            'spans': lambda f: self.spans.write(f, span_end),
+            'span_offsets': lambda f: self.span_offsets.write(f, doc_count + 1),
+            'chunks': lambda f: self.chunks.write(f, chunk_end),
+            'chunk_offsets': lambda f: self.chunk_offsets.write(f, doc_count + 1),
+            'signatures': lambda f: self.signatures.write(f, doc_count * SIGNATURE_WIDTH)
+        }
+        for name in self.FILES:
+            with open(os.path.join(directory, f"{name}.bin"), 'wb') as f:
+                columns[name](f)
+        with open(os.path.join(directory, 'documents.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'count': doc_count,
+                'categoryNames': self.category_names,
+                'ids': {str(doc_id): script_id for doc_id, script_id in self.ids.items() if doc_id < doc_count},
+                'metadata': {str(doc_id): meta for doc_id, meta in self.metadata.items() if doc_id < doc_count},
+                'deleted': sorted(doc_id for doc_id in self.deleted if doc_id < doc_count)
+            }, f)
+
+    @classmethod
+    def open(cls, directory):
+        """Map a saved store read-only; later appends go to in-memory tails"""
+        store = cls()
+
+        def mapped(name):
+            return _map_file(os.path.join(directory, f"{name}.bin"))
+
+        store.text = _Bytes(mapped('text'))
+        store.names = _Bytes(mapped('names'))
+        store.digests = _Bytes(mapped('digests'))
+        store.text_offsets = _Column('q', _int_view(mapped('text_offsets'), 'q'))
+        store.name_offsets = _Column('q', _int_view(mapped('name_offsets'), 'q'))
+        store.category_ids = _Column('i', _int_view(mapped('categories'), 'i'))
+        store.timestamps = _Column('q', _int_view(mapped('timestamps'), 'q'))
+        store.spans = _Column('i', _int_view(mapped('spans'), 'i'))
+        store.span_offsets = _Column('q', _int_view(mapped('span_offsets'), 'q'))
+        store.chunks = _Column('i', _int_view(mapped('chunks'), 'i'))
+        store.chunk_offsets = _Column('q', _int_view(mapped('chunk_offsets'), 'q'))
+        store.signatures = _Column('i', _int_view(mapped('signatures'), 'i'))
+
+        with open(os.path.join(directory, 'documents.json'), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        store.category_names = info['categoryNames']
+        store._category_lookup = {name: code for code, name in enumerate(store.category_names)}
+        store.ids = {int(doc_id): script_id for doc_id, script_id in info['ids'].items()}
+        store.metadata = {int(doc_id): meta for doc_id, meta in info['metadata'].items()}
+        store.deleted = frozenset(info.get('deleted', ()))
+        store.id_lookup = {str(script_id): doc_id for doc_id, script_id in store.ids.items()
+                           if doc_id not in store.deleted}
+        return store
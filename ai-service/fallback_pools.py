@@ -0,0 +1,286 @@
+"""
+Element pools for the training-data fallback, with process-stable selection
+
+Scene headings, dialogue pairs, action lines and plot beats are gathered
+once from the element spans stored at ingest, per training category
+(dialogue/, pacing/, plot_twists/, ...) and for the corpus as a whole. A
+pick is a couple of array reads indexed by a blake2 digest of the prompt,
+so the same prompt gets the same fallback on every worker and after every
+restart, and no screenplay parsing happens at request time.
+
+Pools are saved with each training store snapshot (fallback.* files) and
+mapped back on restore, so a restarted or reloaded worker only pools the
+documents added since the snapshot.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from cache import normalize_prompt
+from document_store import ELEMENT_BUCKETS, SPAN_WIDTH, _Column, _int_view, _map_file
+
+# Categories whose action lines read as story beats for outlines
+BEAT_CATEGORIES = frozenset({'plot_twists', 'tension_building', 'emotional_beats', 'character_development'})
+
+# Ints per pool entry: doc id, then start/end byte offsets of each piece
+ENTRY_WIDTHS = {
+    'scenes': 3,      # heading
+    'actions': 3,     # action line
+    'beats': 3,       # action line from a beat category
+    'dialogue': 9     # cue, line, answering cue, answering line
+}
+
+_SCENES = ELEMENT_BUCKETS.index('scenes')
+_DIALOGUE = ELEMENT_BUCKETS.index('dialogue')
+_DESCRIPTIONS = ELEMENT_BUCKETS.index('descriptions')
+
+# Used when the training data has nothing to offer for a slot
+CANNED = {
+    'scene_description': [
+        "A dimly lit room with shadows dancing on the walls",
+        "A bustling city street filled with the sounds of life",
+        "A quiet forest clearing where sunlight filters through leaves",
+        "A modern office building with floor-to-ceiling windows",
+        "A cozy coffee shop with the aroma of fresh brew"
+    ],
+    'dialogue': [
+        "I never thought it would come to this.",
+        "Sometimes the hardest choices are the right ones.",
+        "We all have our secrets, don't we?",
+        "The past has a way of catching up with us.",
+        "What if everything we know is wrong?"
+    ],
+    'response': [
+        "You don't understand what's at stake.",
+        "I wish it were that simple.",
+        "Maybe we're asking the wrong questions.",
+        "The truth is more complicated than that.",
+        "Some things are better left unsaid."
+    ],
+    'action_line': [
+        "Character looks out the window, lost in thought.",
+        "A moment of silence hangs heavy in the air.",
+        "Character paces back and forth, clearly agitated.",
+        "The tension in the room is palpable.",
+        "Character takes a deep breath, steeling themselves."
+    ],
+    'character': [
+        "A determined individual with a mysterious past",
+        "Someone who has seen too much and learned too little",
+        "A person caught between duty and desire",
+        "An outsider looking for their place in the world",
+        "A character with secrets that could change everything"
+    ],
+    'plot_point': [
+        "A discovery that changes everything",
+        "A betrayal that shatters trust",
+        "A choice that defines character",
+        "A revelation that explains the past",
+        "A decision that shapes the future"
+    ],
+    'themes': [
+        "Redemption and forgiveness",
+        "Truth versus lies",
+        "The price of ambition",
+        "Love and sacrifice",
+        "Identity and self-discovery"
+    ],
+    'genre': [
+        "Drama", "Thriller", "Romance", "Mystery", "Action"
+    ]
+}
+
+
+def stable_index(prompt, slot, count):
+    """Index in range(count) for a prompt and template slot, identical in every process"""
+    key = f"{slot}\0{normalize_prompt(prompt)}".encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big') % count
+
+
+def canned(prompt, slot, offset=0):
+    """Built-in line for a slot"""
+    options = CANNED[slot]
+    return options[(stable_index(prompt, slot, len(options)) + offset) % len(options)]
+
+
+class FallbackPools:
+    """Per-category and corpus-wide element pools over one DocumentStore
+
+    Pools only grow; refresh() adds documents appended since the last call
+    and rebuilds from scratch when the store itself was replaced (restores
+    instead adopt the pools saved with the snapshot; see open()). Each
+    document's entries are contiguous in its category's pools, so picks can
+    stay within the best-matching script before widening to its category.
+    Entries of deleted documents stay in place and picks step over them.
+    """
+
+    def __init__(self):
+        # (documents, pools, ranges), swapped as a whole so readers never mix stores:
+        # pools maps a category (None for the whole corpus) to kind -> flat entries,
+        # ranges maps kind -> (first, last) entry per doc within its category pool
+        self._state = (None, {}, {kind: _Column('q') for kind in ENTRY_WIDTHS})
+        self._lock = threading.Lock()
+
+    @property
+    def covered(self):
+        return len(self._state[2]['scenes']) // 2
+
+    def refresh(self, documents):
+        """Pool every document of documents that is not pooled yet"""
+        if documents is self._state[0] and self.covered == len(documents):
+            return
+        with self._lock:
+            state = self._state
+            if documents is not state[0]:
+                state = (documents, {}, {kind: _Column('q') for kind in ENTRY_WIDTHS})
+                for doc_id in range(len(documents)):
+                    self._add(state, doc_id)
+                self._state = state
+            else:
+                for doc_id in range(self.covered, len(documents)):
+                    self._add(state, doc_id)
+
+    @staticmethod
+    def _pool(pools, category):
+        pool = pools.get(category)
+        if pool is None:
+            pool = pools[category] = {kind: _Column('q') for kind in ENTRY_WIDTHS}
+        return pool
+
+    def _add(self, state, doc_id):
+        documents, pools, ranges = state
+        category = documents.category(doc_id)
+        entries = {kind: [] for kind in ENTRY_WIDTHS}
+        spans = documents.raw_spans(doc_id)
+        previous_line = None
+        for i in range(0, len(spans), SPAN_WIDTH):
+            code, start, end, cue_start, cue_end = spans[i:i + SPAN_WIDTH]
+            if code == _SCENES:
+                entries['scenes'].append((doc_id, start, end))
+            elif code == _DESCRIPTIONS:
+                entries['actions'].append((doc_id, start, end))
+                if category in BEAT_CATEGORIES:
+                    entries['beats'].append((doc_id, start, end))
+            elif code == _DIALOGUE and cue_start >= 0:
+                line = (cue_start, cue_end, start, end)
+                if previous_line is not None:
+                    entries['dialogue'].append((doc_id,) + previous_line + line)
+                previous_line = line
+
+        # Uncategorised documents only go into the corpus-wide pool
+        category_pool = self._pool(pools, category)
+        corpus_pool = self._pool(pools, None) if category is not None else None
+        # Entries go in before the doc's range is published, so readers never see a dangling range
+        for kind, width in ENTRY_WIDTHS.items():
+            first = len(category_pool[kind]) // width
+            for entry in entries[kind]:
+                category_pool[kind].extend(entry)
+                if corpus_pool is not None:
+                    corpus_pool[kind].extend(entry)
+            entries[kind] = (first, first + len(entries[kind]))
+        for kind in ENTRY_WIDTHS:
+            ranges[kind].extend(entries[kind])
+
+    def pick(self, prompt, slot, kind, doc_id=None, offset=0):
+        """Texts of one pool entry for a template slot, or None when there are none
+
+        Looks in the best-matching document first, then its category, then
+        the whole corpus. offset steps to neighbouring entries so several
+        slots drawing on the same pool get different lines.
+        """
+        documents, pools, ranges = self._state
+        width = ENTRY_WIDTHS[kind]
+        candidates = []
+        if doc_id is not None and doc_id * 2 < len(ranges[kind]):
+            pool = pools[documents.category(doc_id)][kind]
+            first, last = ranges[kind].range(doc_id * 2, doc_id * 2 + 2)
+            candidates.append((pool, first, last))
+            candidates.append((pool, 0, len(pool) // width))
+        if None in pools:
+            pool = pools[None][kind]
+            candidates.append((pool, 0, len(pool) // width))
+
+        deleted = documents.deleted if documents is not None else ()
+        for pool, first, last in candidates:
+            count = last - first
+            if count <= 0:
+                continue
+            start = stable_index(prompt, slot, count) + offset
+            for step in range(count):
+                index = first + (start + step) % count
+                entry = pool.range(index * width, (index + 1) * width)
+                if entry[0] not in deleted:
+                    return tuple(documents.span_text(entry[0], entry[i], entry[i + 1]).strip()
+                                 for i in range(1, width, 2))
+        return None
+
+    def save(self, directory, documents, doc_count):
+        """Write the pools of documents[0:doc_count] as fallback.* files under directory
+
+        Returns False, writing nothing, if documents stopped being the
+        current store meanwhile; a restore then pools from scratch.
+        """
+        self.refresh(documents)
+        with self._lock:
+            state = self._state
+        if state[0] is not documents:
+            return False
+        _, pools, ranges = state
+        categories = list(pools)
+        # Pools only grow, and entries of documents past doc_count form the tail of each pool
+        ends = {category: {kind: len(pools[category][kind]) // width for kind, width in ENTRY_WIDTHS.items()}
+                for category in categories}
+        for doc_id in range(doc_count, len(ranges['scenes']) // 2):
+            category = documents.category(doc_id)
+            for kind in ENTRY_WIDTHS:
+                first, last = ranges[kind].range(doc_id * 2, doc_id * 2 + 2)
+                ends[category][kind] -= last - first
+                if category is not None:
+                    ends[None][kind] -= last - first
+
+        offsets = {}
+        for kind, width in ENTRY_WIDTHS.items():
+            offsets[kind] = []
+            position = 0
+            with open(os.path.join(directory, f"fallback.{kind}.bin"), 'wb') as f:
+                for category in categories:
+                    count = ends[category][kind] * width
+                    pools[category][kind].write(f, count)
+                    offsets[kind].append([position, position + count])
+                    position += count
+            with open(os.path.join(directory, f"fallback.{kind}.ranges.bin"), 'wb') as f:
+                ranges[kind].write(f, doc_count * 2)
+        with open(os.path.join(directory, 'fallback.json'), 'w', encoding='utf-8') as f:
+            json.dump({'documents': doc_count, 'categories': categories, 'offsets': offsets}, f)
+        return True
+
+    @classmethod
+    def open(cls, directory, documents):
+        """Pools saved under directory for documents (mapped read-only), or None if there are none"""
+        try:
+            with open(os.path.join(directory, 'fallback.json'), 'r', encoding='utf-8') as f:
+                info = json.load(f)
+        except OSError:
+            return None
+        pools = {}
+        ranges = {}
+        for kind in ENTRY_WIDTHS:
+            entries = _int_view(_map_file(os.path.join(directory, f"fallback.{kind}.bin")), 'q')
+            for category, (start, stop) in zip(info['categories'], info['offsets'][kind]):
+                cls._pool(pools, category)[kind] = _Column('q', entries[start:stop])
+            ranges[kind] = _Column('q', _int_view(_map_file(os.path.join(directory, f"fallback.{kind}.ranges.bin")),
+                                                  'q'))
+        fallback_pools = cls()
+        fallback_pools._state = (documents, pools, ranges)
+        return fallback_pools
+
+    def stats(self):
+        documents, pools, ranges = self._state
+        corpus = pools.get(None)
+        return {
+            'documents': self.covered,
+            'categories': len(pools) - (corpus is not None),
+            'entries': {kind: len(corpus[kind]) // width if corpus else 0 for kind, width in ENTRY_WIDTHS.items()}
+        }
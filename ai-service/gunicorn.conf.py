@@ -0,0 +1,76 @@
+"""
+Gunicorn settings for the AI service
+
+    gunicorn -c gunicorn.conf.py app:app
+
+With GUNICORN_PRELOAD on (the default) the master imports the app once
+and freezes its heap, then forks workers straight away. Each worker loads
+the corpus in the background and serves from what it has indexed so far,
+with /ready answering 503 until it is done. Workers open the same
+memory-mapped store snapshot, so they share its corpus text and index
+pages through the page cache, and per-worker memory stays roughly flat
+as workers are added.
+
+Workers share /metrics through files in METRICS_DIR, cleared when the
+server starts. One worker at a time watches the training directory and
+reloads edited files (see training_watcher.py); the others follow the
+store log.
+"""
+
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from admission import ADMISSION_CONCURRENCY, ADMISSION_QUEUE_LIMIT
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8001)}"
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+# Threads keep slow upstream calls and SSE streams from pinning a whole worker. Every
+# admitted or queued generation holds one, so by default there are enough for all of them
+# plus GUNICORN_RESERVED_THREADS left over for health checks, metrics and listings.
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', ADMISSION_CONCURRENCY + ADMISSION_QUEUE_LIMIT +
+                        int(os.getenv('GUNICORN_RESERVED_THREADS', 8))))
+# Longer than GENERATION_DEADLINE_MS so the latency budget, not gunicorn, ends slow requests
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() not in ('0', 'false', 'no')
+if preload_app:
+    # The master must not start warmup threads: they would not survive the fork (see app.py)
+    os.environ['WARMUP_AFTER_FORK'] = 'true'
+
+# Set before the app is imported so every worker's registry merges through it (see metrics.py)
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f"ai-service-metrics-{os.getenv('PORT', 8001)}"))
+
+
+def on_starting(server):
+    """Drop metric files of a previous run so counters start from zero"""
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+
+
+def child_exit(server, worker):
+    """Keep an exited worker's counters in the totals but drop its gauges"""
+    from metrics import registry
+    registry.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    """Runs in the master after the preloaded app is imported, before any worker forks"""
+    if not preload_app:
+        return
+    # Keep the collector from touching (and so un-sharing) pages of the imported modules
+    gc.collect()
+    gc.freeze()
+    server.log.info(f"Preloaded the app; {gc.get_freeze_count()} objects frozen")
+
+
+def post_worker_init(worker):
+    """Start the corpus warmup and the training directory watch; threads don't survive the fork,
+    and one worker ends up watching"""
+    from app import script_generator
+    script_generator.start_warmup()
+    script_generator.watcher.start()
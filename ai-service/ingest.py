@@ -0,0 +1,264 @@
+"""
+Turning training items into stored records, one at a time or as a bulk stream
+
+A record is everything stored about a document: its fields, element spans
+and retrieval chunks with their term counts. Building one is the CPU-heavy
+part of training, so bulk uploads build records in a process pool while
+the request thread keeps reading the upload, and commit them in batches.
+At most a few batches are held at once, so memory tracks the batch size
+rather than the upload size.
+"""
+
+import json
+import multiprocessing
+import os
+import tarfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from cache import content_digest
+from dedup import minhash
+from document_store import chunk_byte_spans, element_spans
+from retrieval import term_counts
+from screenplay import chunk_spans, collect_elements
+
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', 64))
+BULK_BATCH_BYTES = int(os.getenv('BULK_BATCH_BYTES', 16 * 1024 * 1024))
+BULK_MAX_DOCUMENT_BYTES = int(os.getenv('BULK_MAX_DOCUMENT_BYTES', 16 * 1024 * 1024))
+# 0 uses one process per core
+BULK_WORKERS = int(os.getenv('BULK_WORKERS', 0))
+# Seconds between progress lines in a bulk response
+BULK_PROGRESS_SECONDS = float(os.getenv('BULK_PROGRESS_SECONDS', 1.0))
+# Errors listed in the summary; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+
+def parse_elements(content):
+    """Run the screenplay tokenizer with the caps used for training elements"""
+    return collect_elements(content, scenes=10, characters=20, dialogue=15, descriptions=10)
+
+
+def training_record(item, collected=None):
+    """Everything stored about a new item: its fields, element spans, chunks with their term counts
+    and MinHash signature"""
+    content = item['content']
+    digest = item.get('digest') or content_digest(content)
+    if collected is None:
+        collected = parse_elements(content)
+    spans = chunk_spans(content)
+    chunks = [
+        [start, end, term_counts(content[char_start:char_end])]
+        for (start, end), (char_start, char_end) in zip(chunk_byte_spans(content, spans), spans)
+    ]
+    signature = minhash(content)
+    return {
+        'item': {
+            'content': content,
+            'filename': item.get('filename'),
+            'id': item.get('id'),
+            'metadata': item.get('metadata') or {},
+            'timestamp': item.get('timestamp'),
+            'digest': digest
+        },
+        'spans': element_spans(content, collected),
+        'chunks': chunks,
+        'signature': signature.tolist() if signature is not None else None
+    }
+
+
+def _build_records(items):
+    """Pool task: records for a batch, without the content the parent already holds"""
+    records = []
+    for item in items:
+        record = training_record(item)
+        del record['item']['content']
+        records.append(record)
+    return records
+
+
+def bulk_item(data, source):
+    """Training item from one uploaded entry, or raise ValueError"""
+    if not isinstance(data, dict) or not isinstance(data.get('content'), str) or not data['content'].strip():
+        raise ValueError(f"{source}: content is required")
+    metadata = data.get('metadata') or {}
+    if not isinstance(metadata, dict):
+        raise ValueError(f"{source}: metadata must be an object")
+    script_id = data.get('id', data.get('scriptId'))
+    return {
+        'content': data['content'],
+        'filename': data.get('filename'),
+        'id': str(script_id) if script_id is not None else None,
+        'metadata': metadata,
+        'timestamp': data.get('timestamp') or datetime.now().isoformat()
+    }
+
+
+def read_ndjson(stream, max_bytes=BULK_MAX_DOCUMENT_BYTES):
+    """Yield an item or a ValueError per line of an NDJSON stream, reading one line at a time"""
+    line_number = 0
+    while True:
+        line = stream.readline(max_bytes + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > max_bytes and not line.endswith(b'\n'):
+            # Skip the rest of the oversized line without holding it
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_bytes + 1)
+            yield ValueError(f"line {line_number}: document larger than {max_bytes} bytes")
+            continue
+        if not line.strip():
+            continue
+        try:
+            entry = bulk_item(json.loads(line), f"line {line_number}")
+        except json.JSONDecodeError:
+            entry = ValueError(f"line {line_number}: invalid JSON")
+        except ValueError as e:
+            entry = e
+        yield entry
+
+
+def read_tar(stream, max_bytes=BULK_MAX_DOCUMENT_BYTES):
+    """Yield an item or a ValueError per .txt file of a (possibly compressed) tar stream"""
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith('.txt'):
+                continue
+            name = member.name[2:] if member.name.startswith('./') else member.name
+            if member.size > max_bytes:
+                yield ValueError(f"{name}: document larger than {max_bytes} bytes")
+                continue
+            content = archive.extractfile(member).read().decode('utf-8', errors='replace')
+            try:
+                entry = bulk_item({'content': content, 'filename': name}, name)
+            except ValueError as e:
+                entry = e
+            yield entry
+
+
+class BulkIngester:
+    """Process pool that builds training records for bulk uploads"""
+
+    def __init__(self, workers=BULK_WORKERS):
+        self.workers = workers or os.cpu_count() or 1
+        self.active = 0
+        self.documents = 0
+        self.failed = 0
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        # Workers fork from a forkserver that only imports this module: forking the service
+        # itself from a request thread could copy a lock another thread holds (numpy's import
+        # lock, say) into a child that never releases it, and spawn would re-run the app module
+        pid = os.getpid()
+        if self._pool is None or self._pool_pid != pid:
+            with self._lock:
+                if self._pool is None or self._pool_pid != pid:
+                    context = multiprocessing.get_context('forkserver')
+                    context.set_forkserver_preload([__name__])
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                    self._pool_pid = pid
+        return self._pool
+
+    def run(self, entries, commit, batch_size=BULK_BATCH_SIZE, batch_bytes=BULK_BATCH_BYTES):
+        """Build and commit records for entries, yielding progress dicts and then a summary
+
+        entries yields items or ValueErrors (rejected entries). commit
+        receives each batch's records in upload order and returns their doc
+        ids (None where the dedup policy rejected one) and near-duplicate
+        matches. Batches beyond a couple per worker wait for the oldest to
+        commit, which bounds memory.
+        """
+        started = time.monotonic()
+        totals = {'documents': 0, 'failed': 0, 'duplicates': 0, 'bytes': 0, 'batches': 0}
+        errors = []
+        pending = deque()  # (future, items)
+        max_pending = 2 * self.workers
+        last_progress = started
+
+        def reject(message):
+            totals['failed'] += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append(message)
+
+        def commit_oldest():
+            future, items = pending.popleft()
+            try:
+                records = future.result()
+            except Exception as e:
+                for _ in items:
+                    reject(f"batch {totals['batches'] + 1}: {e}")
+                totals['batches'] += 1
+                return
+            for item, record in zip(items, records):
+                record['item']['content'] = item['content']
+            doc_ids, duplicates = commit(records)
+            for item, doc_id, duplicate in zip(items, doc_ids, duplicates):
+                if duplicate is not None:
+                    totals['duplicates'] += 1
+                if doc_id is None:
+                    reject(f"{item.get('filename') or item.get('id') or 'document'}: "
+                           f"near-duplicate of document {duplicate['docId']}")
+                else:
+                    totals['documents'] += 1
+            totals['batches'] += 1
+
+        def progress():
+            elapsed = time.monotonic() - started
+            return dict(totals, seconds=round(elapsed, 3),
+                        documentsPerSecond=round(totals['documents'] / elapsed, 1) if elapsed else 0.0)
+
+        with self._lock:
+            self.active += 1
+        try:
+            batch, size = [], 0
+            for entry in entries:
+                if isinstance(entry, ValueError):
+                    reject(str(entry))
+                    continue
+                batch.append(entry)
+                size += len(entry['content'])
+                if len(batch) < batch_size and size < batch_bytes:
+                    continue
+                pending.append((self._executor().submit(_build_records, batch), batch))
+                totals['bytes'] += size
+                batch, size = [], 0
+                while len(pending) >= max_pending or (pending and pending[0][0].done()):
+                    commit_oldest()
+                if time.monotonic() - last_progress >= BULK_PROGRESS_SECONDS:
+                    last_progress = time.monotonic()
+                    yield {'progress': progress()}
+            if batch:
+                pending.append((self._executor().submit(_build_records, batch), batch))
+                totals['bytes'] += size
+            while pending:
+                commit_oldest()
+        finally:
+            # Nothing left to commit to if the upload broke off; let queued batches go
+            for future, _ in pending:
+                future.cancel()
+            with self._lock:
+                self.active -= 1
+                self.documents += totals['documents']
+                self.failed += totals['failed']
+        yield dict(progress(), done=True, errors=errors)
+
+    def close(self):
+        """Shut the process pool down; the next run starts a new one"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and self._pool_pid == os.getpid():
+            pool.shutdown()
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'documents': self.documents,
+            'failed': self.failed
+        }
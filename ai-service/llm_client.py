@@ -0,0 +1,390 @@
+"""
+HTTP client for OpenAI-compatible chat-completions APIs
+
+One async keep-alive session per process on its own event loop thread, a
+cap on concurrent upstream requests and jittered retries on 429/5xx. Sync
+callers (request threads, the upstream guard's executor) submit calls to
+that loop, so one process keeps many generations in flight on a handful
+of sockets. Each call has one deadline that covers waiting for a slot,
+every attempt and the backoff between them.
+Point OPENAI_BASE_URL at a local stub server to run without the real API.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+# Imported by the first client that is built, so importing the service doesn't pay for it
+httpx = None
+
+LLM_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', 5))
+LLM_READ_TIMEOUT = float(os.getenv('LLM_READ_TIMEOUT', 60))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 16))
+LLM_POOL_SIZE = int(os.getenv('LLM_POOL_SIZE', LLM_MAX_CONCURRENCY))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', 0.5))
+LLM_BACKOFF_CAP = float(os.getenv('LLM_BACKOFF_CAP', 8))
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# How often a sync caller waiting on the loop checks whether its call was abandoned
+_CANCEL_POLL_SECONDS = 0.05
+
+
+def _import_httpx():
+    global httpx
+    if httpx is None:
+        import httpx as module
+        httpx = module
+
+
+class LLMError(Exception):
+    """Upstream call failed after retries; status is None for transport errors"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def completion_text(response):
+    """Message text from a chat-completions response body"""
+    return response['choices'][0]['message']['content']
+
+
+_SSE_DONE = object()
+
+
+def _sse_piece(line):
+    """Content delta of one streamed line, None if it carries none, or _SSE_DONE at the end"""
+    if not line.startswith('data:'):
+        return None
+    data = line[5:].strip()
+    if data == '[DONE]':
+        return _SSE_DONE
+    try:
+        chunk = json.loads(data)
+    except ValueError:
+        return None
+    choices = chunk.get('choices') or [{}]
+    return (choices[0].get('delta') or {}).get('content') or None
+
+
+def parse_sse_lines(lines):
+    """Content deltas from the data: lines of a streamed chat completion"""
+    for line in lines:
+        piece = _sse_piece(line)
+        if piece is _SSE_DONE:
+            return
+        if piece:
+            yield piece
+
+
+class LLMClient:
+    """Pooled async client for /chat/completions with a sync front end"""
+
+    def __init__(self, api_key, base_url=LLM_BASE_URL, connect_timeout=LLM_CONNECT_TIMEOUT,
+                 read_timeout=LLM_READ_TIMEOUT, max_concurrency=LLM_MAX_CONCURRENCY,
+                 pool_size=LLM_POOL_SIZE, max_retries=LLM_MAX_RETRIES, transport=None):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        # httpx transport override, e.g. httpx.MockTransport in tests
+        self.transport = transport
+        self.in_flight = 0
+        # Token counts reported by the API (streamed completions don't report any)
+        self.usage = {'prompt': 0, 'completion': 0}
+        self.last_usage = {'prompt': 0, 'completion': 0}
+        self._lock = threading.Lock()
+        # Event loop, AsyncClient and slot semaphore of the process that started them
+        self._loop = None
+        self._client = None
+        self._semaphore = None
+        self._loop_pid = None
+
+    # Setup
+
+    def _headers(self):
+        return {
+            'Authorization': f"Bearer {self.api_key}",
+            'Content-Type': 'application/json'
+        }
+
+    def _timeout(self, read_timeout=None):
+        read = self.read_timeout if read_timeout is None else read_timeout
+        return httpx.Timeout(read, connect=min(self.connect_timeout, read))
+
+    def _limits(self):
+        return httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+
+    def _event_loop(self):
+        """This process's client event loop, started on a daemon thread on first use"""
+        # Neither the loop thread nor its connections survive a fork, so each process starts its own
+        pid = os.getpid()
+        if self._loop_pid != pid:
+            with self._lock:
+                if self._loop_pid != pid:
+                    _import_httpx()
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='llm-client', daemon=True).start()
+                    asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+                    self._loop = loop
+                    self._loop_pid = pid
+        return self._loop
+
+    async def _open(self):
+        # Built on the loop itself: on older Pythons asyncio primitives bind to the loop they are made on
+        self._client = httpx.AsyncClient(base_url=self.base_url, headers=self._headers(), timeout=self._timeout(),
+                                         limits=self._limits(), transport=self.transport)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def close(self):
+        """Close the connection pool and stop the event loop"""
+        with self._lock:
+            loop, self._loop, self._loop_pid = self._loop, None, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    def _run(self, coroutine, cancel=None):
+        """Run a coroutine on the client loop and wait for its result
+
+        Once cancel is set, or the caller stops waiting for any other
+        reason, the coroutine is cancelled too, giving back its slot and
+        connection instead of finishing for nobody.
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._event_loop())
+        try:
+            if cancel is None:
+                return future.result()
+            while True:
+                try:
+                    return future.result(timeout=_CANCEL_POLL_SECONDS)
+                except concurrent.futures.TimeoutError:
+                    self._check_cancelled(cancel)
+        finally:
+            future.cancel()
+
+    async def _acquire_slot(self, expires_at, cancel=None):
+        """Take one of the max_concurrency upstream slots, waiting no longer than the call's budget"""
+        self._check_cancelled(cancel)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self._remaining(expires_at))
+        except asyncio.TimeoutError:
+            raise LLMError('Upstream concurrency limit reached before the call ran out of time') from None
+        if cancel is not None and cancel.is_set():
+            self._semaphore.release()
+            self._check_cancelled(cancel)
+        with self._lock:
+            self.in_flight += 1
+
+    def _release_slot(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+
+    def _record_usage(self, body):
+        usage = body.get('usage') or {}
+        last = {'prompt': usage.get('prompt_tokens') or 0, 'completion': usage.get('completion_tokens') or 0}
+        with self._lock:
+            for kind, tokens in last.items():
+                self.usage[kind] += tokens
+            self.last_usage = last
+        return body
+
+    # Retry policy
+
+    def _backoff(self, attempt, response=None):
+        """Full-jitter exponential backoff, honouring Retry-After when given"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after:
+                try:
+                    return min(float(retry_after), LLM_BACKOFF_CAP)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(LLM_BACKOFF_CAP, LLM_BACKOFF_BASE * (2 ** attempt)))
+
+    def _should_retry(self, attempt, status=None):
+        return attempt < self.max_retries and (status is None or status in RETRY_STATUSES)
+
+    def _expires_at(self, timeout):
+        return time.monotonic() + (self.read_timeout if timeout is None else timeout)
+
+    @staticmethod
+    def _remaining(expires_at):
+        """Seconds left of a call's budget, raising once it is spent"""
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            raise LLMError('Upstream call ran out of time')
+        return remaining
+
+    @staticmethod
+    def _check_cancelled(cancel):
+        if cancel is not None and cancel.is_set():
+            raise LLMError('Upstream call abandoned by its caller')
+
+    @classmethod
+    async def _wait_to_retry(cls, delay, expires_at, error, cancel=None):
+        """Sleep before the next attempt, or raise error if the budget ends first"""
+        if time.monotonic() + delay >= expires_at:
+            raise error
+        await asyncio.sleep(delay)
+        cls._check_cancelled(cancel)
+
+    def _payload(self, messages, model, max_tokens, temperature, stream=False):
+        payload = {
+            'model': model,
+            'messages': messages,
+            'max_tokens': max_tokens,
+            'temperature': temperature
+        }
+        if stream:
+            payload['stream'] = True
+        return payload
+
+    # Async API, run on the client loop (see _run)
+
+    async def achat_completion(self, messages, model, max_tokens, temperature, timeout=None, cancel=None):
+        """POST /chat/completions and return the decoded response body
+
+        timeout (read_timeout by default) bounds the whole call: waiting for
+        a concurrency slot, every attempt and the backoff between them.
+        cancel is an optional threading.Event; once it is set the call stops
+        before taking a slot or making another attempt.
+        """
+        payload = self._payload(messages, model, max_tokens, temperature)
+        expires_at = self._expires_at(timeout)
+        attempt = 0
+        await self._acquire_slot(expires_at, cancel)
+        try:
+            while True:
+                remaining = self._remaining(expires_at)
+                try:
+                    response = await asyncio.wait_for(
+                        self._client.post('/chat/completions', json=payload, timeout=self._timeout(remaining)),
+                        remaining)
+                except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                    error = LLMError(f"Upstream connection failed: {e}")
+                    if not self._should_retry(attempt):
+                        raise error from e
+                    await self._wait_to_retry(self._backoff(attempt), expires_at, error, cancel)
+                    attempt += 1
+                    continue
+                except (httpx.TimeoutException, asyncio.TimeoutError) as e:
+                    raise LLMError(f"Upstream timed out: {e}") from e
+
+                if response.status_code == 200:
+                    return self._record_usage(response.json())
+                error = LLMError(f"Upstream returned {response.status_code}: {response.text[:200]}",
+                                 response.status_code)
+                if not self._should_retry(attempt, response.status_code):
+                    raise error
+                await self._wait_to_retry(self._backoff(attempt, response), expires_at, error, cancel)
+                attempt += 1
+        finally:
+            self._release_slot()
+
+    async def acomplete(self, messages, model, max_tokens, temperature, timeout=None, cancel=None):
+        """Generated text for a chat prompt"""
+        return completion_text(await self.achat_completion(messages, model, max_tokens, temperature, timeout, cancel))
+
+    async def astream_complete(self, messages, model, max_tokens, temperature, timeout=None):
+        """Yield text deltas of a streamed completion
+
+        Retries happen only before the first byte, within the same overall
+        budget as achat_completion; once text has been handed out a failure
+        is raised to the caller.
+        """
+        payload = self._payload(messages, model, max_tokens, temperature, stream=True)
+        expires_at = self._expires_at(timeout)
+        attempt = 0
+        await self._acquire_slot(expires_at)
+        try:
+            while True:
+                try:
+                    async with self._client.stream('POST', '/chat/completions', json=payload,
+                                                   timeout=self._timeout(self._remaining(expires_at))) as response:
+                        if response.status_code == 200:
+                            async for line in response.aiter_lines():
+                                piece = _sse_piece(line)
+                                if piece is _SSE_DONE:
+                                    return
+                                if piece:
+                                    yield piece
+                            return
+                        await response.aread()
+                        status = response.status_code
+                        error = LLMError(f"Upstream returned {status}: {response.text[:200]}", status)
+                        if not self._should_retry(attempt, status):
+                            raise error
+                        delay = self._backoff(attempt, response)
+                except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                    error = LLMError(f"Upstream connection failed: {e}")
+                    if not self._should_retry(attempt):
+                        raise error from e
+                    delay = self._backoff(attempt)
+                except httpx.HTTPError as e:
+                    raise LLMError(f"Upstream stream failed: {e}") from e
+                await self._wait_to_retry(delay, expires_at, error)
+                attempt += 1
+        finally:
+            self._release_slot()
+
+    # Sync API
+
+    def chat_completion(self, messages, model, max_tokens, temperature, timeout=None, cancel=None):
+        """Blocking achat_completion()"""
+        return self._run(self.achat_completion(messages, model, max_tokens, temperature, timeout, cancel), cancel)
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None, cancel=None):
+        """Generated text for a chat prompt"""
+        return completion_text(self.chat_completion(messages, model, max_tokens, temperature, timeout, cancel))
+
+    def stream_complete(self, messages, model, max_tokens, temperature, timeout=None):
+        """Blocking astream_complete(); closing the generator cancels the upstream stream"""
+        pieces = queue.Queue()
+
+        async def pump():
+            try:
+                async for piece in self.astream_complete(messages, model, max_tokens, temperature, timeout):
+                    pieces.put(piece)
+            except Exception as e:
+                pieces.put(e)
+            else:
+                pieces.put(None)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._event_loop())
+        try:
+            while True:
+                piece = pieces.get()
+                if piece is None:
+                    return
+                if isinstance(piece, Exception):
+                    raise piece
+                yield piece
+        finally:
+            future.cancel()
+
+    def stats(self):
+        """Pool and concurrency settings for health reporting"""
+        return {
+            'baseUrl': self.base_url,
+            'inFlight': self.in_flight,
+            'maxConcurrency': self.max_concurrency,
+            'connectTimeout': self.connect_timeout,
+            'readTimeout': self.read_timeout,
+            'maxRetries': self.max_retries,
+            'usage': dict(self.usage),
+            'lastUsage': dict(self.last_usage)
+        }
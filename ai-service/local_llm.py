@@ -0,0 +1,417 @@
+"""
+Local causal-LM generation on CPU with dynamic request batching
+
+A drop-in for LLMClient (complete / stream_complete / stats / close) that
+runs a Hugging Face model from a local directory, so generation works
+on-prem and in load tests without any network dependency. Concurrent
+requests are queued and grouped into one batched generate() call within a
+short wait window, and the key/value cache of the prompt prefix every
+request shares (the chat template header and the fixed part of the system
+prompt) is computed once and reused.
+
+torch and transformers are imported on first use, so the API backend never
+pays for them.
+"""
+
+import os
+import queue
+import threading
+import time
+
+from llm_client import LLMError
+
+LOCAL_MODEL_DIR = os.getenv('LOCAL_MODEL_DIR', os.path.join(os.path.dirname(__file__), 'models', 'local'))
+LOCAL_LLM_MAX_BATCH = int(os.getenv('LOCAL_LLM_MAX_BATCH', 8))
+LOCAL_LLM_BATCH_WAIT_MS = float(os.getenv('LOCAL_LLM_BATCH_WAIT_MS', 10))
+# 0 leaves torch's default (one thread per core)
+LOCAL_LLM_THREADS = int(os.getenv('LOCAL_LLM_THREADS', 0))
+LOCAL_LLM_PREFIX_CACHE = os.getenv('LOCAL_LLM_PREFIX_CACHE', 'true').lower() in ('1', 'true', 'yes')
+# Shorter shared prefixes are not worth a separate forward pass
+PREFIX_MIN_TOKENS = 16
+
+
+def common_prefix_length(sequences):
+    """Length of the longest prefix shared by every token sequence"""
+    sequences = list(sequences)
+    if not sequences:
+        return 0
+    shortest = min(len(s) for s in sequences)
+    first = sequences[0]
+    for i in range(shortest):
+        token = first[i]
+        if any(s[i] != token for s in sequences):
+            return i
+    return shortest
+
+
+def render_chat(messages):
+    """Plain-text prompt for tokenizers without a chat template"""
+    lines = [f"{m['role'].capitalize()}: {m['content']}" for m in messages]
+    return "\n\n".join(lines) + "\n\nAssistant:"
+
+
+class _Request:
+    """One queued generation; text arrives through pieces as it is produced"""
+
+    def __init__(self, messages, max_tokens, temperature, timeout):
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.expires_at = time.monotonic() + timeout
+        self.pieces = queue.Queue()
+        self.text = ''
+        self.error = None
+        self.done = threading.Event()
+        self.cancelled = False
+
+    def expired(self):
+        return self.cancelled or time.monotonic() >= self.expires_at
+
+    def emit(self, text):
+        # A trailing replacement character is a multi-byte character still being decoded
+        if len(text) > len(self.text) and not text.endswith('\ufffd'):
+            self.pieces.put(text[len(self.text):])
+            self.text = text
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+        self.pieces.put(None)
+
+
+class LocalLLM:
+    """Batched local generation behind the LLMClient interface"""
+
+    def __init__(self, model_dir=LOCAL_MODEL_DIR, max_batch=LOCAL_LLM_MAX_BATCH,
+                 batch_wait_ms=LOCAL_LLM_BATCH_WAIT_MS, threads=LOCAL_LLM_THREADS,
+                 prefix_cache=LOCAL_LLM_PREFIX_CACHE):
+        self.model_dir = model_dir
+        self.max_batch = max(1, max_batch)
+        self.batch_wait = batch_wait_ms / 1000.0
+        self.threads = threads
+        self.prefix_cache = prefix_cache
+        self.in_flight = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.prefix_hits = 0
+        # Token counts, in the same shape LLMClient reports
+        self.usage = {'prompt': 0, 'completion': 0}
+        self.last_usage = {'prompt': 0, 'completion': 0}
+        self.load_error = None
+        self._model = None
+        self._tokenizer = None
+        self._torch = None
+        self._prefix = None  # (token ids, past key values)
+        self._last_ids = None
+        self._queue = None
+        self._worker_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        """Whether a model directory is configured and present"""
+        return os.path.isfile(os.path.join(self.model_dir, 'config.json'))
+
+    # Setup
+
+    def _load(self):
+        """Load the tokenizer and model; runs on the batching thread"""
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if self.threads > 0:
+            torch.set_num_threads(self.threads)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+        # Prompts are left-padded so every row's next token lines up at the end
+        tokenizer.padding_side = 'left'
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained(self.model_dir, torch_dtype=torch.float32)
+        model.eval()
+        self._torch, self._tokenizer, self._model = torch, tokenizer, model
+        print(f"Local model loaded from {self.model_dir}")
+
+    def _requests(self):
+        # Threads don't survive a fork, so each process starts its own batching thread
+        pid = os.getpid()
+        if self._queue is None or self._worker_pid != pid:
+            with self._lock:
+                if self._queue is None or self._worker_pid != pid:
+                    self._queue = queue.Queue()
+                    self._prefix = None
+                    self._last_ids = None
+                    threading.Thread(target=self._run, args=(self._queue,), daemon=True,
+                                     name='local-llm-batcher').start()
+                    self._worker_pid = pid
+        return self._queue
+
+    def close(self):
+        """Release the model; the next request loads it again"""
+        with self._lock:
+            if self._queue is not None:
+                self._queue.put(None)
+                self._queue = None
+
+    # Batching
+
+    def _run(self, requests):
+        try:
+            self._load()
+        except Exception as e:
+            self.load_error = str(e)
+            print(f"Local model failed to load: {e}")
+
+        held = []  # requests that didn't fit the last batch's sampling settings
+        while True:
+            request = held.pop(0) if held else requests.get()
+            if request is None:
+                self._model = None
+                self._prefix = None
+                return
+            # One generate() call can only use one set of sampling settings
+            batch = [request]
+            waiting, held = held, []
+            for r in waiting:
+                if r.temperature == request.temperature and len(batch) < self.max_batch:
+                    batch.append(r)
+                else:
+                    held.append(r)
+            closes_at = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_batch:
+                remaining = closes_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    candidate = requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if candidate is None:
+                    requests.put(None)
+                    break
+                if candidate.temperature == request.temperature:
+                    batch.append(candidate)
+                else:
+                    held.append(candidate)
+            for r in batch:
+                if r.expired():
+                    r.finish(LLMError('Local generation timed out'))
+            batch = [r for r in batch if not r.done.is_set()]
+            if not batch:
+                continue
+
+            if self._model is None:
+                for r in batch:
+                    r.finish(LLMError(f"Local model unavailable: {self.load_error}"))
+                continue
+            try:
+                self._generate(batch)
+                for r in batch:
+                    r.finish()
+            except Exception as e:
+                for r in batch:
+                    r.finish(LLMError(f"Local generation failed: {e}"))
+
+    def _prompt_ids(self, messages):
+        tokenizer = self._tokenizer
+        if getattr(tokenizer, 'chat_template', None) or getattr(tokenizer, 'default_chat_template', None):
+            try:
+                return tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+            except Exception:
+                pass
+        return tokenizer(render_chat(messages))['input_ids']
+
+    def _shared_prefix(self, rows):
+        """Cached (ids, past key values) for the prefix every row starts with, or None
+
+        The prefix is learned from traffic: the longest common start of the
+        current batch and the previous request, which settles on the
+        template header plus the fixed opening of the system prompt.
+        """
+        if not self.prefix_cache:
+            return None
+        # Keep at least one prompt token per row for generate() to feed
+        limit = min(len(ids) for ids in rows) - 1
+        if self._prefix is not None:
+            ids, past = self._prefix
+            if len(ids) <= limit and all(row[:len(ids)] == ids for row in rows):
+                self.prefix_hits += 1
+                return self._prefix
+
+        sample = rows if len(rows) > 1 or self._last_ids is None else rows + [self._last_ids]
+        self._last_ids = rows[-1]
+        length = min(common_prefix_length(sample), limit)
+        if length < PREFIX_MIN_TOKENS or len(sample) < 2:
+            return None
+        ids = list(rows[0][:length])
+        torch = self._torch
+        with torch.no_grad():
+            output = self._model(torch.tensor([ids]), use_cache=True)
+        self._prefix = (ids, output.past_key_values)
+        return self._prefix
+
+    def _generate(self, batch):
+        from transformers import StoppingCriteriaList
+
+        torch = self._torch
+        tokenizer = self._tokenizer
+        rows = [self._prompt_ids(r.messages) for r in batch]
+        prefix = self._shared_prefix(rows)
+        prefix_len = len(prefix[0]) if prefix else 0
+
+        # Layout per row: shared prefix, left padding, then the row's own tokens
+        suffixes = [ids[prefix_len:] for ids in rows]
+        width = max(len(s) for s in suffixes)
+        input_ids, attention_mask = [], []
+        for ids, suffix in zip(rows, suffixes):
+            pad = width - len(suffix)
+            input_ids.append(ids[:prefix_len] + [tokenizer.pad_token_id] * pad + suffix)
+            attention_mask.append([1] * prefix_len + [0] * pad + [1] * len(suffix))
+
+        streamer = _BatchStreamer(batch, tokenizer)
+        kwargs = {
+            'input_ids': torch.tensor(input_ids),
+            'attention_mask': torch.tensor(attention_mask),
+            'max_new_tokens': max(r.max_tokens for r in batch),
+            'pad_token_id': tokenizer.pad_token_id,
+            'streamer': streamer,
+            'stopping_criteria': StoppingCriteriaList([streamer.all_done])
+        }
+        if batch[0].temperature > 0:
+            kwargs.update(do_sample=True, temperature=batch[0].temperature)
+        else:
+            kwargs['do_sample'] = False
+        if prefix is not None:
+            kwargs['past_key_values'] = tuple(
+                tuple(tensor.expand(len(batch), *tensor.shape[1:]) for tensor in layer)
+                for layer in prefix[1])
+
+        self.batches += 1
+        self.batched_requests += len(batch)
+        with torch.no_grad():
+            try:
+                self._model.generate(**kwargs)
+            except Exception:
+                if prefix is None or any(r.text for r in batch):
+                    raise
+                # Not every architecture accepts a batch-expanded legacy cache; run it in full
+                print("Local model rejected the cached prefix; prefix reuse disabled")
+                self.prefix_cache = False
+                self._prefix = None
+                del kwargs['past_key_values']
+                streamer = _BatchStreamer(batch, tokenizer)
+                kwargs.update(streamer=streamer, stopping_criteria=StoppingCriteriaList([streamer.all_done]))
+                self._model.generate(**kwargs)
+        # Usage of the whole batch, the unit this backend completes in
+        self.last_usage = {'prompt': sum(len(ids) for ids in rows),
+                           'completion': sum(len(tokens) for tokens in streamer.tokens)}
+        for kind, tokens in self.last_usage.items():
+            self.usage[kind] += tokens
+
+    # Client API
+
+    def _submit(self, messages, max_tokens, temperature, timeout):
+        if not self.available:
+            raise LLMError(f"No local model in {self.model_dir}")
+        request = _Request(messages, max_tokens, temperature,
+                           timeout if timeout is not None else float('inf'))
+        self._requests().put(request)
+        return request
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None, cancel=None):
+        """Generated text for a chat prompt; model is fixed by the local directory"""
+        if cancel is not None and cancel.is_set():
+            raise LLMError('Local generation abandoned by its caller')
+        request = self._submit(messages, max_tokens, temperature, timeout)
+        self._track(1)
+        try:
+            if not request.done.wait(timeout):
+                request.cancelled = True
+                raise LLMError('Local generation timed out')
+        finally:
+            self._track(-1)
+        if request.error is not None:
+            raise request.error
+        return request.text
+
+    def stream_complete(self, messages, model, max_tokens, temperature, timeout=None):
+        """Yield text deltas as the batch produces them"""
+        request = self._submit(messages, max_tokens, temperature, timeout)
+        self._track(1)
+        try:
+            while True:
+                remaining = request.expires_at - time.monotonic()
+                try:
+                    piece = request.pieces.get(timeout=max(0.0, min(remaining, 3600)))
+                except queue.Empty:
+                    raise LLMError('Local generation timed out')
+                if piece is None:
+                    break
+                yield piece
+            if request.error is not None:
+                raise request.error
+        finally:
+            # Stop spending forward passes on a client that went away
+            request.cancelled = True
+            self._track(-1)
+
+    def _track(self, delta):
+        with self._lock:
+            self.in_flight += delta
+
+    def stats(self):
+        """Model and batching figures for health reporting"""
+        return {
+            'backend': 'local',
+            'modelDir': self.model_dir,
+            'loaded': self._model is not None,
+            'loadError': self.load_error,
+            'inFlight': self.in_flight,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'maxBatch': self.max_batch,
+            'batchWaitMs': self.batch_wait * 1000,
+            'batches': self.batches,
+            'meanBatchSize': round(self.batched_requests / self.batches, 2) if self.batches else 0.0,
+            'prefixTokens': len(self._prefix[0]) if self._prefix else 0,
+            'prefixHits': self.prefix_hits,
+            'usage': dict(self.usage),
+            'lastUsage': dict(self.last_usage)
+        }
+
+
+class _BatchStreamer:
+    """generate() streamer that hands each row's new text to its request
+
+    Rows stop receiving text once they hit their own token limit or the
+    end-of-sequence token, even while longer rows keep the batch going.
+    """
+
+    def __init__(self, batch, tokenizer):
+        self.batch = batch
+        self.tokenizer = tokenizer
+        self.tokens = [[] for _ in batch]
+        self.finished = [False] * len(batch)
+        self.prompt_seen = False
+
+    def put(self, value):
+        # The first call carries the prompt itself
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for row, token in enumerate(value.reshape(-1).tolist()):
+            if self.finished[row]:
+                continue
+            request = self.batch[row]
+            if token == self.tokenizer.eos_token_id:
+                self.finished[row] = True
+                continue
+            self.tokens[row].append(token)
+            request.emit(self.tokenizer.decode(self.tokens[row], skip_special_tokens=True))
+            if len(self.tokens[row]) >= request.max_tokens:
+                self.finished[row] = True
+
+    def end(self):
+        pass
+
+    def all_done(self, input_ids, scores, **kwargs):
+        """Stopping criterion: every row is finished, timed out or abandoned"""
+        return all(finished or request.expired() for finished, request in zip(self.finished, self.batch))
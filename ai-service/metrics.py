@@ -0,0 +1,405 @@
+"""
+Request and stage metrics in Prometheus text format, plus a sampling profiler
+
+Counters, gauges and histograms live in one process-wide registry. Hot
+paths only time themselves with stage(); figures that other components
+already count (cache hits, fallbacks, breaker state, ...) are read by
+collectors when /metrics is scraped, so serving pays nothing for them.
+
+Under gunicorn each worker has its own registry. With METRICS_DIR set,
+workers write their values there every METRICS_FLUSH_SECONDS and /metrics
+merges every worker's file: counters and histograms are summed, gauges
+are reported per pid. gunicorn.conf.py drops the gauges of workers that
+exit; their counters stay so totals never go backwards.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv('METRICS', 'true').lower() not in ('0', 'false', 'no')
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+# Add a Server-Timing header to every response (otherwise only when X-Server-Timing: 1 is sent)
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() in ('1', 'true', 'yes')
+# The profiler endpoints exist only when this is on
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+PROFILER_INTERVAL_MS = float(os.getenv('PROFILER_INTERVAL_MS', 10))
+PROFILER_MAX_SECONDS = float(os.getenv('PROFILER_MAX_SECONDS', 300))
+
+# Seconds; spans in-process stages (sub-millisecond) up to slow upstream calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return {key: (list(value) if isinstance(value, list) else value) for key, value in self._values.items()}
+
+
+class MetricCounter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class MetricGauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class MetricHistogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        # Per-bucket (not cumulative) counts, then the +Inf count and the sum
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+
+class Registry:
+    """Metrics plus collectors that report other components' counters at scrape time"""
+
+    def __init__(self, directory=METRICS_DIR):
+        self.directory = directory
+        self.metrics = []
+        self.collectors = []
+        self._flusher = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return MetricCounter(self, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return MetricGauge(self, name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return MetricHistogram(self, name, help_text, labelnames, buckets)
+
+    def collector(self, fn):
+        """Register fn() -> iterable of (name, kind, help, {label: value}, value); usable as a decorator"""
+        self.collectors.append(fn)
+        return fn
+
+    def snapshot(self):
+        """This process's families as {name: {kind, help, labelnames, buckets, samples}}"""
+        families = {}
+        for metric in self.metrics:
+            families[metric.name] = {
+                'kind': metric.kind,
+                'help': metric.help,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': [[list(key), value] for key, value in metric.samples().items()]
+            }
+        for collect in self.collectors:
+            try:
+                collected = list(collect())
+            except Exception as e:
+                print(f"Metrics collector error: {e}")
+                continue
+            for name, kind, help_text, labels, value in collected:
+                family = families.setdefault(name, {'kind': kind, 'help': help_text,
+                                                    'labelnames': list(labels), 'buckets': [], 'samples': []})
+                family['samples'].append([[str(labels[label]) for label in family['labelnames']], value])
+        return families
+
+    # Multi-process
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def _write(self, pid, families):
+        temporary = os.path.join(self.directory, f".{pid}.json.tmp")
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(families, f, separators=(',', ':'))
+        os.replace(temporary, self._path(pid))
+
+    def flush(self):
+        """Write this process's values for the other workers' /metrics to merge"""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._write(os.getpid(), self.snapshot())
+
+    def start_flushing(self):
+        """Flush in the background every METRICS_FLUSH_SECONDS (once per process)"""
+        if not self.directory or not METRICS_ENABLED:
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher[0] == os.getpid():
+                return
+            thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher = (os.getpid(), thread)
+        thread.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Metrics flush error: {e}")
+
+    def mark_process_dead(self, pid):
+        """Drop an exited worker's gauges, keeping its counters in the totals"""
+        if not self.directory:
+            return
+        path = self._path(pid)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                families = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._write(pid, {name: family for name, family in families.items() if family['kind'] != 'gauge'})
+
+    def _merged(self):
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        merged = {}
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            pid = name[:-len('.json')]
+            try:
+                with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                    families = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric_name, family in families.items():
+                target = merged.get(metric_name)
+                if target is None:
+                    target = merged[metric_name] = dict(family, samples={})
+                    if family['kind'] == 'gauge':
+                        target['labelnames'] = family['labelnames'] + ['pid']
+                for labels, value in family['samples']:
+                    if family['kind'] == 'gauge':
+                        target['samples'][tuple(labels) + (pid,)] = value
+                    elif family['kind'] == 'histogram':
+                        current = target['samples'].get(tuple(labels))
+                        target['samples'][tuple(labels)] = (
+                            value if current is None else [a + b for a, b in zip(current, value)])
+                    else:
+                        target['samples'][tuple(labels)] = target['samples'].get(tuple(labels), 0) + value
+        for family in merged.values():
+            family['samples'] = [[list(labels), value] for labels, value in family['samples'].items()]
+        return merged
+
+    # Exposition
+
+    def render(self):
+        """Every family in Prometheus text exposition format 0.0.4"""
+        lines = []
+        for name, family in sorted(self._merged().items()):
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['kind']}")
+            labelnames = family['labelnames']
+            for labels, value in sorted(family['samples'], key=lambda sample: sample[0]):
+                pairs = list(zip(labelnames, labels))
+                if family['kind'] != 'histogram':
+                    lines.append(f"{name}{_labels(pairs)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(family['buckets'], value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(pairs + [('le', _number(bound))])} {cumulative}")
+                cumulative += value[-2]
+                lines.append(f"{name}_bucket{_labels(pairs + [('le', '+Inf')])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(pairs)} {_number(value[-1])}")
+                lines.append(f"{name}_count{_labels(pairs)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.counter('script_http_requests_total', 'HTTP requests by endpoint and status',
+                                 ('endpoint', 'method', 'status'))
+HTTP_SECONDS = registry.histogram('script_http_request_seconds',
+                                  'Time to build the response (streamed bodies excluded)', ('endpoint',))
+STAGE_SECONDS = registry.histogram('script_stage_seconds', 'Time spent per generation and ingest stage',
+                                   ('stage',))
+UPSTREAM_ERRORS = registry.counter('script_upstream_errors_total', 'Failed upstream model calls by error',
+                                   ('error',))
+
+
+# Stage timing
+
+_local = threading.local()
+
+
+@contextmanager
+def stage(name):
+    """Time a block into script_stage_seconds and the request's Server-Timing, if it has one"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def start_request_timing(enabled):
+    """Begin collecting stage times for the current thread's request"""
+    _local.timings = {} if enabled else None
+
+
+def finish_request_timing(total=None):
+    """Server-Timing header value for the current request, or None when not collecting
+
+    Stages run on other threads (batch items, hedged calls) are not included.
+    """
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    if timings is None:
+        return None
+    entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.2f}")
+    return ', '.join(entries)
+
+
+# Sampling profiler
+
+class SamplingProfiler:
+    """Samples every thread's Python stack at an interval while switched on
+
+    Stacks are kept as collapsed "file:function;file:function" strings with
+    sample counts, the input format of flamegraph.pl and speedscope. It is
+    per process and stops itself after PROFILER_MAX_SECONDS.
+    """
+
+    def __init__(self):
+        self.interval = PROFILER_INTERVAL_MS / 1000.0
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+        self._stacks = Counter()
+        self._running = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def start(self, interval_ms=None, seconds=None):
+        with self._lock:
+            if self.running:
+                return False
+            if interval_ms:
+                self.interval = max(0.001, float(interval_ms) / 1000.0)
+            limit = min(float(seconds), PROFILER_MAX_SECONDS) if seconds else PROFILER_MAX_SECONDS
+            self._stacks = Counter()
+            self.samples = 0
+            self.started_at = time.time()
+            self.stopped_at = None
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, args=(time.monotonic() + limit,), daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._running.clear()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=1.0)
+        return self.status()
+
+    def _run(self, until):
+        own = threading.get_ident()
+        while self._running.is_set() and time.monotonic() < until:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        self._running.clear()
+        self.stopped_at = time.time()
+
+    def collapsed(self, limit=None):
+        """Collapsed stacks, most sampled first"""
+        stacks = self._stacks.most_common(limit)
+        return '\n'.join(f"{stack} {count}" for stack, count in stacks) + ('\n' if stacks else '')
+
+    def status(self):
+        return {
+            'running': self.running,
+            'pid': os.getpid(),
+            'intervalMs': self.interval * 1000,
+            'samples': self.samples,
+            'stacks': len(self._stacks),
+            'startedAt': self.started_at,
+            'stoppedAt': self.stopped_at
+        }
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,260 @@
+"""
+Latency budgets, circuit breaking and request hedging for upstream generation
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from llm_client import LLMError
+
+# Default end-to-end budget for a generation request
+GENERATION_DEADLINE_MS = int(os.getenv('GENERATION_DEADLINE_MS', 30000))
+# Time kept back for building the training-data fallback
+FALLBACK_RESERVE_MS = int(os.getenv('FALLBACK_RESERVE_MS', 250))
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', 30))
+
+# Send a second upstream request when the first outlives the recent p95
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', 'false').lower() in ('1', 'true', 'yes')
+HEDGE_MIN_SAMPLES = 20
+
+UPSTREAM_WORKERS = int(os.getenv('UPSTREAM_WORKERS', 32))
+
+
+class BreakerOpen(Exception):
+    """Upstream skipped because the circuit breaker is open"""
+
+
+class DeadlineExceeded(Exception):
+    """Upstream skipped or abandoned because the request budget ran out"""
+
+
+class Deadline:
+    """Absolute point in time by which a request must be answered"""
+
+    def __init__(self, budget_ms):
+        self.budget_ms = budget_ms
+        self.expires_at = time.monotonic() + budget_ms / 1000.0
+
+    def remaining(self):
+        """Seconds left, never negative"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+def counts_as_outage(error):
+    """Errors that say upstream is unhealthy, as opposed to a bad request"""
+    if isinstance(error, LLMError):
+        return error.status is None or error.status == 429 or error.status >= 500
+    return True
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open probe after a cool-down"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """Whether a call may go upstream now; in half-open only one probe is let through"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def release(self):
+        """End a call that says nothing about upstream health, freeing the half-open probe slot"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutiveFailures': self.consecutive_failures,
+            'timesOpened': self.times_opened,
+            'rejected': self.rejected
+        }
+
+
+class LatencyTracker:
+    """Sliding window of recent successful upstream latencies"""
+
+    def __init__(self, window=500):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction):
+        """Latency at the given fraction, or None until enough samples exist"""
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class UpstreamGuard:
+    """Runs upstream calls within a deadline, behind a breaker, optionally hedged"""
+
+    def __init__(self, breaker=None, hedge=HEDGE_REQUESTS, reserve_ms=FALLBACK_RESERVE_MS,
+                 workers=UPSTREAM_WORKERS):
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        self.hedge = hedge
+        self.reserve = reserve_ms / 1000.0
+        self.requests = 0
+        self.fallbacks = {'unavailable': 0, 'breaker_open': 0, 'deadline': 0, 'error': 0}
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upstream')
+        self._lock = threading.Lock()
+
+    def _count(self, attribute, key=None):
+        with self._lock:
+            if key is None:
+                setattr(self, attribute, getattr(self, attribute) + 1)
+            else:
+                getattr(self, attribute)[key] += 1
+
+    def record_request(self):
+        self._count('requests')
+
+    def record_fallback(self, reason):
+        self._count('fallbacks', reason)
+
+    def budget(self, deadline):
+        """Seconds upstream may use before the fallback reserve, or raise if none"""
+        available = deadline.remaining() - self.reserve
+        if available <= 0:
+            raise DeadlineExceeded('latency budget used up')
+        if not self.breaker.allow_request():
+            raise BreakerOpen('circuit breaker open')
+        return available
+
+    def record_outcome(self, started, error=None):
+        """Feed a finished call into the breaker and latency window"""
+        if error is None:
+            self.latency.record(time.monotonic() - started)
+            self.breaker.record_success()
+        elif counts_as_outage(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.release()
+
+    def release(self):
+        """End an admitted call that finished without an outcome, e.g. a stream the client closed"""
+        self.breaker.release()
+
+    def _attempt(self, fn, deadline, cancel):
+        """Run one attempt of fn on an executor thread, with whatever budget is left when it starts"""
+        timeout = deadline.remaining() - self.reserve
+        if cancel.is_set() or timeout <= 0:
+            raise DeadlineExceeded('upstream call abandoned before it started')
+        return fn(timeout, cancel)
+
+    def call(self, fn, deadline):
+        """Run fn(timeout, cancel) within the deadline and return its result
+
+        fn receives the seconds it may spend, counted from when an executor
+        thread picks it up, and an Event that is set once the call no longer
+        wants its result. With hedging on, a second attempt is started once
+        the first passes the recent p95, if there is still time for a
+        typical reply; whichever succeeds first wins.
+        """
+        self.budget(deadline)
+        started = time.monotonic()
+        cancel = threading.Event()
+        pending = {self._executor.submit(self._attempt, fn, deadline, cancel)}
+        hedge = None
+
+        try:
+            hedge_after = self.latency.percentile(0.95) if self.hedge else None
+            if hedge_after is not None and hedge_after < deadline.remaining() - self.reserve:
+                done, not_done = wait(pending, timeout=hedge_after)
+                if not done and deadline.remaining() - self.reserve >= self.latency.percentile(0.5):
+                    self._count('hedges_sent')
+                    hedge = self._executor.submit(self._attempt, fn, deadline, cancel)
+                    pending = not_done | {hedge}
+
+            last_error = None
+            while pending:
+                timeout = deadline.remaining() - self.reserve
+                done, pending = wait(pending, timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    error = future.exception()
+                    if error is None:
+                        if hedge is not None and future is hedge:
+                            self._count('hedges_won')
+                        self.record_outcome(started)
+                        return future.result()
+                    last_error = error
+
+            if last_error is not None and not pending:
+                self.record_outcome(started, last_error)
+                raise last_error
+
+            # Still waiting when the budget ran out: treat slowness as an outage signal
+            self.record_outcome(started, DeadlineExceeded('upstream exceeded latency budget'))
+            raise DeadlineExceeded('upstream exceeded latency budget')
+        finally:
+            # Losing and abandoned attempts give up instead of holding upstream slots for nobody
+            cancel.set()
+
+    def stats(self):
+        with self._lock:
+            fallbacks = dict(self.fallbacks)
+            requests = self.requests
+        total_fallbacks = sum(fallbacks.values())
+        return {
+            'breaker': self.breaker.stats(),
+            'requests': requests,
+            'fallbacks': fallbacks,
+            'fallbackRate': round(total_fallbacks / requests, 4) if requests else 0.0,
+            'latencyP95': self.latency.percentile(0.95),
+            'hedging': self.hedge,
+            'hedgesSent': self.hedges_sent,
+            'hedgesWon': self.hedges_won
+        }
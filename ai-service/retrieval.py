@@ -0,0 +1,415 @@
+"""
+Keyword retrieval over the training corpus using a BM25-ranked inverted index
+"""
+
+import heapq
+import math
+import os
+import re
+import threading
+from array import array
+from collections import Counter
+
+# Tokens are lowercase alphanumeric runs, keeping simple contractions together
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+# Very common words carry no retrieval signal and only bloat the postings
+STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have he her his i if in into is it
+its me my of on or our she so that the their them then there they this to was we
+were what when where which who will with you your
+""".split())
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Bonus for each query term that appears in the document's filename
+FILENAME_BOOST = 5.0
+
+# How many of the longest documents to remember for padding short result lists
+LONGEST_POOL_SIZE = 8
+
+# Segments of similar size are merged once this many of them pile up
+MERGE_FACTOR = int(os.getenv('INDEX_MERGE_FACTOR', 8))
+
+
+def tokenize(text):
+    """Split text into lowercase search terms, dropping stopwords"""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+def term_counts(text):
+    """Term frequencies of a document"""
+    return Counter(tokenize(text))
+
+
+def posting_pairs(postings):
+    """(doc_id, tf) pairs of a postings list, which holds them flattened"""
+    return zip(postings[0::2], postings[1::2])
+
+
+def filename_terms(filename):
+    """Search terms for a relative training path like 'dialogue/tarantino.txt'"""
+    if not filename:
+        return set()
+    return set(tokenize(os.path.splitext(filename)[0]))
+
+
+class IndexSegment:
+    """Postings for a batch of documents; never modified once published
+
+    Postings lists are flat int arrays rather than lists of tuples: the
+    cyclic garbage collector never has to walk them, so full collections
+    don't slow down in proportion to the indexed corpus.
+    """
+
+    # Segments loaded from disk are already as large as they will get
+    mergeable = True
+
+    def __init__(self):
+        self.postings = {}        # term -> array of doc_id, term frequency, doc_id, ...
+        self.filename_postings = {}  # term -> set of doc_ids whose filename has it
+        self.doc_lengths = {}     # doc_id -> number of indexed tokens
+        self.total_length = 0
+        self.longest = []         # min-heap of (length, doc_id), largest documents
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, doc_id, content, filename=None):
+        """Index a document into this (still private) segment"""
+        self.add_counts(doc_id, term_counts(content), filename, len(content))
+
+    def add_counts(self, doc_id, term_counts, filename=None, content_length=0):
+        """Index a document whose terms were already counted"""
+        postings = self.postings
+        for term, tf in term_counts.items():
+            entries = postings.get(term)
+            if entries is None:
+                entries = postings[term] = array('i')
+            entries.append(doc_id)
+            entries.append(tf)
+        for term in filename_terms(filename):
+            self.filename_postings.setdefault(term, set()).add(doc_id)
+
+        length = sum(term_counts.values())
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+        self._remember_length(content_length, doc_id)
+
+    def _remember_length(self, length, doc_id):
+        entry = (length, doc_id)
+        if len(self.longest) < LONGEST_POOL_SIZE:
+            heapq.heappush(self.longest, entry)
+        elif entry > self.longest[0]:
+            heapq.heapreplace(self.longest, entry)
+
+    @classmethod
+    def merged(cls, segments, deleted=frozenset()):
+        """Build a new segment holding the union of the given segments, minus deleted documents"""
+        merged = cls()
+        for segment in segments:
+            if not deleted:
+                for term, postings in segment.postings.items():
+                    merged._extend(term, postings)
+                for term, doc_ids in segment.filename_postings.items():
+                    merged.filename_postings.setdefault(term, set()).update(doc_ids)
+                merged.doc_lengths.update(segment.doc_lengths)
+                merged.total_length += segment.total_length
+            else:
+                for term, postings in segment.postings.items():
+                    live = array('i')
+                    for doc_id, tf in posting_pairs(postings):
+                        if doc_id not in deleted:
+                            live.append(doc_id)
+                            live.append(tf)
+                    if live:
+                        merged._extend(term, live)
+                for term, doc_ids in segment.filename_postings.items():
+                    live = doc_ids - deleted
+                    if live:
+                        merged.filename_postings.setdefault(term, set()).update(live)
+                for doc_id, length in segment.doc_lengths.items():
+                    if doc_id not in deleted:
+                        merged.doc_lengths[doc_id] = length
+                        merged.total_length += length
+            for length, doc_id in segment.longest:
+                if doc_id not in deleted:
+                    merged._remember_length(length, doc_id)
+        return merged
+
+    def _extend(self, term, postings):
+        entries = self.postings.get(term)
+        if entries is None:
+            self.postings[term] = array('i', postings)
+        else:
+            entries.extend(postings)
+
+
+def indexed_length(segment, doc_id):
+    """Token count a segment holds for a document, or None when the document is not in it"""
+    lengths = segment.doc_lengths
+    if isinstance(lengths, dict):
+        return lengths.get(doc_id)
+    # Segments mapped from a snapshot hold documents 0..n-1
+    return lengths[doc_id] if 0 <= doc_id < len(lengths) else None
+
+
+class IndexSnapshot:
+    """Consistent, read-only view over a set of segments and their statistics
+
+    deleted doc ids may still have postings in the segments; they are
+    skipped in results, and deleted_count/deleted_length take them out of
+    the corpus statistics.
+    """
+
+    def __init__(self, segments=(), k1=BM25_K1, b=BM25_B, deleted=frozenset(), deleted_count=0, deleted_length=0):
+        self.segments = tuple(segments)
+        self.deleted = deleted
+        self.doc_count = sum(len(s) for s in self.segments) - deleted_count
+        self.total_length = sum(s.total_length for s in self.segments) - deleted_length
+        self.k1 = k1
+        self.b = b
+
+    def __len__(self):
+        return self.doc_count
+
+    def document_frequency(self, term):
+        """Number of documents containing the term"""
+        return sum(len(s.postings.get(term, ())) for s in self.segments) // 2
+
+    def idf(self, term):
+        """BM25 inverse document frequency (always positive)"""
+        df = self.document_frequency(term)
+        return math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+
+    def score(self, query):
+        """Accumulate BM25 scores for every document matching the query terms"""
+        return self.score_many([query])[0]
+
+    def score_many(self, queries):
+        """Score several queries in one pass, walking each distinct term's postings once"""
+        all_scores = [{} for _ in queries]
+        if not self.doc_count:
+            return all_scores
+
+        # term -> indexes of the queries that contain it
+        term_queries = {}
+        for i, query in enumerate(queries):
+            for term in set(tokenize(query)):
+                term_queries.setdefault(term, []).append(i)
+
+        avg_length = self.total_length / self.doc_count or 1.0
+        k1, b = self.k1, self.b
+
+        for term, query_ids in term_queries.items():
+            idf = self.idf(term)
+            for segment in self.segments:
+                postings = segment.postings.get(term)
+                if postings:
+                    doc_lengths = segment.doc_lengths
+                    for doc_id, tf in posting_pairs(postings):
+                        norm = k1 * (1 - b + b * doc_lengths[doc_id] / avg_length)
+                        contribution = idf * tf * (k1 + 1) / (tf + norm)
+                        for i in query_ids:
+                            scores = all_scores[i]
+                            scores[doc_id] = scores.get(doc_id, 0.0) + contribution
+                for doc_id in segment.filename_postings.get(term, ()):
+                    for i in query_ids:
+                        scores = all_scores[i]
+                        scores[doc_id] = scores.get(doc_id, 0.0) + FILENAME_BOOST
+
+        return all_scores
+
+    def search(self, query, k=3):
+        """Return the top-k (score, doc_id) pairs for a free-text query"""
+        return self._top_k(self.score(query), k)
+
+    def search_many(self, queries, k=3):
+        """Top-k (score, doc_id) lists for a batch of queries"""
+        return [self._top_k(scores, k) for scores in self.score_many(queries)]
+
+    def _top_k(self, scores, k):
+        deleted = self.deleted
+        candidates = scores.items()
+        if deleted:
+            candidates = (item for item in candidates if item[0] not in deleted)
+        top = heapq.nlargest(k, candidates, key=lambda item: item[1])
+        results = [(score, doc_id) for doc_id, score in top]
+
+        # Pad with the longest documents so callers always get some material
+        if len(results) < k:
+            longest = heapq.nlargest(LONGEST_POOL_SIZE, (e for s in self.segments for e in s.longest
+                                                        if e[1] not in deleted))
+            for _, doc_id in longest:
+                if len(results) >= k:
+                    break
+                if doc_id not in scores:
+                    results.append((0.0, doc_id))
+
+        return results
+
+
+class InvertedIndex:
+    """Segmented inverted index with copy-on-write snapshots
+
+    Writers build a fresh segment for each new batch of documents and publish
+    a new snapshot by swapping a single reference, so readers never see a
+    half-applied update. Small segments are merged in the background in
+    size tiers, keeping the segment count (and query fan-out) logarithmic.
+    Deleted documents are tombstoned in the snapshot and dropped from
+    segments as they get merged.
+    """
+
+    def __init__(self, k1=BM25_K1, b=BM25_B, merge_factor=MERGE_FACTOR, background_merge=True):
+        self.k1 = k1
+        self.b = b
+        self.merge_factor = max(2, merge_factor)
+        self.background_merge = background_merge
+        self._snapshot = IndexSnapshot((), k1, b)
+        # Tombstones, and how many of them (and their tokens) the published segments still hold
+        self._deleted = frozenset()
+        self._deleted_count = 0
+        self._deleted_length = 0
+        self._write_lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._merge_wanted = threading.Event()
+        self._merge_thread = None
+        self._merge_pid = None
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def snapshot(self):
+        """Current consistent view; safe to use while writers keep publishing"""
+        return self._snapshot
+
+    def search(self, query, k=3):
+        """Return the top-k (score, doc_id) pairs from the current snapshot"""
+        return self._snapshot.search(query, k)
+
+    def search_many(self, queries, k=3):
+        """Top-k results for each query, all scored against one snapshot"""
+        return self._snapshot.search_many(queries, k)
+
+    def document_frequency(self, term):
+        """Number of documents containing the term in the current snapshot"""
+        return self._snapshot.document_frequency(term)
+
+    def add_document(self, doc_id, content, filename=None):
+        """Index one document in time proportional to its length"""
+        self.add_documents([(doc_id, content, filename)])
+
+    def add_documents(self, documents):
+        """Index an iterable of (doc_id, content, filename) as one new segment"""
+        segment = IndexSegment()
+        for doc_id, content, filename in documents:
+            segment.add(doc_id, content, filename)
+        self.add_segment(segment)
+
+    def add_counted_documents(self, documents, deleted=()):
+        """Index (doc_id, term_counts, filename, content_length) tuples as one new segment
+
+        deleted doc ids are retired in the same snapshot, so a replaced
+        document and its replacement never show up together.
+        """
+        segment = IndexSegment()
+        for doc_id, counts, filename, content_length in documents:
+            segment.add_counts(doc_id, counts, filename, content_length)
+        self.add_segment(segment, deleted)
+
+    def delete_documents(self, doc_ids):
+        """Stop returning documents, in time proportional to how many there are"""
+        self.add_segment(IndexSegment(), doc_ids)
+
+    def add_segment(self, segment, deleted=()):
+        """Publish a fully built segment, retiring the deleted doc ids in the same snapshot"""
+        if not len(segment) and not deleted:
+            return
+
+        with self._write_lock:
+            segments = self._snapshot.segments + ((segment,) if len(segment) else ())
+            self._retire(segments, deleted)
+            self._publish(segments)
+        if len(segment):
+            self._request_merge()
+
+    def _retire(self, segments, doc_ids):
+        """Tombstone doc ids and count what segments still hold of them; caller holds the write lock"""
+        retired = {doc_id for doc_id in doc_ids if doc_id not in self._deleted}
+        if not retired:
+            return
+        for doc_id in retired:
+            for segment in segments:
+                length = indexed_length(segment, doc_id)
+                if length is not None:
+                    self._deleted_count += 1
+                    self._deleted_length += length
+                    break
+        self._deleted = self._deleted | retired
+
+    def _publish(self, segments):
+        self._snapshot = IndexSnapshot(segments, self.k1, self.b, self._deleted,
+                                       self._deleted_count, self._deleted_length)
+
+    def _tier(self, segment):
+        return int(math.log(max(len(segment), 1), self.merge_factor))
+
+    def _pick_merge(self, segments):
+        """Smallest size tier holding at least merge_factor segments, if any"""
+        tiers = {}
+        for segment in segments:
+            if not segment.mergeable:
+                continue
+            tiers.setdefault(self._tier(segment), []).append(segment)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier]
+        return None
+
+    def merge_once(self):
+        """Merge one tier of segments; returns False when nothing needed merging"""
+        with self._merge_lock:
+            victims = self._pick_merge(self._snapshot.segments)
+            if not victims:
+                return False
+
+            # The expensive part runs without the write lock; readers keep using old segments
+            merged = IndexSegment.merged(victims, self._snapshot.deleted)
+
+            with self._write_lock:
+                # Documents deleted later stay in the merged segment and keep being counted
+                self._deleted_count -= sum(len(s) for s in victims) - len(merged)
+                self._deleted_length -= sum(s.total_length for s in victims) - merged.total_length
+                current = self._snapshot.segments
+                victim_ids = {id(s) for s in victims}
+                remaining = [s for s in current if id(s) not in victim_ids]
+                self._publish([merged] + remaining)
+            return True
+
+    def _request_merge(self):
+        if not self.background_merge:
+            while self.merge_once():
+                pass
+            return
+
+        # Threads don't survive fork, so a preloaded index restarts its merger in each worker
+        pid = os.getpid()
+        if self._merge_pid != pid:
+            with self._write_lock:
+                if self._merge_pid != pid:
+                    self._merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+                    self._merge_thread.start()
+                    self._merge_pid = pid
+        self._merge_wanted.set()
+
+    def _merge_loop(self):
+        while True:
+            self._merge_wanted.wait()
+            self._merge_wanted.clear()
+            try:
+                while self.merge_once():
+                    pass
+            except Exception as e:
+                print(f"Index merge error: {e}")
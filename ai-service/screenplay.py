@@ -0,0 +1,175 @@
+"""
+Single-pass screenplay tokenizer shared by training ingestion and fallback generation
+"""
+
+import re
+from collections import namedtuple
+
+# Element kinds
+SCENE_HEADING = 'scene_heading'
+CHARACTER = 'character'
+PARENTHETICAL = 'parenthetical'
+DIALOGUE = 'dialogue'
+ACTION = 'action'
+TRANSITION = 'transition'
+
+# Precompiled line patterns, applied to stripped lines
+SCENE_PATTERN = re.compile(r'(?:INT\.|EXT\.|INT/EXT\.)')
+CHARACTER_PATTERN = re.compile(r"[A-Z][A-Z\s]*(?:\([A-Z.' ]+\))?")
+TRANSITION_PATTERN = re.compile(r'FADE|[A-Z\s]+TO:$')
+
+# Action lines shorter than this are usually fragments, not descriptions
+MIN_DESCRIPTION_LENGTH = 21
+
+# A typed element with its [start, end) character span in the source text.
+# For dialogue and parentheticals, `character` is the cue they belong to.
+Element = namedtuple('Element', ['kind', 'text', 'start', 'end', 'character'])
+
+
+def iter_elements(content):
+    """Classify each line of a screenplay once, yielding typed elements lazily
+
+    Blank lines are not emitted but end the current dialogue block. Callers
+    can stop consuming as soon as they have what they need.
+    """
+    cue = None
+    pos = 0
+    length = len(content)
+
+    while pos <= length:
+        newline = content.find('\n', pos)
+        if newline == -1:
+            newline = length
+        line_start, line_end = pos, newline
+        pos = newline + 1
+
+        # Trim the span to the stripped text so it can be sliced back out
+        while line_start < line_end and content[line_start].isspace():
+            line_start += 1
+        while line_end > line_start and content[line_end - 1].isspace():
+            line_end -= 1
+        if line_start == line_end:
+            cue = None
+            continue
+
+        line = content[line_start:line_end]
+
+        if SCENE_PATTERN.match(line):
+            cue = None
+            yield Element(SCENE_HEADING, line, line_start, line_end, None)
+        elif TRANSITION_PATTERN.match(line):
+            cue = None
+            yield Element(TRANSITION, line, line_start, line_end, None)
+        elif CHARACTER_PATTERN.fullmatch(line):
+            cue = line
+            yield Element(CHARACTER, line, line_start, line_end, None)
+        elif line.startswith('('):
+            yield Element(PARENTHETICAL, line, line_start, line_end, cue)
+        elif cue is not None:
+            yield Element(DIALOGUE, line, line_start, line_end, cue)
+        else:
+            yield Element(ACTION, line, line_start, line_end, None)
+
+
+def collect_elements(content, scenes=10, characters=20, dialogue=15, descriptions=10):
+    """Gather capped lists of elements in one pass, stopping once every cap is hit
+
+    Dialogue holds the first spoken line after each character cue and
+    descriptions hold action lines long enough to describe a scene.
+    """
+    collected = {
+        'scenes': [],
+        'characters': [],
+        'dialogue': [],
+        'descriptions': []
+    }
+    caps = {
+        'scenes': scenes,
+        'characters': characters,
+        'dialogue': dialogue,
+        'descriptions': descriptions
+    }
+    open_slots = sum(caps.values())
+    if open_slots <= 0:
+        return collected
+
+    spoken_cue = None  # cue element whose first dialogue line is still pending
+    for element in iter_elements(content):
+        kind = element.kind
+        if kind == SCENE_HEADING:
+            bucket = 'scenes'
+        elif kind == CHARACTER:
+            spoken_cue = element
+            if len(element.text) <= 2:
+                continue
+            bucket = 'characters'
+        elif kind == DIALOGUE and spoken_cue is not None:
+            spoken_cue = None
+            bucket = 'dialogue'
+        elif kind == ACTION and len(element.text) >= MIN_DESCRIPTION_LENGTH:
+            bucket = 'descriptions'
+        else:
+            continue
+
+        items = collected[bucket]
+        if len(items) < caps[bucket]:
+            items.append(element)
+            open_slots -= 1
+            if not open_slots:
+                break
+
+    return collected
+
+
+def chunk_spans(content, max_chars=800, min_chars=200):
+    """Split a screenplay into contiguous [start, end) spans of roughly one beat each
+
+    Blocks are runs of non-blank lines, such as a character cue with its
+    dialogue or an action paragraph. Every scene heading starts a new chunk;
+    otherwise blocks are packed together until adding the next one would
+    pass max_chars. Blocks longer than max_chars are split between lines.
+    The spans cover the whole text, so every token lands in exactly one chunk.
+    """
+    blocks = []  # (start, end, starts_scene)
+    block_start = block_end = None
+    pos = 0
+    length = len(content)
+    while pos < length:
+        newline = content.find('\n', pos)
+        if newline == -1:
+            newline = length
+        line_start, line_end = pos, newline
+        pos = newline + 1
+
+        line = content[line_start:line_end].strip()
+        if not line:
+            if block_start is not None:
+                blocks.append((block_start, block_end, False))
+                block_start = None
+            continue
+        if SCENE_PATTERN.match(line):
+            if block_start is not None:
+                blocks.append((block_start, block_end, False))
+            blocks.append((line_start, line_end, True))
+            block_start = None
+            continue
+        # Close oversized blocks at a line boundary
+        if block_start is not None and line_end - block_start > max_chars:
+            blocks.append((block_start, block_end, False))
+            block_start = None
+        if block_start is None:
+            block_start = line_start
+        block_end = line_end
+    if block_start is not None:
+        blocks.append((block_start, block_end, False))
+
+    spans = []
+    chunk_start = 0
+    has_text = False
+    for start, end, starts_scene in blocks:
+        if has_text and (starts_scene or (end - chunk_start > max_chars and start - chunk_start >= min_chars)):
+            spans.append((chunk_start, start))
+            chunk_start = start
+        has_text = True
+    spans.append((chunk_start, length))
+    return spans
@@ -0,0 +1,271 @@
+"""
+Latent-semantic retrieval over training chunks: TF-IDF reduced with truncated SVD
+
+Chunks become unit vectors in a low-dimensional space where terms that
+co-occur across the corpus end up close, so a prompt can match passages
+that share none of its words. A query is one matrix-vector product over
+the chunk matrix plus an argpartition for the top k.
+
+The model is fitted from the chunk index's postings (no re-tokenizing, no
+downloads); chunks added afterwards are projected into the fitted space
+and the model is refitted in the background once the corpus has grown by
+SEMANTIC_REFIT_GROWTH. Snapshots persist it as:
+
+    semantic.vectors.npy      float32 chunk vectors, memory-mapped on load
+    semantic.components.npy   float32 term -> latent space projection
+    semantic.idf.npy          float32 inverse document frequencies
+    semantic.terms.json       vocabulary in column order
+"""
+
+import json
+import math
+import os
+
+from retrieval import posting_pairs, term_counts
+
+# Loaded with the first model; only services with semantic retrieval on ever need it
+np = None
+
+SEMANTIC_RETRIEVAL = os.getenv('SEMANTIC_RETRIEVAL', 'false').lower() in ('1', 'true', 'yes')
+SEMANTIC_DIMENSIONS = int(os.getenv('SEMANTIC_DIMENSIONS', 128))
+# Share of the blended score that comes from semantic similarity
+SEMANTIC_WEIGHT = float(os.getenv('SEMANTIC_WEIGHT', 0.3))
+# Terms in fewer chunks than this carry no co-occurrence signal
+SEMANTIC_MIN_DF = int(os.getenv('SEMANTIC_MIN_DF', 2))
+SEMANTIC_MAX_TERMS = int(os.getenv('SEMANTIC_MAX_TERMS', 50000))
+SEMANTIC_REFIT_GROWTH = float(os.getenv('SEMANTIC_REFIT_GROWTH', 2.0))
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        import numpy as module
+        np = module
+
+
+class SemanticModel:
+    """Fitted TF-IDF weights and SVD projection; read-only once built"""
+
+    def __init__(self, terms, idf, components):
+        _import_numpy()
+        self.terms = terms
+        self.vocabulary = {term: column for column, term in enumerate(terms)}
+        self.idf = idf                  # (terms,)
+        self.components = components    # (terms, dimensions)
+
+    @property
+    def dimensions(self):
+        return self.components.shape[1]
+
+    def project(self, counts_list):
+        """Unit vectors for term-count mappings, shape (len(counts_list), dimensions)
+
+        Applies the fit's weighting (sublinear tf times idf, L2 normalised)
+        and projection, touching only the rows of terms present.
+        """
+        vectors = np.zeros((len(counts_list), self.dimensions), dtype=np.float32)
+        vocabulary = self.vocabulary
+        for row, counts in enumerate(counts_list):
+            columns = []
+            weights = []
+            for term, tf in counts.items():
+                column = vocabulary.get(term)
+                if column is not None:
+                    columns.append(column)
+                    weights.append(1.0 + math.log(tf))
+            if not columns:
+                continue
+            weights = np.asarray(weights, dtype=np.float32) * self.idf[columns]
+            weights /= np.linalg.norm(weights)
+            vectors[row] = weights @ self.components[columns]
+        return _normalize(vectors)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores, k):
+    """(score, id) pairs for the k highest scores, best first"""
+    if k <= 0 or not len(scores):
+        return []
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    # Ties break on the lower id so results are deterministic
+    candidates = candidates[np.lexsort((candidates, -scores[candidates]))]
+    return [(float(scores[i]), int(i)) for i in candidates]
+
+
+class SemanticIndex:
+    """Chunk vectors for ids 0..rows-1: a persisted base plus an in-memory tail
+
+    Rows are only ever appended, in chunk id order, so readers can score
+    without locks while one writer adds.
+    """
+
+    def __init__(self, model, vectors, fitted_rows=None):
+        self.model = model
+        self._base = vectors
+        self._tail = (np.zeros((0, model.dimensions), dtype=np.float32), 0)  # (buffer, rows used)
+        self.fitted_rows = fitted_rows if fitted_rows is not None else len(vectors)
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def rows(self):
+        return len(self._base) + self._tail[1]
+
+    def _matrices(self):
+        buffer, used = self._tail
+        return self._base, buffer[:used]
+
+    def add(self, first_id, counts_list):
+        """Project and append chunks first_id, first_id + 1, ...; ignored unless they come next"""
+        if first_id != self.rows or not counts_list:
+            return False
+        vectors = self.model.project(counts_list)
+        buffer, used = self._tail
+        if used + len(vectors) > len(buffer):
+            grown = np.zeros((max(2 * len(buffer), used + len(vectors), 64), self.model.dimensions),
+                             dtype=np.float32)
+            grown[:used] = buffer[:used]
+            buffer = grown
+        buffer[used:used + len(vectors)] = vectors
+        self._tail = (buffer, used + len(vectors))
+        return True
+
+    def query_vectors(self, queries):
+        return self.model.project([term_counts(query) for query in queries])
+
+    def scores(self, query_vectors):
+        """Cosine similarity of every chunk to each query, shape (queries, rows)"""
+        base, tail = self._matrices()
+        if len(tail):
+            return np.hstack([query_vectors @ base.T, query_vectors @ tail.T])
+        return query_vectors @ base.T
+
+    def search(self, query, k=3):
+        return self.search_many([query], k)[0]
+
+    def search_many(self, queries, k=3):
+        """Top-k (similarity, chunk_id) per query from one matrix product"""
+        if not queries or not self.rows:
+            return [[] for _ in queries]
+        return [_top_k(row, k) for row in self.scores(self.query_vectors(queries))]
+
+    def blend_many(self, queries, lexical_results, k=3, weight=SEMANTIC_WEIGHT, exclude=frozenset()):
+        """Merge BM25 results with semantic matches into one ranking per query
+
+        Each candidate scores (1 - weight) * bm25 / best bm25 + weight *
+        similarity, so chunks that only match in meaning can still make the
+        cut and literal matches keep most of their say. Semantic matches in
+        exclude (chunks of deleted documents) are left out.
+        """
+        if not queries or not self.rows:
+            return lexical_results
+        all_scores = self.scores(self.query_vectors(queries))
+        blended = []
+        for scores, lexical in zip(all_scores, lexical_results):
+            best = max((score for score, _ in lexical), default=0.0)
+            combined = {}
+            for similarity, chunk_id in _top_k(scores, k):
+                if chunk_id not in exclude:
+                    combined[chunk_id] = weight * max(similarity, 0.0)
+            for score, chunk_id in lexical:
+                similarity = float(scores[chunk_id]) if chunk_id < len(scores) else 0.0
+                combined[chunk_id] = (1 - weight) * score / (best or 1.0) + weight * max(similarity, 0.0)
+            ranked = sorted(combined.items(), key=lambda item: (-item[1], item[0]))[:k]
+            blended.append([(score, chunk_id) for chunk_id, score in ranked if score > 0])
+        return blended
+
+    def snapshot(self):
+        """Read-only view of the current rows, safe to save while adds continue"""
+        view = SemanticIndex.__new__(SemanticIndex)
+        view.model = self.model
+        view._base = self._base
+        view._tail = self._tail
+        view.fitted_rows = self.fitted_rows
+        return view
+
+    def save(self, directory, count):
+        """Write the model and vectors for chunks 0..count-1 into directory"""
+        base, tail = self._matrices()
+        np.save(os.path.join(directory, 'semantic.vectors.npy'),
+                np.vstack([base, tail])[:count] if len(tail) else np.asarray(base[:count]))
+        np.save(os.path.join(directory, 'semantic.components.npy'), np.asarray(self.model.components))
+        np.save(os.path.join(directory, 'semantic.idf.npy'), np.asarray(self.model.idf))
+        with open(os.path.join(directory, 'semantic.terms.json'), 'w', encoding='utf-8') as f:
+            json.dump({'terms': self.model.terms, 'fittedRows': self.fitted_rows}, f, separators=(',', ':'))
+
+    @classmethod
+    def open(cls, directory):
+        """Map a saved index; the vectors stay on disk and in the shared page cache"""
+        with open(os.path.join(directory, 'semantic.terms.json'), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        _import_numpy()
+        model = SemanticModel(info['terms'],
+                              np.load(os.path.join(directory, 'semantic.idf.npy')),
+                              np.load(os.path.join(directory, 'semantic.components.npy'), mmap_mode='r'))
+        vectors = np.load(os.path.join(directory, 'semantic.vectors.npy'), mmap_mode='r')
+        return cls(model, vectors, info.get('fittedRows'))
+
+    def stats(self):
+        return {
+            'rows': self.rows,
+            'fittedRows': self.fitted_rows,
+            'dimensions': self.model.dimensions,
+            'terms': len(self.model.terms)
+        }
+
+
+def fit_semantic_index(index_snapshot, count, dimensions=SEMANTIC_DIMENSIONS,
+                       min_df=SEMANTIC_MIN_DF, max_terms=SEMANTIC_MAX_TERMS):
+    """Fit TF-IDF + truncated SVD on entries 0..count-1 of an index snapshot
+
+    Returns None when the corpus is too small to reduce. scikit-learn (and
+    scipy) are only needed here, not for queries.
+    """
+    from scipy.sparse import csr_matrix
+    from sklearn.decomposition import TruncatedSVD
+    _import_numpy()
+
+    columns = {}
+    for segment in index_snapshot.segments:
+        for term, postings in segment.postings.items():
+            entries = [(doc_id, tf) for doc_id, tf in posting_pairs(postings) if doc_id < count]
+            if entries:
+                columns.setdefault(term, []).extend(entries)
+    vocabulary = [term for term, postings in columns.items() if len(postings) >= min_df]
+    # Keep the most widespread terms, ties broken alphabetically for a stable fit
+    vocabulary.sort(key=lambda term: (-len(columns[term]), term))
+    terms = sorted(vocabulary[:max_terms])
+    dimensions = min(dimensions, len(terms) - 1, count - 1)
+    if dimensions < 2:
+        return None
+
+    rows, cols, data = [], [], []
+    idf = np.empty(len(terms), dtype=np.float32)
+    for column, term in enumerate(terms):
+        postings = columns[term]
+        # Same smoothing as scikit-learn's TfidfTransformer
+        idf[column] = math.log((1 + count) / (1 + len(postings))) + 1
+        for doc_id, tf in postings:
+            rows.append(doc_id)
+            cols.append(column)
+            data.append(1.0 + math.log(tf))
+    matrix = csr_matrix((np.asarray(data, dtype=np.float32), (rows, cols)),
+                        shape=(count, len(terms)), dtype=np.float32)
+    matrix = matrix.multiply(idf).tocsr()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    matrix = csr_matrix(matrix.multiply(1 / norms[:, None]))
+
+    svd = TruncatedSVD(n_components=dimensions, algorithm='randomized', n_iter=5, random_state=0)
+    vectors = _normalize(svd.fit_transform(matrix).astype(np.float32))
+    model = SemanticModel(terms, idf, np.ascontiguousarray(svd.components_.T, dtype=np.float32))
+    return SemanticIndex(model, vectors)
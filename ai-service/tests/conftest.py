@@ -0,0 +1,43 @@
+"""Point the service's module-level state at scratch space before any test imports app"""
+
+import functools
+import os
+import tempfile
+
+import pytest
+
+_scratch = tempfile.mkdtemp(prefix='ai-service-tests-')
+os.environ['TRAINING_STORE_DIR'] = os.path.join(_scratch, 'store')
+os.environ['METRICS_DIR'] = os.path.join(_scratch, 'metrics')
+os.environ['TRAINING_WATCH'] = 'off'
+os.environ['OPENAI_API_KEY'] = ''
+os.environ.pop('RESPONSE_CACHE_DIR', None)
+
+
+@pytest.fixture
+def training_dir(tmp_path):
+    """Training files for 40 distinct scripts"""
+    from benchmarks.corpus import generate_document
+    directory = tmp_path / 'training'
+    for index in range(40):
+        filename, content = generate_document(index, seed=7)
+        path = directory / filename
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding='utf-8')
+    return directory
+
+
+@pytest.fixture
+def start(tmp_path, training_dir, monkeypatch):
+    """Start a generator on a store under tmp_path, as a restarted process would"""
+    import app
+    from training_store import TrainingStore
+    monkeypatch.setattr(app, 'training_directory', lambda: str(training_dir))
+    monkeypatch.setattr(app, 'TrainingStore', functools.partial(TrainingStore, str(tmp_path / 'store')))
+
+    def start_generator():
+        generator = app.ScriptGenerator()
+        assert generator.wait_until_warm(60)
+        assert generator.warmup_error is None
+        return generator
+    return start_generator
@@ -0,0 +1,179 @@
+import threading
+import time
+
+import pytest
+
+from admission import BATCH, INTERACTIVE, AdmissionController, Overloaded
+from resilience import Deadline
+
+
+def wait_for(condition, timeout=5.0):
+    stop = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < stop, 'timed out'
+        time.sleep(0.001)
+
+
+class Queue:
+    """Requests waiting in their own threads, recording the order they are admitted in"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.order = []
+        self.tickets = {}
+        self.errors = {}
+        self._threads = []
+
+    def add(self, name, client, lane=INTERACTIVE):
+        queued = self.controller.queued
+
+        def run():
+            try:
+                ticket = self.controller.admit(client, lane)
+            except Overloaded as e:
+                self.errors[name] = e
+                return
+            self.tickets[name] = ticket
+            self.order.append(name)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        wait_for(lambda: self.controller.queued == queued + 1)
+
+    def release(self, name):
+        """Release one ticket and wait for whoever it admits"""
+        admitted = len(self.order)
+        waiting = self.controller.queued
+        self.tickets.pop(name).release()
+        if not waiting:
+            return None
+        wait_for(lambda: len(self.order) > admitted)
+        return self.order[-1]
+
+    def drain(self, first):
+        """Release first, then every request it lets in, returning the admission order"""
+        name = first
+        while name is not None:
+            name = self.release(name)
+        return self.order
+
+
+def test_admits_up_to_concurrency_without_waiting():
+    controller = AdmissionController(concurrency=2)
+    first = controller.admit('a')
+    second = controller.admit('b')
+    assert controller.active == 2 and first.waited == 0.0
+    first.release()
+    first.release()
+    assert controller.active == 1
+    with controller.admit('c'):
+        assert controller.active == 2
+    second.release()
+    assert controller.active == 0
+    assert controller.stats()['admitted'] == {INTERACTIVE: 3}
+
+
+def test_disabled_controller_never_queues():
+    controller = AdmissionController(concurrency=1, queue_limit=0, enabled=False)
+    tickets = [controller.admit('a') for _ in range(5)]
+    assert controller.active == 0
+    for ticket in tickets:
+        ticket.release()
+
+
+def test_full_queue_is_turned_away():
+    controller = AdmissionController(concurrency=1, queue_limit=2)
+    held = controller.admit('a')
+    queue = Queue(controller)
+    queue.add('b1', 'b')
+    queue.add('c1', 'c')
+    with pytest.raises(Overloaded) as excinfo:
+        controller.admit('d')
+    assert excinfo.value.reason == 'queue_full'
+    assert excinfo.value.retry_after >= 1
+    with pytest.raises(Overloaded):
+        controller.check('d')
+    held.release()
+    wait_for(lambda: len(queue.order) == 1)
+    queue.drain(queue.order[0])
+    assert controller.stats()['rejected'] == {f"{INTERACTIVE}:queue_full": 2}
+
+
+def test_one_client_cannot_fill_the_queue():
+    controller = AdmissionController(concurrency=1, queue_limit=10, client_queue_limit=2)
+    held = controller.admit('greedy')
+    queue = Queue(controller)
+    queue.add('g1', 'greedy')
+    queue.add('g2', 'greedy')
+    with pytest.raises(Overloaded) as excinfo:
+        controller.admit('greedy')
+    assert excinfo.value.reason == 'client_queue_full'
+    # Everyone else still gets in line
+    queue.add('o1', 'other')
+    held.release()
+    wait_for(lambda: len(queue.order) == 1)
+    assert queue.drain(queue.order[0]) == ['g1', 'o1', 'g2']
+
+
+def test_clients_take_turns_within_a_lane():
+    controller = AdmissionController(concurrency=1, queue_limit=10)
+    queue = Queue(controller)
+    queue.tickets['held'] = controller.admit('a')
+    for name in ('a1', 'a2', 'a3'):
+        queue.add(name, 'a')
+    queue.add('b1', 'b')
+    queue.add('c1', 'c')
+    assert queue.drain('held') == ['a1', 'b1', 'c1', 'a2', 'a3']
+
+
+def test_interactive_lane_is_weighted_but_batch_keeps_moving():
+    controller = AdmissionController(concurrency=1, queue_limit=20, client_queue_limit=20, interactive_weight=2)
+    queue = Queue(controller)
+    queue.tickets['held'] = controller.admit('x')
+    for index in range(3):
+        queue.add(f"b{index}", 'jobs', BATCH)
+    for index in range(5):
+        queue.add(f"i{index}", 'chat')
+    assert queue.drain('held') == ['i0', 'i1', 'b0', 'i2', 'i3', 'b1', 'i4', 'b2']
+
+
+def test_waiter_times_out_and_leaves_the_queue():
+    controller = AdmissionController(concurrency=1, max_wait_ms=50)
+    held = controller.admit('a')
+    started = time.monotonic()
+    with pytest.raises(Overloaded) as excinfo:
+        controller.admit('b')
+    assert excinfo.value.reason == 'timeout'
+    assert 0.04 <= time.monotonic() - started < 2
+    assert controller.queued == 0
+    held.release()
+    assert controller.active == 0
+
+
+def test_deadline_shortens_the_wait():
+    controller = AdmissionController(concurrency=1, max_wait_ms=10000)
+    held = controller.admit('a')
+    started = time.monotonic()
+    with pytest.raises(Overloaded):
+        controller.admit('b', deadline=Deadline(50))
+    assert time.monotonic() - started < 2
+    held.release()
+
+
+def test_hopeless_wait_is_refused_with_retry_after():
+    controller = AdmissionController(concurrency=1, max_wait_ms=5000)
+    slow = controller.admit('a')
+    # Generations have been holding their slot for about 9.5s
+    slow.started -= 9.5
+    slow.release()
+    assert abs(controller.stats()['holdSeconds'] - 9.5) < 0.1
+
+    held = controller.admit('a')
+    with pytest.raises(Overloaded) as excinfo:
+        controller.admit('b')
+    assert excinfo.value.reason == 'wait_too_long'
+    assert excinfo.value.retry_after == 10
+    # A longer budget would have let it queue
+    controller.max_wait = 30
+    controller.check('b')
+    held.release()
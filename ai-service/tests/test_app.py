@@ -0,0 +1,96 @@
+import functools
+import io
+import json
+import tarfile
+import threading
+
+import pytest
+
+from benchmarks.corpus import generate_document
+
+
+@pytest.fixture
+def app(start):
+    """The service module with its training directory and store pointed at scratch space"""
+    import app
+    return app
+
+
+def test_generate_answers_while_warming_up(app, monkeypatch):
+    release = threading.Event()
+    # As in a gunicorn worker under preload: built unwarmed, warmed after the fork
+    generator = app.ScriptGenerator(warm_up=False)
+    load = generator.load_training_data
+
+    def held_load():
+        release.wait(10)
+        load()
+    monkeypatch.setattr(generator, 'load_training_data', held_load)
+    monkeypatch.setattr(app, 'script_generator', generator)
+    generator.start_warmup()
+    client = app.app.test_client()
+
+    ready = client.get('/ready')
+    assert ready.status_code == 503
+    assert ready.get_json()['status'] == 'warming'
+    generated = client.post('/generate', json={'prompt': 'a detective on a rooftop at night'})
+    assert generated.status_code == 200
+    assert generated.get_json()['content']
+
+    release.set()
+    assert generator.wait_until_warm(60)
+    assert client.get('/ready').status_code == 200
+
+
+@pytest.fixture
+def bulk(app, start, monkeypatch):
+    """POST to /train/bulk, returning the response's NDJSON lines"""
+    import ingest
+    generator = start()
+    monkeypatch.setattr(app, 'script_generator', generator)
+    # Small batches and documents, and a progress line after every batch
+    monkeypatch.setattr(ingest, 'BULK_PROGRESS_SECONDS', 0)
+    monkeypatch.setattr(generator.bulk_ingester, 'run',
+                        functools.partial(ingest.BulkIngester.run, generator.bulk_ingester, batch_size=2))
+    monkeypatch.setitem(app.BULK_READERS, 'application/x-ndjson', functools.partial(ingest.read_ndjson, max_bytes=8192))
+    monkeypatch.setitem(app.BULK_READERS, 'application/x-tar', functools.partial(ingest.read_tar, max_bytes=8192))
+    client = app.app.test_client()
+
+    def post(body, content_type):
+        response = client.post('/train/bulk', data=body, content_type=content_type)
+        assert response.status_code == 200
+        return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    yield post
+    generator.bulk_ingester.close()
+
+
+def test_bulk_ndjson_upload(bulk):
+    lines = [json.dumps({'filename': filename, 'content': content})
+             for filename, content in (generate_document(index, seed=11) for index in range(100, 105))]
+    lines.insert(2, json.dumps({'filename': 'huge.txt', 'content': 'x' * 10000}))
+    lines.insert(4, '{not json')
+    events = bulk(('\n'.join(lines) + '\n').encode('utf-8'), 'application/x-ndjson')
+
+    *progress, summary = events
+    assert progress and all('progress' in event for event in progress)
+    assert progress[-1]['progress']['documents'] <= 5
+    assert summary['done'] is True
+    assert (summary['documents'], summary['failed']) == (5, 2)
+    assert summary['errors'] == ['line 3: document larger than 8192 bytes', 'line 5: invalid JSON']
+    assert summary['trainingDataCount'] == 45
+
+
+def test_bulk_tar_upload(bulk):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as archive:
+        files = [generate_document(index, seed=11) for index in range(200, 203)]
+        files += [('notes/readme.md', 'not a script'), ('big/huge.txt', 'x' * 10000)]
+        for filename, content in files:
+            data = content.encode('utf-8')
+            member = tarfile.TarInfo(filename)
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+    summary = bulk(buffer.getvalue(), 'application/x-tar')[-1]
+    assert (summary['documents'], summary['failed']) == (3, 1)
+    assert summary['errors'] == ['big/huge.txt: document larger than 8192 bytes']
+    assert summary['trainingDataCount'] == 43
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+
+import pytest
+
+from cache import ResponseCache
+from resilience import DeadlineExceeded
+
+
+def slow(value, started, release):
+    def compute():
+        started.set()
+        release.wait(5)
+        return value
+    return compute
+
+
+def test_identical_requests_share_one_call():
+    cache = ResponseCache(ttl=60)
+    started, release = threading.Event(), threading.Event()
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get_or_compute('k', slow('a', started, release))))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(cache.get_or_compute('k', lambda: 'b')))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+    assert results == ['a', 'a']
+    assert cache.coalesced == 1
+    assert cache.get('k') == 'a'
+
+
+def test_follower_gives_up_after_its_timeout():
+    cache = ResponseCache(ttl=60)
+    started, release = threading.Event(), threading.Event()
+    leader = threading.Thread(target=cache.get_or_compute, args=('k', slow('a', started, release)))
+    leader.start()
+    started.wait(5)
+    began = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        cache.get_or_compute('k', lambda: 'b', timeout=0.05)
+    assert time.monotonic() - began < 1
+    release.set()
+    leader.join()
+
+
+def test_bypass_neither_caches_nor_joins():
+    cache = ResponseCache(ttl=60)
+    cache.put('k', 'cached')
+    started, release = threading.Event(), threading.Event()
+    leader = threading.Thread(target=cache.get_or_compute, args=('j', slow('a', started, release)))
+    leader.start()
+    started.wait(5)
+    assert cache.get_or_compute('k', lambda: 'fresh', bypass=True) == 'fresh'
+    assert cache.get_or_compute('j', lambda: 'own', bypass=True) == 'own'
+    assert cache.coalesced == 0
+    assert cache.get('k') == 'cached'
+    release.set()
+    leader.join()
+
+
+def swept(cache):
+    """Wait for the running disk sweep, then run one more over everything written so far"""
+    cache._sweeper.join()
+    cache._start_sweep()
+    cache._sweeper.join()
+    return cache
+
+
+def test_disk_tier_is_capped(tmp_path):
+    cache = ResponseCache(ttl=60, disk_dir=str(tmp_path), disk_max_entries=10)
+    for number in range(11):
+        cache.put(f"k{number}", f"v{number}")
+    # Trimmed to the low-water mark, not just under the cap
+    assert len(os.listdir(swept(cache).disk_dir)) == 9
+    # The newest entries survive
+    assert ResponseCache(ttl=60, disk_dir=str(tmp_path)).get('k10') == 'v10'
+
+
+def test_sweep_counts_other_workers_files(tmp_path):
+    other = ResponseCache(ttl=60, disk_dir=str(tmp_path))
+    for number in range(8):
+        other.put(f"other{number}", 'value')
+    cache = swept(ResponseCache(ttl=60, disk_dir=str(tmp_path), disk_max_entries=10, sweep_seconds=0))
+    for number in range(3):
+        cache.put(f"mine{number}", 'value')
+    assert len(os.listdir(swept(cache).disk_dir)) == 9
+
+
+def test_sweep_runs_off_the_request_path(tmp_path):
+    cache = ResponseCache(ttl=60, disk_dir=str(tmp_path), disk_max_entries=1)
+    cache._sweeper.join()
+    cache._sweep_lock.acquire()
+    # A sweep already running doesn't hold up writes that would start another
+    cache.put('a', 'value')
+    cache.put('b', 'value')
+    assert sorted(os.listdir(tmp_path)) == ['a.json', 'b.json']
+    cache._sweep_lock.release()
+    assert os.listdir(swept(cache).disk_dir) == ['b.json']
+
+
+def test_sweep_removes_expired_disk_entries(tmp_path):
+    cache = ResponseCache(ttl=0.01, disk_dir=str(tmp_path))
+    cache.put('old', 'value')
+    time.sleep(0.05)
+    ResponseCache(ttl=60, disk_dir=str(tmp_path))._sweeper.join()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,60 @@
+from context_packer import HEADER_TOKENS, ContextChunk, estimate_tokens, format_chunks, pack_chunks
+
+SCENES = {
+    'rooftop': 'INT. ROOFTOP - NIGHT\nThe detective watches the city lights flicker below the water tower.',
+    'kitchen': 'INT. KITCHEN - DAY\nMarta slices lemons while the radio plays an old waltz.',
+    'harbour': 'EXT. HARBOUR - DAWN\nFishing boats drift past rusted cranes as gulls circle overhead.',
+    'library': 'INT. LIBRARY - EVENING\nA librarian stamps overdue cards beside a humming lamp.',
+}
+
+
+def chunk(score, name, text=None, doc_id=None, start=0):
+    return ContextChunk(score, doc_id if doc_id is not None else hash(name) % 1000, start, name,
+                        SCENES[name] if text is None else text)
+
+
+def cost(name):
+    return estimate_tokens(SCENES[name]) + HEADER_TOKENS
+
+
+def test_best_chunks_that_fit_the_budget():
+    candidates = [chunk(5, 'kitchen'), chunk(9, 'rooftop'), chunk(7, 'harbour')]
+    assert [c.name for c in pack_chunks(candidates, 10_000)] == ['rooftop', 'harbour', 'kitchen']
+    # Room for exactly the two best
+    budget = cost('rooftop') + cost('harbour')
+    assert [c.name for c in pack_chunks(candidates, budget)] == ['rooftop', 'harbour']
+
+
+def test_oversized_chunk_is_skipped_for_smaller_ones():
+    long_scene = SCENES['harbour'] + ' ' + ' '.join(f"crate{i}" for i in range(200))
+    candidates = [chunk(9, 'rooftop'), chunk(8, 'harbour', long_scene), chunk(6, 'kitchen')]
+    budget = cost('rooftop') + cost('kitchen')
+    assert [c.name for c in pack_chunks(candidates, budget)] == ['rooftop', 'kitchen']
+
+
+def test_weak_matches_fall_below_the_relative_floor():
+    candidates = [chunk(10, 'rooftop'), chunk(3, 'kitchen'), chunk(2, 'harbour')]
+    assert [c.name for c in pack_chunks(candidates, 10_000)] == ['rooftop', 'kitchen']
+    assert pack_chunks([], 10_000) == []
+
+
+def test_exact_and_near_duplicates_are_skipped():
+    reworded = SCENES['rooftop'].replace('watches', 'WATCHES').replace('\n', '  \n ')
+    near = SCENES['rooftop'].replace('flicker', 'shimmer')
+    candidates = [chunk(9, 'rooftop'), chunk(8, 'rooftop', reworded, doc_id=1),
+                  chunk(7, 'rooftop', near, doc_id=2), chunk(6, 'library')]
+    picked = pack_chunks(candidates, 10_000)
+    assert [(c.name, c.score) for c in picked] == [('rooftop', 9), ('library', 6)]
+
+
+def test_empty_chunks_are_skipped():
+    assert [c.name for c in pack_chunks([chunk(9, 'rooftop', ''), chunk(8, 'kitchen')], 10_000)] == ['kitchen']
+
+
+def test_format_groups_by_script_in_reading_order():
+    chunks = [chunk(4, 'kitchen', doc_id=2, start=0), chunk(9, 'rooftop', doc_id=1, start=500),
+              chunk(6, 'library', doc_id=1, start=10)]
+    formatted = format_chunks(chunks)
+    order = [formatted.index(SCENES[name]) for name in ('library', 'rooftop', 'kitchen')]
+    assert order == sorted(order)
+    assert '--- Training Script: rooftop (Relevance: 9.0) ---' in formatted
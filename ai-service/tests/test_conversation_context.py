@@ -0,0 +1,70 @@
+from conversation_context import OMITTED_MARKER, ConversationContext, summarize_turn
+
+SCENE = 'INT. DINER - NIGHT\n\nMARTA\nMore coffee?\n\nJOE\nJust the check.\n'
+
+
+def conversation(count):
+    """Alternating user prompts and assistant replies, numbered so summaries can be told apart"""
+    return [{'type': 'user', 'content': f"prompt {i}"} if i % 2 == 0 else
+            {'type': 'assistant', 'content': f"reply {i}"} for i in range(count)]
+
+
+def summary_lines(rendered):
+    summary = rendered.split('\n\n')[0]
+    assert summary.startswith('Conversation summary:')
+    return [line[2:] for line in summary.split('\n')[1:]]
+
+
+def test_short_history_is_passed_through():
+    context = ConversationContext(raw_turns=4)
+    assert context.render([]) is None
+    # The trailing user message is the request itself
+    assert context.render([{'type': 'user', 'content': 'a diner'}], prompt='a diner') is None
+    rendered = context.render(conversation(3), conversation_id='c')
+    assert rendered == 'Recent turns:\nUser: prompt 0\nAssistant: reply 1\nUser: prompt 2'
+
+
+def test_each_turn_is_folded_once():
+    context = ConversationContext(raw_turns=4)
+    first = context.render(conversation(10), conversation_id='c')
+    assert context.folded == 6
+    assert summary_lines(first) == ['User asked for: prompt 0', 'Assistant replied: reply 1', 'User asked for: prompt 2',
+                                    'Assistant replied: reply 3', 'User asked for: prompt 4',
+                                    'Assistant replied: reply 5']
+    assert first.endswith('Assistant: reply 9')
+
+    # Two more messages: only the two that aged out are summarized
+    second = context.render(conversation(12), conversation_id='c')
+    assert context.folded == 8
+    assert summary_lines(second)[-2:] == ['User asked for: prompt 6', 'Assistant replied: reply 7']
+    # The same request again folds nothing
+    assert context.render(conversation(12), conversation_id='c') == second
+    assert context.folded == 8
+
+
+def test_rewritten_history_starts_over():
+    context = ConversationContext(raw_turns=2)
+    context.render(conversation(10), conversation_id='c')
+    # The conversation was cut back to fewer messages than were folded
+    rewritten = [{'type': 'user', 'content': 'start again'}, {'type': 'assistant', 'content': 'fresh'},
+                 {'type': 'user', 'content': 'and again'}]
+    rendered = context.render(rewritten, conversation_id='c')
+    assert summary_lines(rendered) == ['User asked for: start again']
+    assert 'reply' not in rendered
+
+
+def test_turns_sent_only_as_a_tail_are_marked_omitted():
+    context = ConversationContext(raw_turns=4)
+    tail = conversation(20)[14:]
+    rendered = context.render(tail, conversation_id='c', message_count=20)
+    assert summary_lines(rendered) == [OMITTED_MARKER, 'User asked for: prompt 14', 'Assistant replied: reply 15']
+    # Later requests keep the marker once rather than adding another
+    rendered = context.render(conversation(22)[16:], conversation_id='c', message_count=22)
+    assert summary_lines(rendered).count(OMITTED_MARKER) == 1
+    assert summary_lines(rendered)[-1] == 'Assistant replied: reply 17'
+
+
+def test_scene_replies_are_summarized_by_heading_and_cast():
+    assert summarize_turn('assistant', SCENE) == 'Assistant wrote a scene set in INT. DINER - NIGHT with MARTA, JOE'
+    assert summarize_turn('assistant', 'MOVIE OUTLINE: Night Shift\n1. ...') == \
+        'Assistant outlined: MOVIE OUTLINE: Night Shift'
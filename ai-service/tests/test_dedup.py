@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from dedup import DedupIndex, minhash
+
+
+@pytest.fixture
+def training_dir(tmp_path):
+    """Training files where about a third of the scripts are edits of earlier ones"""
+    from benchmarks.corpus import iter_corpus
+    directory = tmp_path / 'training'
+    for filename, content in iter_corpus(40, seed=7, duplicate_rate=0.3):
+        path = directory / filename
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding='utf-8')
+    return directory
+
+
+def clusters(generator):
+    dedup = generator.dedup
+    return [dedup.match(doc_id) for doc_id in range(len(generator.training_data))], dedup.stats()
+
+
+def test_restart_restores_clusters_without_rebuilding(start, monkeypatch):
+    first = start()
+    assert first.dedup.duplicates > 0
+    rebuilt = []
+    rebuild = DedupIndex.rebuild
+    monkeypatch.setattr(DedupIndex, 'rebuild', lambda self, documents: rebuilt.append(len(documents))
+                        or rebuild(self, documents))
+    second = start()
+    # Only the empty store the generator starts with
+    assert rebuilt == [0]
+    assert clusters(second) == clusters(first)
+    doc_id = next(doc_id for doc_id in range(1, 40) if second.dedup.match(doc_id) is None)
+    assert second.dedup.find(minhash(second.training_data[doc_id].content))[0] == doc_id
+
+
+def test_deleting_a_restored_cluster_member(start):
+    first = start()
+    doc_id = next(doc_id for doc_id in range(40) if first.dedup.match(doc_id))
+    original = first.dedup.match(doc_id)[0]
+    first.reload_training_files([], [original])
+    second = start()
+    assert second.dedup.match(doc_id) is not None
+    signature = minhash(second.training_data[original].content)
+    match = second.dedup.find(signature)
+    assert match is not None and match[0] != original
+
+
+def test_batch_records_match_each_other(start):
+    generator = start()
+    content = 'INT. OBSERVATORY - NIGHT\n\n' + ' '.join(f"word{i}" for i in range(300)) + '\n'
+    records = [generator._training_record({'filename': f"batch/{name}.txt", 'content': text})
+               for name, text in (('first', content), ('second', content.replace('word7 ', 'word7b ')))]
+    doc_ids, duplicates = generator.commit_training_records(records)
+    assert duplicates[0] is None
+    assert duplicates[1]['docId'] == doc_ids[0]
+    assert duplicates[1]['filename'] == 'batch/first.txt'
+
+
+def test_bucket_keys_are_stable_across_processes():
+    code = ('from dedup import DedupIndex, minhash; '
+            'print(DedupIndex()._keys(minhash("a b c d e f g h i j k l")))')
+    outputs = {subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.dirname(__file__)),
+                              env=dict(os.environ, PYTHONHASHSEED=seed)).stdout
+               for seed in ('1', '2')}
+    assert len(outputs) == 1
+
+
+def test_numpy_loads_on_first_use():
+    code = ('import sys, dedup, semantic_index; loaded = "numpy" in sys.modules; '
+            'dedup.minhash("a b c d e f"); print(loaded, "numpy" in sys.modules)')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(__file__))).stdout
+    assert output.split() == ['False', 'True']
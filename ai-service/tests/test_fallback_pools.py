@@ -0,0 +1,53 @@
+from document_store import DocumentStore, element_spans
+from fallback_pools import FallbackPools
+from ingest import parse_elements
+
+SCRIPTS = {
+    'drama/alpha.txt': 'INT. ALPHA HOUSE - DAY\n\nRain taps the alpha window.\n',
+    'drama/beta.txt': 'INT. BETA HOUSE - NIGHT\n\nThe beta kettle screams.\n',
+    'comedy/gamma.txt': 'EXT. GAMMA PIER - DAWN\n\nGulls steal a gamma sandwich.\n',
+}
+
+
+def store():
+    documents = DocumentStore()
+    for filename, content in SCRIPTS.items():
+        documents.append(content, filename=filename, spans=element_spans(content, parse_elements(content)))
+    return documents
+
+
+def scene(pools, doc_id=None, prompt='a quiet house'):
+    picked = pools.pick(prompt, 'scene_description', 'scenes', doc_id)
+    return picked[0] if picked else None
+
+
+def test_picks_from_the_document_then_its_category_then_the_corpus():
+    documents = store()
+    pools = FallbackPools()
+    pools.refresh(documents)
+    assert scene(pools, 0) == 'INT. ALPHA HOUSE - DAY'
+    assert scene(pools, 2) == 'EXT. GAMMA PIER - DAWN'
+    documents.delete([0])
+    # The deleted script's own entries are stepped over; its category still has one
+    assert scene(pools, 0) == 'INT. BETA HOUSE - NIGHT'
+    documents.delete([1])
+    assert scene(pools, 0) == 'EXT. GAMMA PIER - DAWN'
+    documents.delete([2])
+    assert scene(pools, 0) is None and scene(pools) is None
+
+
+def test_saved_pools_skip_documents_deleted_later(tmp_path):
+    documents = store()
+    pools = FallbackPools()
+    pools.save(str(tmp_path), documents, len(documents))
+    opened = FallbackPools.open(str(tmp_path), documents)
+    assert opened.stats() == pools.stats()
+    for prompt in ('a quiet house', 'pier at dawn', 'kettle'):
+        assert scene(opened, None, prompt) == scene(pools, None, prompt)
+    documents.delete([1])
+    assert scene(opened, 1) == 'INT. ALPHA HOUSE - DAY'
+    assert all(scene(opened, None, prompt) != 'INT. BETA HOUSE - NIGHT' for prompt in map(str, range(20)))
+
+
+def test_missing_pools_open_as_none(tmp_path):
+    assert FallbackPools.open(str(tmp_path), store()) is None
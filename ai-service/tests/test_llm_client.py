@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+
+import llm_client
+from llm_client import LLMClient, LLMError
+
+MESSAGES = [{'role': 'user', 'content': 'a scene'}]
+
+
+def client_for(handler, **settings):
+    # The client normally imports httpx when it starts its loop; the mock transport needs it first
+    llm_client._import_httpx()
+    return LLMClient('key', base_url='http://upstream.test', transport=httpx.MockTransport(handler), **settings)
+
+
+def wait_for_idle(client, timeout=2.0):
+    """Wait for cancelled calls on the client loop to hand back their slots"""
+    stop = time.monotonic() + timeout
+    while client.in_flight or client._semaphore.locked():
+        assert time.monotonic() < stop, 'slot still held'
+        time.sleep(0.01)
+
+
+def test_retries_then_succeeds():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) < 2:
+            return httpx.Response(503, headers={'Retry-After': '0'})
+        return httpx.Response(200, json={'choices': [{'message': {'content': 'FADE IN:'}}],
+                                         'usage': {'prompt_tokens': 3, 'completion_tokens': 2}})
+
+    client = client_for(handler, max_retries=2)
+    assert client.complete(MESSAGES, 'model', 10, 0.3, timeout=5) == 'FADE IN:'
+    assert len(calls) == 2
+    assert client.usage == {'prompt': 3, 'completion': 2}
+
+
+def test_retries_stop_when_the_budget_is_spent():
+    def handler(request):
+        return httpx.Response(503, headers={'Retry-After': '0.3'})
+
+    client = client_for(handler, max_retries=10)
+    started = time.monotonic()
+    with pytest.raises(LLMError) as raised:
+        client.chat_completion(MESSAGES, 'model', 10, 0.3, timeout=0.5)
+    assert raised.value.status == 503
+    assert time.monotonic() - started < 0.5
+    assert client.in_flight == 0
+
+
+def test_bad_request_is_not_retried():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(400, text='bad')
+
+    client = client_for(handler, max_retries=3)
+    with pytest.raises(LLMError) as raised:
+        client.chat_completion(MESSAGES, 'model', 10, 0.3, timeout=5)
+    assert raised.value.status == 400
+    assert len(calls) == 1
+
+
+def test_concurrency_slot_wait_is_bounded():
+    client = client_for(lambda request: httpx.Response(200, json={}), max_concurrency=1)
+    loop = client._event_loop()
+    asyncio.run_coroutine_threadsafe(client._semaphore.acquire(), loop).result()
+    started = time.monotonic()
+    with pytest.raises(LLMError):
+        client.chat_completion(MESSAGES, 'model', 10, 0.3, timeout=0.1)
+    assert time.monotonic() - started < 0.5
+
+
+def test_cancelled_call_takes_no_slot():
+    calls = []
+    client = client_for(lambda request: calls.append(request) or httpx.Response(200, json={}))
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(LLMError):
+        client.chat_completion(MESSAGES, 'model', 10, 0.3, timeout=5, cancel=cancel)
+    assert calls == [] and client.in_flight == 0
+
+
+def test_cancel_stops_retries():
+    calls = []
+    cancel = threading.Event()
+
+    def handler(request):
+        calls.append(request)
+        cancel.set()
+        return httpx.Response(503, headers={'Retry-After': '2'})
+
+    client = client_for(handler, max_retries=5)
+    started = time.monotonic()
+    with pytest.raises(LLMError):
+        client.chat_completion(MESSAGES, 'model', 10, 0.3, timeout=5, cancel=cancel)
+    assert len(calls) == 1
+    assert time.monotonic() - started < 1
+    wait_for_idle(client)
+
+
+def test_abandoned_call_gives_back_its_slot():
+    async def handler(request):
+        await asyncio.sleep(5)
+        return httpx.Response(200, json={})
+
+    client = client_for(handler, max_concurrency=1)
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    started = time.monotonic()
+    with pytest.raises(LLMError):
+        client.chat_completion(MESSAGES, 'model', 10, 0.3, timeout=10, cancel=cancel)
+    assert time.monotonic() - started < 1
+    wait_for_idle(client)
+
+
+def test_many_calls_in_flight_on_one_loop():
+    async def handler(request):
+        await asyncio.sleep(0.2)
+        return httpx.Response(200, json={'choices': [{'message': {'content': 'ok'}}]})
+
+    client = client_for(handler, max_concurrency=50)
+
+    async def fan_out():
+        return await asyncio.gather(*(client.acomplete(MESSAGES, 'model', 10, 0.3, timeout=5) for _ in range(50)))
+
+    started = time.monotonic()
+    assert client._run(fan_out()) == ['ok'] * 50
+    assert time.monotonic() - started < 2
+
+
+def test_stream_yields_deltas():
+    body = (b'data: {"choices":[{"delta":{"content":"INT. "}}]}\n\n'
+            b'data: {"choices":[{"delta":{"content":"DINER"}}]}\n\ndata: [DONE]\n\n')
+    client = client_for(lambda request: httpx.Response(200, content=body))
+    assert ''.join(client.stream_complete(MESSAGES, 'model', 10, 0.3, timeout=5)) == 'INT. DINER'
+
+
+def test_closing_a_stream_gives_back_its_slot():
+    async def lines():
+        yield b'data: {"choices":[{"delta":{"content":"INT. "}}]}\n\n'
+        await asyncio.sleep(5)
+        yield b'data: [DONE]\n\n'
+
+    client = client_for(lambda request: httpx.Response(200, content=lines()), max_concurrency=1)
+    stream = client.stream_complete(MESSAGES, 'model', 10, 0.3, timeout=10)
+    assert next(stream) == 'INT. '
+    stream.close()
+    wait_for_idle(client)
@@ -0,0 +1,118 @@
+import contextlib
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from llm_client import LLMError
+from local_llm import PREFIX_MIN_TOKENS, LocalLLM, common_prefix_length
+
+SYSTEM = {'role': 'system', 'content': 'You are a screenwriter. Write in screenplay format.'}
+
+
+class FakeModel:
+    """Stands in for the causal LM: records prefix passes, and generate() echoes each prompt"""
+
+    def __init__(self):
+        self.prefix_passes = []
+        self.batches = []
+
+    def __call__(self, input_ids, use_cache):
+        self.prefix_passes.append(input_ids[0])
+        return SimpleNamespace(past_key_values=('cache', len(input_ids[0])))
+
+
+@pytest.fixture
+def llm(tmp_path, monkeypatch):
+    (tmp_path / 'config.json').write_text('{}')
+    llm = LocalLLM(model_dir=str(tmp_path), max_batch=3, batch_wait_ms=200)
+    model = FakeModel()
+
+    def load():
+        # Character codes as tokens, and plain lists for tensors
+        llm._tokenizer = lambda text: {'input_ids': [ord(c) for c in text]}
+        llm._torch = SimpleNamespace(no_grad=contextlib.nullcontext, tensor=lambda data: data)
+        llm._model = model
+
+    def generate(batch):
+        llm._shared_prefix([llm._prompt_ids(r.messages) for r in batch])
+        model.batches.append([r.messages[-1]['content'] for r in batch])
+        for r in batch:
+            r.emit(f"echo {r.messages[-1]['content']}")
+    monkeypatch.setattr(llm, '_load', load)
+    monkeypatch.setattr(llm, '_generate', generate)
+    yield llm
+    llm.close()
+
+
+def ask(llm, prompts, temperature=0.3):
+    """Send prompts concurrently; returns {prompt: text or error}"""
+    results = {}
+
+    def run(prompt):
+        try:
+            results[prompt] = llm.complete([SYSTEM, {'role': 'user', 'content': prompt}], 'local', 16, temperature,
+                                           timeout=10)
+        except LLMError as e:
+            results[prompt] = e
+    threads = [threading.Thread(target=run, args=(prompt,)) for prompt in prompts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_requests_share_a_batch(llm):
+    prompts = ['diner', 'rooftop', 'harbour', 'library']
+    results = ask(llm, prompts)
+    assert results == {prompt: f"echo {prompt}" for prompt in prompts}
+    batches = llm._model.batches
+    assert sorted(len(batch) for batch in batches) == [1, 3]
+    assert llm.in_flight == 0
+
+
+def test_requests_with_other_sampling_settings_wait_for_their_own_batch(llm):
+    results = {}
+    threads = [threading.Thread(target=lambda: results.update(ask(llm, ['cold'], temperature=0.0)))]
+    threads[0].start()
+    results.update(ask(llm, ['warm-1', 'warm-2']))
+    threads[0].join()
+    assert set(results) == {'cold', 'warm-1', 'warm-2'}
+    for batch in llm._model.batches:
+        assert batch == ['cold'] or 'cold' not in batch
+
+
+def test_shared_prompt_prefix_is_computed_once(llm):
+    ask(llm, ['diner', 'rooftop'])
+    ask(llm, ['harbour', 'library'])
+    model = llm._model
+    # One forward pass over the shared start of the prompts, reused by the second batch
+    assert len(model.prefix_passes) == 1
+    assert len(model.prefix_passes[0]) >= PREFIX_MIN_TOKENS
+    assert llm.prefix_hits >= 1
+    assert llm.stats()['prefixTokens'] == len(model.prefix_passes[0])
+
+
+def test_prefix_needs_two_prompts_to_learn_from(llm):
+    llm._load()
+    rows = [[1] * 40 + [2, 3]]
+    assert llm._shared_prefix(rows) is None
+    # The previous request is the second prompt
+    assert llm._shared_prefix([[1] * 40 + [4]]) is not None
+    assert llm._model.prefix_passes == [[1] * 40]
+
+
+def test_model_that_fails_to_load_fails_requests(llm, monkeypatch):
+    def broken():
+        raise OSError('no weights')
+    monkeypatch.setattr(llm, '_load', broken)
+    result = ask(llm, ['diner'])['diner']
+    assert isinstance(result, LLMError) and 'no weights' in str(result)
+    assert llm.stats()['loadError'] == 'no weights'
+
+
+def test_common_prefix_length():
+    assert common_prefix_length([[1, 2, 3], [1, 2, 4], [1, 2]]) == 2
+    assert common_prefix_length([[5, 6]]) == 2
+    assert common_prefix_length([]) == 0
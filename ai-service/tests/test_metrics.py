@@ -0,0 +1,66 @@
+import os
+
+from metrics import Registry
+
+WORKER_PID = 424242
+
+
+def worker_registry(directory):
+    """Registry with the service's kinds of metrics, as each worker builds it"""
+    registry = Registry(str(directory))
+    registry.requests = registry.counter('requests_total', 'Requests', ('endpoint',))
+    registry.queued = registry.gauge('queued', 'Queued generations')
+    registry.seconds = registry.histogram('stage_seconds', 'Stage time', ('stage',), buckets=(0.1, 1.0))
+    return registry
+
+
+def samples(text, name):
+    return sorted(line for line in text.splitlines() if line.startswith(name + '{') or line.startswith(name + ' '))
+
+
+def test_workers_are_merged(tmp_path):
+    here, other = worker_registry(tmp_path), worker_registry(tmp_path)
+    here.requests.inc(endpoint='generate')
+    here.queued.set(3)
+    here.seconds.observe(0.05, stage='upstream')
+    other.requests.inc(2, endpoint='generate')
+    other.requests.inc(endpoint='scripts')
+    other.queued.set(5)
+    other.seconds.observe(0.5, stage='upstream')
+    other.seconds.observe(7.0, stage='upstream')
+    other._write(WORKER_PID, other.snapshot())
+
+    text = here.render()
+    # Counters and histograms add up across workers, gauges stay per process
+    assert samples(text, 'requests_total') == ['requests_total{endpoint="generate"} 3',
+                                               'requests_total{endpoint="scripts"} 1']
+    assert samples(text, 'queued') == sorted([f'queued{{pid="{os.getpid()}"}} 3', f'queued{{pid="{WORKER_PID}"}} 5'])
+    assert samples(text, 'stage_seconds_bucket') == ['stage_seconds_bucket{stage="upstream",le="+Inf"} 3',
+                                                     'stage_seconds_bucket{stage="upstream",le="0.1"} 1',
+                                                     'stage_seconds_bucket{stage="upstream",le="1.0"} 2']
+    assert samples(text, 'stage_seconds_count') == ['stage_seconds_count{stage="upstream"} 3']
+    assert samples(text, 'stage_seconds_sum') == ['stage_seconds_sum{stage="upstream"} 7.55']
+    assert '# TYPE stage_seconds histogram' in text
+
+
+def test_dead_worker_keeps_counters_but_not_gauges(tmp_path):
+    here, other = worker_registry(tmp_path), worker_registry(tmp_path)
+    other.requests.inc(4, endpoint='generate')
+    other.queued.set(9)
+    other._write(WORKER_PID, other.snapshot())
+
+    here.mark_process_dead(WORKER_PID)
+    text = here.render()
+    assert samples(text, 'requests_total') == ['requests_total{endpoint="generate"} 4']
+    assert str(WORKER_PID) not in text
+    # A pid that never wrote anything is ignored
+    here.mark_process_dead(WORKER_PID + 1)
+    assert not os.path.exists(tmp_path / f"{WORKER_PID + 1}.json")
+
+
+def test_collectors_report_at_scrape_time(tmp_path):
+    registry = worker_registry(tmp_path)
+    hits = [0]
+    registry.collector(lambda: [('cache_hits_total', 'counter', 'Cache hits', {'tier': 'memory'}, hits[0])])
+    hits[0] = 7
+    assert samples(registry.render(), 'cache_hits_total') == ['cache_hits_total{tier="memory"} 7']
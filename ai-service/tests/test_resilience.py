@@ -0,0 +1,165 @@
+import threading
+import time
+
+import pytest
+
+from llm_client import LLMError
+from resilience import BreakerOpen, CircuitBreaker, Deadline, DeadlineExceeded, UpstreamGuard
+
+
+def open_breaker(guard):
+    """Trip a threshold-1 breaker with one outage and wait out its cool-down"""
+    guard.budget(Deadline(5000))
+    guard.record_outcome(time.monotonic(), LLMError('unavailable', 503))
+    assert guard.breaker.state == CircuitBreaker.OPEN
+    time.sleep(guard.breaker.reset_seconds * 2)
+
+
+@pytest.fixture
+def guard():
+    return UpstreamGuard(breaker=CircuitBreaker(failure_threshold=1, reset_seconds=0.01), workers=2)
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=60)
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.rejected == 1
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_lets_one_probe_through(guard):
+    open_breaker(guard)
+    guard.budget(Deadline(5000))
+    assert guard.breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(BreakerOpen):
+        guard.budget(Deadline(5000))
+
+
+def test_successful_probe_closes_breaker(guard):
+    open_breaker(guard)
+    guard.budget(Deadline(5000))
+    guard.record_outcome(time.monotonic())
+    assert guard.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_reopens_breaker(guard):
+    open_breaker(guard)
+    guard.budget(Deadline(5000))
+    guard.record_outcome(time.monotonic(), LLMError('unavailable', 503))
+    assert guard.breaker.state == CircuitBreaker.OPEN
+
+
+def test_bad_request_probe_frees_the_probe_slot(guard):
+    open_breaker(guard)
+    guard.budget(Deadline(5000))
+    guard.record_outcome(time.monotonic(), LLMError('bad request', 400))
+    # Neither healthy nor unhealthy: the next call may probe again
+    guard.budget(Deadline(5000))
+
+
+def test_released_probe_frees_the_probe_slot(guard):
+    open_breaker(guard)
+    guard.budget(Deadline(5000))
+    guard.release()
+    guard.budget(Deadline(5000))
+
+
+def test_call_returns_result_and_records_success(guard):
+    assert guard.call(lambda timeout, cancel: 'scene', Deadline(5000)) == 'scene'
+    assert guard.breaker.consecutive_failures == 0
+
+
+def test_call_raises_upstream_error(guard):
+    def fail(timeout, cancel):
+        raise LLMError('unavailable', 503)
+
+    with pytest.raises(LLMError):
+        guard.call(fail, Deadline(5000))
+    assert guard.breaker.state == CircuitBreaker.OPEN
+
+
+def test_call_gives_up_at_deadline():
+    guard = UpstreamGuard(breaker=CircuitBreaker(failure_threshold=5), reserve_ms=0, workers=2)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        guard.call(lambda timeout, cancel: time.sleep(1), Deadline(100))
+    assert time.monotonic() - started < 0.5
+
+
+def test_spent_budget_skips_upstream():
+    guard = UpstreamGuard(reserve_ms=250, workers=2)
+    with pytest.raises(DeadlineExceeded):
+        guard.budget(Deadline(100))
+
+
+def test_attempt_gets_the_budget_left_when_it_starts():
+    guard = UpstreamGuard(reserve_ms=0, workers=1)
+    budgets = []
+    busy = threading.Event()
+    # The only executor thread is taken for 200ms before the call is queued
+    guard._executor.submit(busy.wait, 0.2)
+    assert guard.call(lambda timeout, cancel: budgets.append(timeout), Deadline(1000)) is None
+    assert budgets[0] <= 0.8 + 0.05
+
+
+def test_abandoned_attempt_sees_cancel():
+    guard = UpstreamGuard(reserve_ms=0, workers=2)
+    seen = []
+
+    def slow(timeout, cancel):
+        seen.append(cancel.wait(2))
+
+    with pytest.raises(DeadlineExceeded):
+        guard.call(slow, Deadline(100))
+    guard._executor.shutdown(wait=True)
+    assert seen == [True]
+
+
+def hedging_guard(latencies):
+    guard = UpstreamGuard(hedge=True, reserve_ms=0, workers=4)
+    for latency in latencies:
+        guard.latency.record(latency)
+    return guard
+
+
+def test_hedge_wins_over_a_stalled_attempt():
+    guard = hedging_guard([0.05] * 20)
+    calls = []
+
+    def fn(timeout, cancel):
+        calls.append(timeout)
+        if len(calls) == 1:
+            cancel.wait(2)
+            return 'stalled'
+        return 'hedge'
+
+    assert guard.call(fn, Deadline(1000)) == 'hedge'
+    assert guard.hedges_sent == 1 and guard.hedges_won == 1
+    # The hedge's budget ends with the call's, not a fresh one
+    assert calls[1] < calls[0] <= 1.0
+
+
+def test_no_hedge_without_time_for_a_typical_reply():
+    guard = hedging_guard([0.1] * 10 + [0.5] * 10)
+    calls = []
+
+    def fn(timeout, cancel):
+        calls.append(timeout)
+        cancel.wait(2)
+
+    # p95 is 0.5s, leaving less than the 0.5s median once it has passed
+    with pytest.raises(DeadlineExceeded):
+        guard.call(fn, Deadline(800))
+    assert guard.hedges_sent == 0 and len(calls) == 1
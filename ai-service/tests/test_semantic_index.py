@@ -0,0 +1,82 @@
+import time
+
+import pytest
+
+import app
+from benchmarks.corpus import generate_document
+from semantic_index import SemanticIndex, SemanticModel
+
+
+def test_unreducible_corpus_is_not_refitted_on_every_commit(start, monkeypatch):
+    fits = []
+    # The service's own generator, warming since import, must not fit into this one's list
+    assert app.script_generator.wait_until_warm(60)
+    monkeypatch.setattr(app, 'SEMANTIC_RETRIEVAL', True)
+    monkeypatch.setattr(app, 'fit_semantic_index', lambda snapshot, count: fits.append(count))
+    generator = start()
+    assert len(fits) == 1 and generator.semantic is None
+    tried = fits[0]
+
+    generator.add_training_item({'filename': 'late/one.txt', 'content': generate_document(100, seed=7)[1]})
+    time.sleep(0.05)
+    assert not generator._semantic_stale()
+    assert len(fits) == 1
+
+    index = 101
+    while generator._chunk_count() < tried * app.SEMANTIC_REFIT_GROWTH:
+        generator.add_training_item({'filename': f"late/{index}.txt", 'content': generate_document(index, seed=7)[1]})
+        index += 1
+    deadline = time.monotonic() + 5
+    while len(fits) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fits[1] >= tried * app.SEMANTIC_REFIT_GROWTH
+
+
+def toy_index():
+    """Two latent topics: rain/window and coffee/diner, with one base row per topic"""
+    np = pytest.importorskip('numpy')
+    components = np.array([[1, 0], [1, 0], [0, 1], [0, 1]], dtype=np.float32)
+    model = SemanticModel(['rain', 'window', 'coffee', 'diner'],
+                          np.ones(4, dtype=np.float32), components)
+    return SemanticIndex(model, np.array([[1, 0], [0, 1]], dtype=np.float32))
+
+
+def test_tail_rows_are_searched_with_the_base():
+    index = toy_index()
+    assert index.add(2, [{'window': 1}, {'diner': 2}])
+    # Only the next chunk ids can be appended
+    assert not index.add(7, [{'rain': 1}])
+    assert (len(index), index.fitted_rows) == (4, 2)
+    assert [chunk_id for _, chunk_id in index.search('rain', k=2)] == [0, 2]
+    assert [chunk_id for _, chunk_id in index.search('coffee', k=2)] == [1, 3]
+
+
+def test_blend_keeps_lexical_matches_and_adds_semantic_ones():
+    index = toy_index()
+    index.add(2, [{'window': 1}])
+    (blended,) = index.blend_many(['rain'], [[(10.0, 1)]], k=3, weight=0.3)
+    assert [chunk_id for _, chunk_id in blended] == [1, 0, 2]
+    assert blended[0][0] == pytest.approx(0.7)
+    assert blended[1][0] == pytest.approx(0.3)
+
+
+def test_blend_leaves_out_excluded_semantic_matches():
+    index = toy_index()
+    index.add(2, [{'window': 1}])
+    (blended,) = index.blend_many(['rain'], [[(10.0, 1)]], k=3, weight=0.3, exclude={0})
+    assert [chunk_id for _, chunk_id in blended] == [1, 2]
+
+
+def test_blend_scores_lexical_rows_the_index_has_not_reached():
+    index = toy_index()
+    (blended,) = index.blend_many(['rain'], [[(4.0, 9)]], k=1, weight=0.3)
+    assert blended[0][1] == 9 and blended[0][0] == pytest.approx(0.7)
+
+
+def test_saved_index_includes_the_tail(tmp_path):
+    index = toy_index()
+    index.add(2, [{'window': 1}, {'diner': 1}])
+    index.save(str(tmp_path), 3)
+    opened = SemanticIndex.open(str(tmp_path))
+    assert (len(opened), opened.fitted_rows) == (3, 2)
+    assert opened.search('rain', k=2) == index.search('rain', k=2)
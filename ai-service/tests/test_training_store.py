@@ -0,0 +1,157 @@
+import json
+import os
+
+import pytest
+
+from document_store import SPAN_WIDTH, summarize_elements
+from fallback_pools import FallbackPools
+from ingest import parse_elements
+from screenplay import chunk_spans
+from training_store import MappedTermTable, TrainingStore, write_term_table
+
+QUERIES = ('detective rooftop night', 'kitchen phone letter', 'silence rain window')
+
+
+def ranking(generator, query):
+    return [(round(score, 6), document.filename) for score, document in generator._retrieve_training_documents(query)]
+
+
+def test_restart_restores_documents_and_rankings(start):
+    first = start()
+    assert first.training_data.live_count == 40
+    second = start()
+    assert second.training_data.live_count == 40
+    assert second.store.snapshot_seq == 40
+    for query in QUERIES:
+        assert ranking(second, query) == ranking(first, query)
+
+
+def test_restart_reads_only_the_log_tail(start, tmp_path):
+    start()
+    # The snapshot covers the seed log whole, so it is gone
+    logs = sorted(os.listdir(tmp_path / 'store' / 'logs'))
+    assert logs == ['000000000041.log']
+    assert os.path.getsize(tmp_path / 'store' / 'logs' / logs[0]) == 0
+
+    second = start()
+    second.add_training_item({'filename': 'late/addition.txt', 'content': 'INT. LIGHTHOUSE - NIGHT\n\nZEBRA KEEPER\n'})
+    state = TrainingStore(str(tmp_path / 'store')).load()
+    assert [record['item']['filename'] for record in state.records] == ['late/addition.txt']
+
+    third = start()
+    assert third.training_data.live_count == 41
+    assert ranking(third, 'zebra lighthouse')[0][1] == 'late/addition.txt'
+
+
+def test_deletes_survive_restart(start):
+    first = start()
+    filename = first.training_data[0].filename
+    first.reload_training_files([], [0])
+    assert first.training_data.live_count == 39
+    second = start()
+    assert second.training_data.live_count == 39
+    assert second.training_data.is_deleted(0)
+    assert all(document.filename != filename
+               for query in QUERIES for _, document in second._retrieve_training_documents(query, k=40))
+
+
+def test_old_snapshot_layout_is_rebuilt(start, tmp_path):
+    start()
+    store_dir = tmp_path / 'store'
+    with open(store_dir / 'CURRENT') as f:
+        snapshot = store_dir / 'snapshots' / f.read().strip()
+    info = json.loads((snapshot / 'snapshot.json').read_text())
+    info['format'] = 1
+    (snapshot / 'snapshot.json').write_text(json.dumps(info))
+
+    second = start()
+    assert second.training_data.live_count == 40
+    assert any(name.startswith('stale-') for name in os.listdir(store_dir))
+    # And the rebuilt store restores normally from then on
+    assert start().store.snapshot_seq == 40
+
+
+def test_term_table_round_trip(tmp_path):
+    table = {'rain': [3, 1, 1, 2], 'ünïcode': [2, 5], 'alley': [0, 1]}
+    write_term_table(str(tmp_path), 'docs.postings', table, 2)
+    mapped = MappedTermTable(str(tmp_path), 'docs.postings', 2)
+    assert len(mapped) == 3
+    assert list(mapped.get('rain')) == [1, 2, 3, 1]
+    assert list(mapped.get('ünïcode')) == [2, 5]
+    assert mapped.get('missing', ()) == ()
+    assert 'alley' in mapped and 'zebra' not in mapped
+    assert {term: list(values) for term, values in mapped.items()} == {
+        'alley': [0, 1], 'rain': [1, 2, 3, 1], 'ünïcode': [2, 5]}
+
+    write_term_table(str(tmp_path), 'empty', {}, 1)
+    assert MappedTermTable(str(tmp_path), 'empty', 1).get('rain') is None
+
+
+def picks(pools, doc_id=None):
+    return [pools.pick(query, slot, kind, doc_id)
+            for query in QUERIES for slot, kind in (('scene_description', 'scenes'), ('dialogue', 'dialogue'),
+                                                     ('action_line', 'actions'), ('plot_point', 'beats'))]
+
+
+def test_fallback_pools_restored_from_snapshot(start):
+    first = start()
+    first.fallback_pools.refresh(first.training_data)
+    second = start()
+    # Mapped from the snapshot rather than rebuilt
+    assert second.fallback_pools.covered == 40
+    for doc_id in (None, 0, 17):
+        assert picks(second.fallback_pools, doc_id) == picks(first.fallback_pools, doc_id)
+
+
+def test_fallback_pools_saved_as_of_doc_count(start, tmp_path):
+    documents = start().training_data
+    pools = FallbackPools()
+    pools.save(str(tmp_path), documents, 25)
+    partial = FallbackPools.open(str(tmp_path), documents)
+    assert partial.covered == 25
+    partial.refresh(documents)
+    assert partial.stats() == pools.stats()
+    for doc_id in (None, 3, 30):
+        assert picks(partial, doc_id) == picks(pools, doc_id)
+
+
+def test_non_ascii_spans_round_trip(start):
+    content = ('INT. CAFÉ MÜNCHEN - NACHT\n\nRain on the 窓. Zoë waits — coffee ☕ gone cold.\n\n'
+               'ZOË\nWo bist du? 🌧\n\nJÜRGEN\n(leise)\nHier. Immer hier.\n\n'
+               'EXT. 東京 STREET - DAWN\n\nNeon fades. Jürgen walks into the crowd.\n')
+    expected = summarize_elements(parse_elements(content))
+    chunks = [content[char_start:char_end].strip() for char_start, char_end in chunk_spans(content)]
+    generator = start()
+    generator.add_training_item({'filename': 'late/café.txt', 'content': content})
+    for documents in (generator.training_data, start().training_data):
+        doc_id = len(documents) - 1
+        assert summarize_elements(documents.elements(doc_id)) == expected
+        assert [documents.chunk_text(chunk_id) for chunk_id in documents.chunk_range(doc_id)] == chunks
+        for i in range(0, len(documents.raw_spans(doc_id)), SPAN_WIDTH):
+            _, start_byte, end_byte, cue_start, cue_end = documents.raw_spans(doc_id)[i:i + SPAN_WIDTH]
+            assert documents.span_text(doc_id, start_byte, end_byte) in content
+            if cue_start >= 0:
+                assert documents.span_text(doc_id, cue_start, cue_end) in ('ZOË', 'JÜRGEN')
+
+
+def test_scripts_etag_matches_across_restart(start, monkeypatch):
+    import app
+    client = app.app.test_client()
+
+    def listing(generator, etag=None):
+        monkeypatch.setattr(app, 'script_generator', generator)
+        return client.get('/scripts?limit=5', headers={'If-None-Match': etag} if etag else {})
+
+    live = start()
+    live.reload_training_files([], [2, 5])
+    live.add_training_item({'filename': 'late/addition.txt', 'content': 'INT. LIGHTHOUSE - NIGHT\n\nZEBRA KEEPER\n'})
+    etag = listing(live).headers['ETag']
+    with live.store.locked():
+        snapshot = live._start_snapshot()
+    live._write_snapshot(*snapshot)
+    # A worker that opened that snapshot holds the same documents, so it keeps the client's copy
+    restored = start()
+    assert listing(restored, etag).status_code == 304
+    restored.reload_training_files([], [7])
+    changed = listing(restored, etag)
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
@@ -0,0 +1,44 @@
+import os
+
+from training_watcher import TRAINING_SOURCE, TrainingWatcher
+
+
+def begin(generator, training_dir):
+    """Run a watcher's start-up scan in this thread; returns it and the paths it read"""
+    watcher = TrainingWatcher(generator, str(training_dir), mode='poll')
+    read = []
+    original = watcher._read
+
+    def counting_read(path, stat=None):
+        read.append(path)
+        return original(path, stat)
+    watcher._read = counting_read
+    watcher._begin()
+    return watcher, read
+
+
+def test_start_reads_only_files_whose_stat_changed(start, training_dir):
+    generator = start()
+    watcher, read = begin(generator, training_dir)
+    assert read == []
+    assert watcher.files == 40 and watcher.reloads == 0
+
+    paths = sorted(str(path.relative_to(training_dir)) for path in training_dir.rglob('*.txt'))
+    edited, touched = paths[0], paths[1]
+    (training_dir / edited).write_text('INT. QUARRY - DAY\n\nA new draft.\n', encoding='utf-8')
+    stat = os.stat(training_dir / touched)
+    os.utime(training_dir / touched, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    watcher, read = begin(generator, training_dir)
+    assert sorted(read) == [edited, touched]
+    assert watcher.reloads == 1 and dict(watcher.changes) == {'modified': 1}
+    documents = generator.training_data
+    doc_id = len(documents) - 1
+    assert documents.filename(doc_id) == edited
+    stat = os.stat(training_dir / edited)
+    assert documents.metadata[doc_id] == {'source': TRAINING_SOURCE, 'mtime': stat.st_mtime_ns,
+                                          'size': stat.st_size}
+
+    # The edit is recorded with its stat; the touched file keeps its old one and is compared by digest
+    _, read = begin(generator, training_dir)
+    assert read == [touched]
@@ -0,0 +1,472 @@
+"""
+Durable training corpus: an append-only ingest log plus compacted, memory-mapped snapshots
+
+Layout under TRAINING_STORE_DIR:
+
+    lock                      process-wide append/snapshot lock (flock)
+    logs/<first seq>.log      JSON lines: {"seq", "item", "spans", "chunks", "signature"}
+                              for documents, {"seq", "delete"} for doc ids retired
+    snapshots/<seq>/          DocumentStore columns (see document_store.py) and,
+                              per index, <name>.doclens.bin, <name>.index.json
+                              and two term tables, <name>.postings.* and
+                              <name>.filenames.*, plus semantic.* when semantic
+                              retrieval has been fitted (see semantic_index.py)
+                              and the fallback element pools, fallback.*
+                              (see fallback_pools.py), and dedup clusters,
+                              dedup.* (see dedup.py)
+    CURRENT                   name of the newest complete snapshot
+
+A term table is four flat files: the sorted terms' UTF-8 bytes (.terms.bin)
+with their byte offsets (.termoffsets.bin), the values (.bin) and each
+term's first value (.offsets.bin). Lookups binary-search the mapped files,
+so nothing is decoded when a snapshot is opened.
+
+Startup maps the snapshot named in CURRENT and replays only log records
+newer than it, skipping log files the snapshot covers whole, so restart
+cost tracks the log tail rather than the corpus.
+Every worker appends under the same lock after catching up on the log,
+which keeps document ids identical across gunicorn workers.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+from dedup import DedupIndex
+from document_store import DocumentStore, _int_view, _map_file
+from fallback_pools import FallbackPools
+from retrieval import LONGEST_POOL_SIZE, posting_pairs
+from semantic_index import SemanticIndex
+
+STORE_DIR = os.getenv('TRAINING_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'store'))
+STORE_ENABLED = os.getenv('TRAINING_STORE', 'true').lower() not in ('0', 'false', 'no')
+# Compact the log into a new snapshot after this many appended records
+SNAPSHOT_EVERY = int(os.getenv('SNAPSHOT_EVERY', 1000))
+# fsync each append; turn off only where losing the last few records is acceptable
+STORE_FSYNC = os.getenv('STORE_FSYNC', 'true').lower() not in ('0', 'false', 'no')
+# How often request handlers look for records appended by other workers
+STORE_REFRESH_SECONDS = float(os.getenv('STORE_REFRESH_SECONDS', 1.0))
+
+SEQ_WIDTH = 12
+# Bumped whenever the snapshot layout changes
+SNAPSHOT_FORMAT = 5
+
+
+class LogGap(Exception):
+    """Records this process never read were compacted away; reload from the snapshot"""
+
+
+class MappedTermTable:
+    """term -> values lookups over a term table mapped from a snapshot
+
+    width is the number of int32s per value: 2 for (doc_id, tf) postings,
+    which come back flat like IndexSegment's, 1 for the doc ids of
+    filename postings.
+    """
+
+    def __init__(self, directory, prefix, width):
+        def mapped(suffix):
+            return _map_file(os.path.join(directory, f"{prefix}.{suffix}"))
+
+        self.width = width
+        self._text = mapped('terms.bin')
+        self._term_offsets = _int_view(mapped('termoffsets.bin'), 'q')
+        self._offsets = _int_view(mapped('offsets.bin'), 'q')
+        self._values = _int_view(mapped('bin'), 'i')
+        self._count = max(0, len(self._term_offsets) - 1)
+
+    def _term(self, position):
+        return self._text[self._term_offsets[position]:self._term_offsets[position + 1]]
+
+    def _find(self, term):
+        """Position of term in the sorted table, or None"""
+        key = term.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._term(low) == key:
+            return low
+        return None
+
+    def _values_at(self, position):
+        view = self._values[self._offsets[position] * self.width:self._offsets[position + 1] * self.width]
+        if self.width == 2:
+            return view
+        return list(view)
+
+    def __contains__(self, term):
+        return self._find(term) is not None
+
+    def __len__(self):
+        return self._count
+
+    def get(self, term, default=None):
+        position = self._find(term)
+        return default if position is None else self._values_at(position)
+
+    def items(self):
+        for position in range(self._count):
+            yield bytes(self._term(position)).decode('utf-8'), self._values_at(position)
+
+
+def write_term_table(directory, prefix, table, width):
+    """Write term -> values as a term table; values are flat (doc_id, tf) postings or doc ids by width"""
+    text = bytearray()
+    term_offsets = array('q', [0])
+    offsets = array('q', [0])
+    values = array('i')
+    # UTF-8 byte order is code point order, so str-sorted terms are byte-sorted too
+    for term in sorted(table):
+        text += term.encode('utf-8')
+        term_offsets.append(len(text))
+        if width == 2:
+            for doc_id, tf in sorted(posting_pairs(table[term])):
+                values.append(doc_id)
+                values.append(tf)
+        else:
+            values.extend(sorted(table[term]))
+        offsets.append(len(values) // width)
+    with open(os.path.join(directory, f"{prefix}.terms.bin"), 'wb') as f:
+        f.write(text)
+    for suffix, column in (('termoffsets.bin', term_offsets), ('offsets.bin', offsets), ('bin', values)):
+        with open(os.path.join(directory, f"{prefix}.{suffix}"), 'wb') as f:
+            column.tofile(f)
+
+
+class MappedSegment:
+    """Read-only index segment loaded from a snapshot (documents 0..n-1)"""
+
+    mergeable = False
+
+    def __init__(self, directory, name):
+        with open(os.path.join(directory, f"{name}.index.json"), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        self.postings = MappedTermTable(directory, f"{name}.postings", 2)
+        self.filename_postings = MappedTermTable(directory, f"{name}.filenames", 1)
+        self.doc_lengths = _int_view(_map_file(os.path.join(directory, f"{name}.doclens.bin")), 'i')
+        self.total_length = info['total_length']
+        self.longest = [tuple(entry) for entry in info['longest']]
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+
+class StoreState:
+    """What startup recovered from disk"""
+
+    def __init__(self, documents=None, segments=None, records=None, seq=0, semantic=None, fallback=None,
+                 dedup=None):
+        self.documents = documents
+        self.segments = segments or {}  # index name -> MappedSegment
+        self.semantic = semantic        # SemanticIndex over the snapshot's chunks, if fitted
+        self.fallback = fallback        # FallbackPools over the snapshot's documents, if saved
+        self.dedup = dedup              # DedupIndex over them, if saved with the current settings
+        self.records = records or []
+        self.seq = seq
+
+    @property
+    def empty(self):
+        return self.documents is None and not self.records
+
+
+class TrainingStore:
+    """Append-only log of ingested training items with periodic compacted snapshots"""
+
+    def __init__(self, directory=STORE_DIR, snapshot_every=SNAPSHOT_EVERY, fsync=STORE_FSYNC):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.logs_dir = os.path.join(directory, 'logs')
+        self.snapshots_dir = os.path.join(directory, 'snapshots')
+        os.makedirs(self.logs_dir, exist_ok=True)
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        self.last_seq = 0
+        self.snapshot_seq = 0
+        self.appended_since_snapshot = 0
+        self.snapshotting = False
+        self._positions = {}   # log name -> bytes already consumed
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+
+    # Locking
+
+    @contextmanager
+    def locked(self):
+        """Exclusive across threads and processes sharing the store"""
+        with self._lock:
+            with open(os.path.join(self.directory, 'lock'), 'a+') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Reading
+
+    def _current_snapshot(self):
+        try:
+            with open(os.path.join(self.directory, 'CURRENT'), 'r') as f:
+                name = f.read().strip()
+        except OSError:
+            return None
+        path = os.path.join(self.snapshots_dir, name)
+        return path if name and os.path.isdir(path) else None
+
+    def _log_names(self):
+        return sorted(name for name in os.listdir(self.logs_dir) if name.endswith('.log'))
+
+    def load(self):
+        """Map the newest snapshot and collect the log records written after it"""
+        state = StoreState()
+        self.last_seq = self.snapshot_seq = 0
+        self._positions = {}
+        snapshot = self._current_snapshot()
+        if snapshot is not None:
+            with open(os.path.join(snapshot, 'snapshot.json'), 'r', encoding='utf-8') as f:
+                info = json.load(f)
+            if info.get('format', 1) != SNAPSHOT_FORMAT:
+                self._drop_stale_snapshot(snapshot)
+                snapshot = None
+        if snapshot is not None:
+            state.documents = DocumentStore.open(snapshot)
+            state.segments = {name: MappedSegment(snapshot, name) for name in info['indexes']}
+            if info.get('semantic'):
+                state.semantic = SemanticIndex.open(snapshot)
+            if info.get('fallback'):
+                state.fallback = FallbackPools.open(snapshot, state.documents)
+            if info.get('dedup'):
+                state.dedup = DedupIndex.open(snapshot, state.documents)
+            state.seq = self.last_seq = self.snapshot_seq = info['seq']
+        state.records = self.read_new()
+        return state
+
+    def _drop_stale_snapshot(self, snapshot):
+        """Stop using a snapshot written in an older layout; caller holds locked()
+
+        The log is replayed instead when it still starts at seq 1. Otherwise
+        the store is moved aside whole and rebuilt from the training files.
+        """
+        names = self._log_names()
+        if names and int(names[0][:-4]) == 1:
+            print(f"Training store snapshot {snapshot} has an old layout; replaying the log instead")
+            os.remove(os.path.join(self.directory, 'CURRENT'))
+            return
+        stale = os.path.join(self.directory, f"stale-{int(time.time())}")
+        print(f"Training store snapshot {snapshot} has an old layout and the log is compacted; "
+              f"moved the store to {stale} and rebuilding it from the training files")
+        os.makedirs(stale)
+        for name in ('CURRENT', 'logs', 'snapshots'):
+            os.replace(os.path.join(self.directory, name), os.path.join(stale, name))
+        os.makedirs(self.logs_dir)
+        os.makedirs(self.snapshots_dir)
+
+    def read_new(self):
+        """Records appended (by any process) since the last read, in seq order"""
+        records = []
+        names = self._log_names()
+        for name, following in zip(names, names[1:] + [None]):
+            # A log ends right before the next one starts; skip those already read or snapshotted whole
+            if following is not None and int(following[:-4]) - 1 <= self.last_seq:
+                continue
+            path = os.path.join(self.logs_dir, name)
+            position = self._positions.get(name, 0)
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(position)
+                    data = f.read()
+            except OSError:
+                continue
+            # Only consume complete lines; a torn final write is retried next time
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(f"Skipping corrupt training log record in {name}")
+                    continue
+                if record['seq'] > self.last_seq + 1:
+                    raise LogGap(f"training log jumps from {self.last_seq} to {record['seq']}")
+                if record['seq'] > self.last_seq:
+                    records.append(record)
+                    self.last_seq = record['seq']
+            self._positions[name] = position + end
+        return records
+
+    def refresh(self, catch_up):
+        """Run catch_up() at most once per STORE_REFRESH_SECONDS, for the request path
+
+        catch_up runs under the store's thread lock, so records are applied
+        in seq order even when several request threads refresh at once.
+        """
+        now = time.monotonic()
+        if now - self._last_refresh < STORE_REFRESH_SECONDS:
+            return
+        self._last_refresh = now
+        with self._lock:
+            catch_up()
+
+    # Writing
+
+    def append(self, records):
+        """Assign seqs and durably append records; caller holds locked() and has caught up"""
+        if not records:
+            return []
+        names = self._log_names()
+        name = names[-1] if names else f"{self.last_seq + 1:0{SEQ_WIDTH}d}.log"
+        lines = []
+        for record in records:
+            self.last_seq += 1
+            record['seq'] = self.last_seq
+            lines.append(json.dumps(record, separators=(',', ':')))
+        payload = ('\n'.join(lines) + '\n').encode('utf-8')
+
+        path = os.path.join(self.logs_dir, name)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            position = os.fstat(fd).st_size
+            os.write(fd, payload)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        # Our own records are already applied; don't read them back
+        if self._positions.get(name, 0) == position:
+            self._positions[name] = position + len(payload)
+        self.appended_since_snapshot += len(records)
+        return [record['seq'] for record in records]
+
+    def snapshot_due(self):
+        return not self.snapshotting and self.appended_since_snapshot >= self.snapshot_every
+
+    def rotate(self):
+        """Start a new log file after the current seq; caller holds locked()"""
+        name = f"{self.last_seq + 1:0{SEQ_WIDTH}d}.log"
+        open(os.path.join(self.logs_dir, name), 'ab').close()
+        self.appended_since_snapshot = 0
+        return self.last_seq
+
+    def write_snapshot(self, seq, documents, doc_count, indexes, semantic=None, fallback=None, dedup=None):
+        """Write documents[0:doc_count] and their indexes as the snapshot for seq
+
+        indexes maps a name to (index snapshot, entry count); each snapshot
+        must cover exactly the entries of those documents, and so must the
+        optional (semantic index view, chunk count). The optional
+        FallbackPools are saved as of doc_count too, and so is the optional
+        DedupIndex.snapshot(), which must cover exactly those documents.
+        documents may keep growing past doc_count while this runs.
+        """
+        name = f"{seq:0{SEQ_WIDTH}d}"
+        final_path = os.path.join(self.snapshots_dir, name)
+        if not os.path.isdir(final_path):
+            self._write_snapshot_files(final_path, documents, doc_count, indexes, semantic, fallback, dedup, seq)
+        with self.locked():
+            # Another worker may have published a newer snapshot meanwhile
+            current = self._current_snapshot()
+            if current is not None and int(os.path.basename(current)) >= seq:
+                return
+            self._swap_current(name)
+            self.snapshot_seq = seq
+            self._prune(seq)
+
+    def _write_snapshot_files(self, final_path, documents, doc_count, indexes, semantic, fallback, dedup, seq):
+        tmp_path = f"{final_path}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        documents.save(tmp_path, doc_count)
+        for name, (index_snapshot, count) in indexes.items():
+            self._write_index(tmp_path, name, index_snapshot, count)
+        if semantic is not None:
+            semantic_view, count = semantic
+            semantic_view.save(tmp_path, count)
+        pooled = fallback is not None and fallback.save(tmp_path, documents, doc_count)
+        if dedup is not None:
+            dedup.save(tmp_path)
+        with open(os.path.join(tmp_path, 'snapshot.json'), 'w', encoding='utf-8') as f:
+            json.dump({'seq': seq, 'format': SNAPSHOT_FORMAT, 'documents': doc_count,
+                       'indexes': sorted(indexes), 'semantic': semantic is not None, 'fallback': pooled,
+                       'dedup': dedup is not None,
+                       'created': time.time()}, f)
+
+        os.replace(tmp_path, final_path)
+
+    def _write_index(self, directory, name, index_snapshot, count):
+        """Flatten an index snapshot over entries 0..count-1 into <name>.* files"""
+        # Flatten every segment into one postings file ordered by term, then doc id
+        merged = {}
+        doc_lengths = array('i', bytes(4 * count))
+        filename_postings = {}
+        longest = []
+        total_length = 0
+        for segment in index_snapshot.segments:
+            for term, postings in segment.postings.items():
+                merged.setdefault(term, array('i')).extend(postings)
+            if isinstance(segment.doc_lengths, dict):
+                for doc_id, length in segment.doc_lengths.items():
+                    doc_lengths[doc_id] = length
+            else:
+                doc_lengths[:len(segment.doc_lengths)] = array('i', segment.doc_lengths)
+            for term, doc_ids in segment.filename_postings.items():
+                filename_postings.setdefault(term, set()).update(doc_ids)
+            longest.extend(segment.longest)
+            total_length += segment.total_length
+
+        write_term_table(directory, f"{name}.postings", merged, 2)
+        write_term_table(directory, f"{name}.filenames", filename_postings, 1)
+        with open(os.path.join(directory, f"{name}.doclens.bin"), 'wb') as f:
+            doc_lengths.tofile(f)
+        longest.sort(reverse=True)
+        with open(os.path.join(directory, f"{name}.index.json"), 'w', encoding='utf-8') as f:
+            json.dump({'total_length': total_length, 'longest': longest[:LONGEST_POOL_SIZE]}, f)
+
+    def _swap_current(self, name):
+        current_tmp = os.path.join(self.directory, f"CURRENT.tmp{os.getpid()}")
+        with open(current_tmp, 'w') as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(current_tmp, os.path.join(self.directory, 'CURRENT'))
+
+    def _prune(self, seq):
+        """Drop snapshots and logs a full generation behind the new snapshot
+
+        Logs covered only by the newest snapshot are kept for a while so
+        workers that have not caught up yet can still read them. The first
+        snapshot has no generation behind it, so the seed log it covers is
+        dropped at once; a worker still reading it reloads (see LogGap).
+        """
+        snapshots = sorted(name for name in os.listdir(self.snapshots_dir) if name.isdigit())
+        previous = [int(name) for name in snapshots if int(name) < seq]
+        keep_after = previous[-1] if previous else seq
+        for name in snapshots:
+            if int(name) < keep_after:
+                shutil.rmtree(os.path.join(self.snapshots_dir, name), ignore_errors=True)
+
+        names = self._log_names()
+        for current, following in zip(names, names[1:]):
+            # A log ends right before the next one starts
+            if int(following[:-4]) - 1 <= keep_after:
+                try:
+                    os.remove(os.path.join(self.logs_dir, current))
+                except OSError:
+                    pass
+                self._positions.pop(current, None)
+
+    def stats(self):
+        return {
+            'directory': self.directory,
+            'lastSeq': self.last_seq,
+            'snapshotSeq': self.snapshot_seq,
+            'appendedSinceSnapshot': self.appended_since_snapshot
+        }
+
@@ -0,0 +1,468 @@
+"""
+Hot reload of the training directory
+
+The watcher keeps a manifest of every .txt file under the training
+directory (mtime, size, content digest and the doc id serving it). When
+files change it reads only those whose mtime or size moved, skips the
+ones whose content digest did not, and commits the rest at once: new and
+edited files become training records, and the documents of edited and
+removed files are deleted in the same commit, so the documents, indexes
+and fallback pools switch over in one snapshot swap while requests keep
+reading the old one. A reload costs what the change costs, not what the
+corpus costs.
+
+On Linux the watcher sleeps on inotify and rescans only the directories
+events came from; elsewhere, or with TRAINING_WATCH=poll, it stats the
+tree every TRAINING_WATCH_INTERVAL seconds. Documents loaded from the
+directory record the mtime and size their file had when it was read, so
+the first scan only stats the tree and reads the files whose stat moved
+since. With the training store, one process per store watches (whichever
+holds watch.lock) and the others pick its commits up from the log like
+any other training.
+"""
+
+import ctypes
+import ctypes.util
+import fcntl
+import os
+import select
+import struct
+import threading
+import time
+from collections import Counter
+
+from cache import content_digest
+
+# auto (inotify, else polling), poll, or off
+TRAINING_WATCH = os.getenv('TRAINING_WATCH', 'auto').lower()
+# Seconds between polls, and between tries to take over watching from another process
+TRAINING_WATCH_INTERVAL = float(os.getenv('TRAINING_WATCH_INTERVAL', 2.0))
+# Quiet time after an event before changed files are read, so a burst of writes is one reload
+TRAINING_WATCH_DEBOUNCE_MS = int(os.getenv('TRAINING_WATCH_DEBOUNCE_MS', 250))
+
+# metadata['source'] of documents loaded from the training directory
+TRAINING_SOURCE = 'training'
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+               IN_DELETE_SELF | IN_MOVE_SELF)
+# struct inotify_event without its trailing name
+_EVENT = struct.Struct('iIII')
+
+
+def training_metadata(mtime_ns, size):
+    """Metadata of a document read from a training file with this stat"""
+    return {'source': TRAINING_SOURCE, 'mtime': mtime_ns, 'size': size}
+
+
+def training_directory():
+    """Directory training files are loaded from: the first of the candidates that exists, or None"""
+    # Try multiple possible paths for scripts, prioritizing training folder
+    possible_paths = [
+        os.path.join(os.path.dirname(__file__), '..', 'training'),
+        os.path.join(os.path.dirname(__file__), '..', 'scripts'),
+        os.path.join(os.path.dirname(__file__), 'scripts')
+    ]
+    for path in possible_paths:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class _Inotify:
+    """Just enough of inotify(7) through libc; raises OSError where it is unavailable"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}  # watch descriptor -> directory relative to the root ('' for the root)
+
+    def watch(self, path, directory):
+        wd = self._add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.directories[wd] = directory
+
+    def unwatch(self, directory):
+        """Drop the watches of a directory and everything under it"""
+        prefix = directory + os.sep
+        for wd, watched in list(self.directories.items()):
+            if watched == directory or watched.startswith(prefix):
+                self._rm_watch(self.fd, wd)
+                del self.directories[wd]
+
+    def read(self, timeout):
+        """[(directory, mask, name)] for the events of the next timeout seconds, at most one read's worth
+
+        directory is None for a queue overflow, after which anything may have changed.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0'))
+            offset += _EVENT.size + length
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            events.append((self.directories.get(wd) if not mask & IN_Q_OVERFLOW else None, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TrainingWatcher:
+    """Reloads training files that change on disk into a ScriptGenerator
+
+    The generator provides sync_training_data(), which catches up on the
+    store log and returns the current DocumentStore, and
+    reload_training_files(items, retired), which commits new items in
+    place of the retired doc ids and returns their doc ids.
+    """
+
+    def __init__(self, generator, directory=None, lock_path=None, mode=TRAINING_WATCH,
+                 interval=TRAINING_WATCH_INTERVAL, debounce_ms=TRAINING_WATCH_DEBOUNCE_MS):
+        self.generator = generator
+        self.directory = directory
+        self.lock_path = lock_path
+        self.mode = mode if directory is not None else 'off'
+        self.interval = interval
+        self.debounce = debounce_ms / 1000.0
+        # directory -> file name -> (mtime_ns, size, digest, doc id or None), directories relative to the root
+        self._files = {}
+        self._inotify = None
+        self._lock_file = None
+        self._thread = None
+        self._pid = None
+        self._stopped = threading.Event()
+        self.active = False
+        self.files = 0
+        self.reloads = 0
+        self.changes = Counter()
+        self.errors = 0
+        self.last_reload = None
+
+    def start(self):
+        """Watch in a background thread; call again in a forked child to watch there"""
+        pid = os.getpid()
+        if self.mode == 'off' or self._pid == pid:
+            return
+        self._pid = pid
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    # Watching
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if not self.active:
+                    if not self._take_over():
+                        self._stopped.wait(self.interval)
+                        continue
+                    self._begin()
+                if self._inotify is None:
+                    self._stopped.wait(self.interval)
+                    self._rescan({'': True})
+                    continue
+                dirty = self._dirty(self._inotify.read(self.interval))
+                if not dirty:
+                    continue
+                # Let a burst of writes settle before reading anything
+                while True:
+                    events = self._inotify.read(self.debounce)
+                    if not events:
+                        break
+                    for directory, recursive in self._dirty(events).items():
+                        dirty[directory] = dirty.get(directory, False) or recursive
+                self._rescan(dirty)
+            except Exception as e:
+                self.errors += 1
+                print(f"Training watch error: {e}")
+                self._stopped.wait(self.interval)
+
+    def _take_over(self):
+        """Whether this process is (now) the one watching for its store"""
+        if self.lock_path is None or self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        # Held for the life of the process
+        self._lock_file = lock_file
+        return True
+
+    def _begin(self):
+        """Set up inotify, match the files on disk to their documents and reload what differs"""
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._files = {}
+        if self.mode != 'poll':
+            try:
+                self._inotify = _Inotify()
+                self._watch_tree('')
+            except OSError as e:
+                print(f"Training watch falling back to polling: {e}")
+                if self._inotify is not None:
+                    self._inotify.close()
+                self._inotify = None
+
+        started = time.monotonic()
+        on_disk = {}
+        self._walk('', on_disk)
+        documents = self.generator.sync_training_data()
+        loaded = self._loaded_files(documents, on_disk)
+        items = []
+        retired = []
+        counts = Counter()
+        read = 0
+        for path, stat in on_disk.items():
+            doc_id = loaded.pop(path, None)
+            if doc_id is not None:
+                metadata = documents.metadata.get(doc_id, {})
+                if (metadata.get('mtime'), metadata.get('size')) == (stat.st_mtime_ns, stat.st_size):
+                    self._remember(path, (stat.st_mtime_ns, stat.st_size, documents.digest(doc_id), doc_id))
+                    continue
+            entry = self._read(path, stat)
+            if entry is None:
+                continue
+            read += 1
+            if doc_id is not None and documents.digest(doc_id) == entry[2]:
+                # Touched or rewritten with the same text
+                self._remember(path, entry[:3] + (doc_id,))
+                continue
+            # Changed or added while the service was down
+            self._remember(path, entry[:3] + (None,))
+            items.append((path, entry[3], entry[2]))
+            if doc_id is not None:
+                retired.append(doc_id)
+            counts['modified' if doc_id is not None else 'added'] += 1
+        # Removed while the service was down
+        for doc_id in loaded.values():
+            if documents.metadata.get(doc_id, {}).get('source') == TRAINING_SOURCE:
+                retired.append(doc_id)
+                counts['deleted'] += 1
+        self._commit(items, retired, counts)
+        self._count_files()
+        self.active = True
+        print(f"Watching {self.files} training files in {self.directory} "
+              f"({'inotify' if self._inotify is not None else 'polling'}, {read} read, matched in "
+              f"{time.monotonic() - started:.1f}s)")
+
+    def _loaded_files(self, documents, on_disk):
+        """path -> doc id of the live documents loaded from training files
+
+        Documents stored before they were tagged with their source count
+        when they have no script id and their filename is on disk.
+        """
+        loaded = {}
+        metadata = documents.metadata
+        for doc_id in range(len(documents)):
+            if documents.is_deleted(doc_id):
+                continue
+            source = metadata.get(doc_id, {}).get('source')
+            if source is not None and source != TRAINING_SOURCE:
+                continue
+            filename = documents.filename(doc_id)
+            if source == TRAINING_SOURCE or (filename in on_disk and documents.ids.get(doc_id) is None):
+                loaded[filename] = doc_id
+        return loaded
+
+    def _watch_tree(self, directory):
+        root = os.path.join(self.directory, directory)
+        self._inotify.watch(root, directory)
+        for path, dirs, _ in os.walk(root):
+            for name in dirs:
+                full = os.path.join(path, name)
+                self._inotify.watch(full, os.path.relpath(full, self.directory))
+
+    def _dirty(self, events):
+        """directory -> whether to rescan its subdirectories too, for a batch of events"""
+        dirty = {}
+        for directory, mask, name in events:
+            if directory is None:
+                return {'': True}
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # A subdirectory's removal also shows up as an event on its parent
+                if directory == '':
+                    return {'': True}
+                continue
+            if mask & IN_ISDIR:
+                path = os.path.join(directory, name)
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._inotify.unwatch(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # Watch before scanning so files written meanwhile aren't missed
+                    self._watch_tree(path)
+                dirty[path] = True
+            elif name.endswith('.txt'):
+                dirty.setdefault(directory, False)
+        return dirty
+
+    # Scanning
+
+    def _read(self, path, stat=None):
+        """(mtime_ns, size, digest, content) of a training file, or None if it can't be read"""
+        full = os.path.join(self.directory, path)
+        try:
+            stat = stat or os.stat(full)
+            with open(full, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Error loading {path}: {e}")
+            return None
+        return stat.st_mtime_ns, stat.st_size, content_digest(content), content
+
+    def _walk(self, directory, found):
+        """Stat every .txt file under directory into found (path -> os.stat_result)"""
+        try:
+            with os.scandir(os.path.join(self.directory, directory)) as entries:
+                for entry in entries:
+                    path = os.path.join(directory, entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            self._walk(path, found)
+                        elif entry.name.endswith('.txt') and entry.is_file():
+                            found[path] = entry.stat()
+                    except OSError:
+                        pass
+        except OSError as e:
+            print(f"Error listing {directory or self.directory}: {e}")
+
+    def _scan(self, directory, recursive, items, retired, counts):
+        """Compare one directory (and its subdirectories if recursive) with the manifest"""
+        known = self._files.get(directory, {})
+        listed = {}
+        subdirectories = []
+        try:
+            with os.scandir(os.path.join(self.directory, directory)) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(os.path.join(directory, entry.name))
+                    elif entry.name.endswith('.txt') and entry.is_file():
+                        listed[entry.name] = entry.stat()
+        except OSError:
+            pass
+
+        for name in list(known.keys() - listed.keys()):
+            _, _, _, doc_id = known.pop(name)
+            if doc_id is not None:
+                retired.append(doc_id)
+            counts['deleted'] += 1
+        for name, stat in listed.items():
+            path = os.path.join(directory, name)
+            previous = known.get(name)
+            if previous is not None and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+                continue
+            entry = self._read(path, stat)
+            if entry is None:
+                continue
+            mtime, size, digest, content = entry
+            if previous is not None and previous[2] == digest:
+                # Touched or rewritten with the same text
+                known[name] = (mtime, size, digest, previous[3])
+                continue
+            known[name] = (mtime, size, digest, None)
+            items.append((path, content, digest))
+            if previous is not None and previous[3] is not None:
+                retired.append(previous[3])
+            counts['modified' if previous is not None else 'added'] += 1
+        if known:
+            self._files[directory] = known
+        else:
+            self._files.pop(directory, None)
+
+        if recursive:
+            for subdirectory in subdirectories:
+                self._scan(subdirectory, True, items, retired, counts)
+            # Directories that disappeared along with their files
+            prefix = directory + os.sep if directory else ''
+            for known_directory in [d for d in self._files if d.startswith(prefix) and d != directory]:
+                if not os.path.isdir(os.path.join(self.directory, known_directory)):
+                    self._scan(known_directory, False, items, retired, counts)
+
+    def _rescan(self, dirty):
+        items = []
+        retired = []
+        counts = Counter()
+        for directory, recursive in sorted(dirty.items()):
+            self._scan(directory, recursive, items, retired, counts)
+        self._commit(items, retired, counts)
+        self._count_files()
+
+    def _count_files(self):
+        self.files = sum(len(files) for files in self._files.values())
+
+    def _remember(self, path, entry):
+        directory, name = os.path.split(path)
+        self._files.setdefault(directory, {})[name] = entry
+
+    def _commit(self, items, retired, counts):
+        """Reload changed files in one commit and record the doc ids they got"""
+        if not items and not retired:
+            return
+        started = time.monotonic()
+        reloaded = []
+        for path, content, digest in items:
+            directory, name = os.path.split(path)
+            mtime, size, _, _ = self._files[directory][name]
+            reloaded.append({'filename': path, 'content': content, 'digest': digest,
+                             'metadata': training_metadata(mtime, size)})
+        doc_ids = self.generator.reload_training_files(reloaded, retired)
+        for (path, _, digest), doc_id in zip(items, doc_ids):
+            directory, name = os.path.split(path)
+            entry = self._files.get(directory, {}).get(name)
+            if entry is not None and entry[2] == digest:
+                self._files[directory][name] = entry[:3] + (doc_id,)
+        self.reloads += 1
+        self.changes.update(counts)
+        self.last_reload = time.time()
+        print(f"Reloaded training files: {len(items)} parsed, {len(retired)} documents retired "
+              f"in {time.monotonic() - started:.2f}s")
+
+    def stats(self):
+        mode = self.mode
+        if self.active:
+            mode = 'inotify' if self._inotify is not None else 'poll'
+        return {
+            'mode': mode,
+            'active': self.active,
+            'files': self.files,
+            'reloads': self.reloads,
+            'changes': dict(self.changes),
+            'errors': self.errors,
+            'lastReload': self.last_reload
+        }
@@ -3,6 +3,20 @@ const router = express.Router();
 const axios = require('axios');
 const Conversation = require('../models/Conversation');
 
+// The AI service queues generations per client; name the end user rather than this proxy
+const aiServiceHeaders = (req) => ({ 'X-Client-Id': req.ip, 'X-Priority': 'interactive' });
+
+// The AI service turned the request away under load: pass its 429 and retry hint along.
+// No reply is stored, so the client can simply resend the message.
+const relayOverload = (res, aiError) => {
+  const retryAfter = aiError.response.headers['retry-after'] || '1';
+  res.set('Retry-After', retryAfter);
+  return res.status(429).json({
+    error: 'AI service is busy, please retry shortly',
+    retryAfter: Number(retryAfter)
+  });
+};
+
 // POST /api/chat - Send a chat message and get AI response
 router.post('/', async (req, res) => {
   try {
@@ -36,8 +50,11 @@ router.post('/', async (req, res) => {
       const aiResponse = await axios.post(`${process.env.AI_SERVICE_URL}/generate`, {
         prompt: message,
         outputType,
-        conversationHistory: conversation.messages.slice(-10) // Last 10 messages for context
-      });
+        conversationHistory: conversation.messages.slice(-10), // Last 10 messages for context
+        // Lets the AI service keep a rolling summary of everything before them
+        conversationId: conversation._id.toString(),
+        messageCount: conversation.messages.length
+      }, { headers: aiServiceHeaders(req) });
 
       const aiContent = aiResponse.data.content || 'I apologize, but I encountered an error generating a response.';
 
@@ -54,6 +71,9 @@ router.post('/', async (req, res) => {
       });
 
     } catch (aiError) {
+      if (aiError.response && aiError.response.status === 429) {
+        return relayOverload(res, aiError);
+      }
       console.error('AI Service Error:', aiError);
       
       // Add error message
@@ -74,6 +94,124 @@ router.post('/', async (req, res) => {
   }
 });
 
+// POST /api/chat/stream - Send a chat message and relay the AI response as Server-Sent Events
+router.post('/stream', async (req, res) => {
+  try {
+    const { message, outputType = 'script', conversationId } = req.body;
+
+    if (!message) {
+      return res.status(400).json({ error: 'Message is required' });
+    }
+
+    let conversation;
+
+    if (conversationId) {
+      // Continue existing conversation
+      conversation = await Conversation.findById(conversationId);
+      if (!conversation) {
+        return res.status(404).json({ error: 'Conversation not found' });
+      }
+    } else {
+      // Create new conversation
+      conversation = new Conversation({
+        title: message.substring(0, 50) + '...',
+        outputType
+      });
+    }
+
+    // Add user message
+    await conversation.addMessage('user', message);
+
+    let aiStream;
+    try {
+      const aiResponse = await axios.post(`${process.env.AI_SERVICE_URL}/generate/stream`, {
+        prompt: message,
+        outputType,
+        conversationHistory: conversation.messages.slice(-10), // Last 10 messages for context
+        // Lets the AI service keep a rolling summary of everything before them
+        conversationId: conversation._id.toString(),
+        messageCount: conversation.messages.length
+      }, { responseType: 'stream', headers: aiServiceHeaders(req) });
+      aiStream = aiResponse.data;
+    } catch (aiError) {
+      if (aiError.response && aiError.response.status === 429) {
+        return relayOverload(res, aiError);
+      }
+      console.error('AI Service Error:', aiError);
+
+      await conversation.addMessage('ai', 'I apologize, but I encountered an error. Please try again.');
+      await conversation.save();
+
+      return res.status(500).json({
+        error: 'AI service unavailable',
+        conversationId: conversation._id,
+        response: 'I apologize, but I encountered an error. Please try again.',
+        conversation: conversation.getSummary()
+      });
+    }
+
+    res.writeHead(200, {
+      'Content-Type': 'text/event-stream',
+      'Cache-Control': 'no-cache',
+      'Connection': 'keep-alive',
+      'X-Accel-Buffering': 'no'
+    });
+    res.write(`event: conversation\ndata: ${JSON.stringify({ conversationId: conversation._id })}\n\n`);
+
+    // Pass events through untouched, watching for the final one to save the reply
+    let buffer = '';
+    let aiContent = '';
+    aiStream.on('data', (chunk) => {
+      const text = chunk.toString('utf8');
+      res.write(text);
+      // compression() buffers responses unless told to flush
+      if (res.flush) res.flush();
+
+      buffer += text;
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        if (rawEvent.startsWith('event: done\n')) {
+          const data = rawEvent.slice(rawEvent.indexOf('data: ') + 6);
+          try {
+            aiContent = JSON.parse(data).content || '';
+          } catch (parseError) {
+            console.error('Malformed done event from AI service:', parseError);
+          }
+        }
+      }
+    });
+
+    aiStream.on('end', async () => {
+      try {
+        await conversation.addMessage('ai', aiContent || 'I apologize, but I encountered an error generating a response.');
+        await conversation.save();
+      } catch (saveError) {
+        console.error('Error saving streamed conversation:', saveError);
+      }
+      res.end();
+    });
+
+    aiStream.on('error', (streamError) => {
+      console.error('AI Service stream error:', streamError);
+      res.write(`event: error\ndata: ${JSON.stringify({ error: 'AI service stream interrupted' })}\n\n`);
+      res.end();
+    });
+
+    // Stop pulling from the AI service if the client goes away
+    res.on('close', () => aiStream.destroy());
+
+  } catch (error) {
+    console.error('Chat stream route error:', error);
+    if (!res.headersSent) {
+      res.status(500).json({ error: 'Internal server error' });
+    } else {
+      res.end();
+    }
+  }
+});
+
 // GET /api/chat/:conversationId - Get conversation messages
 router.get('/:conversationId', async (req, res) => {
   try {